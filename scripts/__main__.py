@@ -20,8 +20,17 @@ This utility current loads the data and tests the correctness of
 the library.
 """
 import argparse
+import sys
 
+from .benchmark import run_benchmarks
+from .benchmark import STAGES
 from .export_csv import export_csv
+from .export_jsonl import export_jsonl
+from .fdc_api import FDC_API_URL
+from .food_store import build_food_store
+from .incremental_export import export_csv_incremental
+from .instrumentation import start_tracing
+from .instrumentation import stop_tracing
 from .integration_test import create_test_data
 from .integration_test import IntegrationTest
 from .summarize import summarize
@@ -35,25 +44,153 @@ if __name__ == '__main__':
         Available commands:
             summarize               print summary information
             export_csv              export raw data to merged CSV format
+            export_csv_incremental  update merged CSV from a new release
+            export_jsonl            export raw data to merged JSON Lines
+            build_food_store        write merged foods to an indexed store
+            build_search_index      write a search index of merged foods
+            search                  search a search index
+            benchmark_search        measure latency of search queries
+            serve                   serve merged foods like the FDC API
+            benchmark_server        measure a local server under load
+            evaluate_recipes        compute the nutrients of recipes
+            benchmark_quantities    measure bulk parsing of quantities
             create_test_data        create data for integration tests
             test                    run integration tests
+            benchmark               benchmark the pipeline on synthetic data
+
+        Args for all commands:
+            --trace_file            file to write a JSON trace of stages to
+            --profile_dir           directory to write profiles of stages to
+            --profiler              profiler to use: cprofile or sampling
+            --progress_interval     seconds between progress reports
 
         Args for summarize:
             --raw_data_dir          directory containing raw FDC data
             --summary_dir           directory to write summmary data to
+            --cache_dir             directory to cache parsed raw data in
+            --processes             number of processes to summarize with
+            --sketch_error          also summarize brandOwner, gtinUpc and
+                                    ingredients using sketches with this
+                                    relative error
+            --nutrient_stats        write statistics of nutrient amounts
 
         Args for export_csv
             --raw_data_dir          directory containing raw FDC data
             --export_config_file    file containing export config
             --merged_data_dir       directory to write merged CSV data to
+            --join                  join to merge with: hash or sort_merge
+            --tmp_dir               directory for temporary files
+            --cache_dir             directory to cache parsed raw data in
+            --processes             number of processes to parse files with
+            --compact               store food nutrients as typed arrays
+            --vectorized            compute nutrient columns using NumPy
+            --output_format         csv, or parquet or arrow to write typed
+                                    columns
+
+        Args for export_csv_incremental
+            --raw_data_dir          directory containing raw FDC data
+            --export_config_file    file containing export config
+            --merged_data_dir       directory to write merged CSV data to
+            --state_file            database containing the previous export
+            --delta                 raw data only contains changed foods
+
+        Args for export_jsonl
+            --raw_data_dir          directory containing raw FDC data
+            --merged_data_dir       directory to write merged JSON Lines
+                                    files to
+            --num_shards            number of files to split foods into, at
+                                    most 256
+            --compress              gzip the files
+            --join                  join to merge with: hash or sort_merge
+            --tmp_dir               directory for temporary files
+            --cache_dir             directory to cache parsed raw data in
+            --processes             number of processes to parse files with
+            --compact               store food nutrients as typed arrays
+
+        Args for build_food_store
+            --raw_data_dir          directory containing raw FDC data
+            --store_file            SQLite database to write foods to
+            --join                  join to merge with: hash or sort_merge
+            --tmp_dir               directory for temporary files
+            --cache_dir             directory to cache parsed raw data in
+            --processes             number of processes to parse files with
+            --compact               store food nutrients as typed arrays
+
+        Args for build_search_index
+            --raw_data_dir          directory containing raw FDC data
+            --index_file            file to write the search index to
+            --join                  join to merge with: hash or sort_merge
+            --tmp_dir               directory for temporary files
+            --cache_dir             directory to cache parsed raw data in
+            --processes             number of processes to parse files with
+            --compact               store food nutrients as typed arrays
+
+        Args for search
+            --index_file            search index to query
+            --query                 text to search for
+            --limit                 maximum number of results
+
+        Args for benchmark_search
+            --index_file            search index to query
+            --num_queries           number of queries to run
+            --limit                 maximum number of results of each query
+
+        Args for serve
+            --store_file            food store written by build_food_store
+            --index_file            search index written by
+                                    build_search_index
+            --host                  address to listen on
+            --port                  port to listen on
+
+        Args for benchmark_server
+            --store_file            food store written by build_food_store
+            --index_file            search index written by
+                                    build_search_index
+            --num_requests          number of requests to send
+            --connections           number of concurrent connections
+            --results_file          file to write JSON results to
+
+        Args for evaluate_recipes
+            --raw_data_dir          directory containing raw FDC data
+            --recipes_file          JSON file containing a list of recipes
+            --config_file           JSON config containing massUnits and
+                                    volumeUnits
+            --output_file           file to write JSON Lines of nutrients
+                                    of recipes to
+
+        Args for benchmark_quantities
+            --raw_data_dir          directory containing raw FDC data
+            --config_file           JSON config containing massUnits and
+                                    volumeUnits
+            --num_quantities        number of quantities to parse
+            --results_file          file to write JSON results to
 
         Args for create_test_data:
             --raw_data_dir          directory containing raw FDC data
             --fdc_api_key           API key to call FDC API
             --test_data_dir         directory to write test data to
+            --fdc_ids_file          file listing fdc_ids to sample
+            --processes             number of processes to extract rows with
+            --fdc_api_url           URL of the FDC API
+            --concurrency           maximum number of concurrent API requests
+            --rate_limit            maximum number of API requests per second
 
         Args for test:
             --test_data_dir         directory containing test data
+            --cache_dir             directory to cache parsed raw data in
+            --processes             number of processes to parse files and
+                                    compare foods with
+            --compact               store food nutrients as typed arrays
+
+        Args for benchmark:
+            --benchmark_data_dir    directory to generate synthetic data in
+            --num_foods             number of foods to generate
+            --repeat                number of times to run each stage
+            --stages                comma separated stages to run (default
+                                    all of load,merge,export,summarize)
+            --results_file          file to write JSON results to
+            --baseline_file         results file of an earlier run to
+                                    compare with
         """)
     parser.add_argument('command', help='the command to run')
     parser.add_argument(
@@ -68,29 +205,316 @@ if __name__ == '__main__':
     parser.add_argument(
         '--merged_data_dir',
         help='directory to write merged CSV data to')
+    parser.add_argument(
+        '--join',
+        choices=['hash', 'sort_merge'],
+        default='hash',
+        help='join to merge with: hash or sort_merge')
+    parser.add_argument(
+        '--tmp_dir',
+        help='directory for temporary files')
+    parser.add_argument(
+        '--cache_dir',
+        help='directory to cache parsed raw data in')
+    parser.add_argument(
+        '--processes',
+        type=int,
+        help='number of processes to parse files with')
+    parser.add_argument(
+        '--sketch_error',
+        type=float,
+        help='relative error of sketches for approximate summaries')
+    parser.add_argument(
+        '--nutrient_stats',
+        action='store_true',
+        help='write statistics of nutrient amounts')
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='store food nutrients as typed arrays')
+    parser.add_argument(
+        '--vectorized',
+        action='store_true',
+        help='compute nutrient columns using NumPy')
+    parser.add_argument(
+        '--output_format',
+        choices=['csv', 'parquet', 'arrow'],
+        default='csv',
+        help='format to export to: csv, parquet or arrow')
+    parser.add_argument(
+        '--num_shards',
+        type=int,
+        default=1,
+        help='number of files to split foods into, at most 256')
+    parser.add_argument(
+        '--compress',
+        action='store_true',
+        help='gzip the files')
+    parser.add_argument(
+        '--store_file',
+        help='SQLite database of foods')
+    parser.add_argument(
+        '--index_file',
+        help='search index file')
+    parser.add_argument(
+        '--query',
+        help='text to search for')
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=10,
+        help='maximum number of search results')
+    parser.add_argument(
+        '--num_queries',
+        type=int,
+        default=1000,
+        help='number of search queries to run')
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='address to listen on')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8080,
+        help='port to listen on')
+    parser.add_argument(
+        '--num_requests',
+        type=int,
+        default=20000,
+        help='number of requests to send')
+    parser.add_argument(
+        '--connections',
+        type=int,
+        default=64,
+        help='number of concurrent connections')
+    parser.add_argument(
+        '--recipes_file',
+        help='JSON file containing a list of recipes')
+    parser.add_argument(
+        '--config_file',
+        help='JSON config containing massUnits and volumeUnits')
+    parser.add_argument(
+        '--output_file',
+        help='file to write JSON Lines of nutrients of recipes to')
+    parser.add_argument(
+        '--num_quantities',
+        type=int,
+        default=1000000,
+        help='number of quantities to parse')
+    parser.add_argument(
+        '--state_file',
+        help='database containing the previous export')
+    parser.add_argument(
+        '--delta',
+        action='store_true',
+        help='raw data only contains changed foods')
     parser.add_argument(
         '--fdc_api_key',
         help='API key to call FDC API')
+    parser.add_argument(
+        '--fdc_api_url',
+        default=FDC_API_URL,
+        help='URL of the FDC API')
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='maximum number of concurrent API requests')
+    parser.add_argument(
+        '--rate_limit',
+        type=float,
+        help='maximum number of API requests per second')
+    parser.add_argument(
+        '--fdc_ids_file',
+        help='file listing fdc_ids to sample, one per line')
     parser.add_argument(
         '--test_data_dir',
         help='directory containing test data')
+    parser.add_argument(
+        '--benchmark_data_dir',
+        help='directory to generate synthetic data in')
+    parser.add_argument(
+        '--num_foods',
+        type=int,
+        default=100000,
+        help='number of foods to generate')
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='number of times to run each stage')
+    parser.add_argument(
+        '--stages',
+        default=','.join(STAGES),
+        help='comma separated stages to run')
+    parser.add_argument(
+        '--results_file',
+        help='file to write JSON results to')
+    parser.add_argument(
+        '--baseline_file',
+        help='results file of an earlier run to compare with')
+    parser.add_argument(
+        '--trace_file',
+        help='file to write a JSON trace of stages to')
+    parser.add_argument(
+        '--profile_dir',
+        help='directory to write profiles of stages to')
+    parser.add_argument(
+        '--profiler',
+        choices=['cprofile', 'sampling'],
+        default='cprofile',
+        help='profiler to use: cprofile or sampling')
+    parser.add_argument(
+        '--progress_interval',
+        type=float,
+        help='seconds between progress reports')
     args = parser.parse_args()
-    if args.command == 'summarize':
-        summarize(
-            raw_data_dir=args.raw_data_dir,
-            summary_dir=args.summary_dir)
-    elif args.command == 'export_csv':
-        export_csv(
-            raw_data_dir=args.raw_data_dir,
-            export_config_file=args.export_config_file,
-            merged_data_dir=args.merged_data_dir)
-    elif args.command == 'test':
-        test_case = IntegrationTest(test_data_dir=args.test_data_dir)
-        test_case.test_load_and_merge()
-    elif args.command == 'create_test_data':
-        create_test_data(
-            raw_data_dir=args.raw_data_dir,
-            fdc_api_key=args.fdc_api_key,
-            test_data_dir=args.test_data_dir)
-    else:
-        raise ValueError("Unknown command %s" % args.command)
+    # Stages are only instrumented if one of these options is given.
+    if (args.trace_file is not None or args.profile_dir is not None or
+            args.progress_interval is not None):
+        start_tracing(
+            trace_file=args.trace_file,
+            profile_dir=args.profile_dir,
+            profiler=args.profiler,
+            progress_interval=args.progress_interval or 10.0)
+    try:
+        if args.command == 'summarize':
+            summarize(
+                raw_data_dir=args.raw_data_dir,
+                summary_dir=args.summary_dir,
+                cache_dir=args.cache_dir,
+                processes=args.processes,
+                sketch_error=args.sketch_error,
+                nutrient_stats=args.nutrient_stats)
+        elif args.command == 'export_csv':
+            export_csv(
+                raw_data_dir=args.raw_data_dir,
+                export_config_file=args.export_config_file,
+                merged_data_dir=args.merged_data_dir,
+                join=args.join,
+                tmp_dir=args.tmp_dir,
+                cache_dir=args.cache_dir,
+                processes=args.processes,
+                compact=args.compact,
+                vectorized=args.vectorized,
+                output_format=args.output_format)
+        elif args.command == 'export_csv_incremental':
+            export_csv_incremental(
+                raw_data_dir=args.raw_data_dir,
+                export_config_file=args.export_config_file,
+                merged_data_dir=args.merged_data_dir,
+                state_file=args.state_file,
+                delta=args.delta)
+        elif args.command == 'export_jsonl':
+            export_jsonl(
+                raw_data_dir=args.raw_data_dir,
+                merged_data_dir=args.merged_data_dir,
+                num_shards=args.num_shards,
+                compress=args.compress,
+                join=args.join,
+                tmp_dir=args.tmp_dir,
+                cache_dir=args.cache_dir,
+                processes=args.processes,
+                compact=args.compact)
+        elif args.command == 'build_food_store':
+            build_food_store(
+                raw_data_dir=args.raw_data_dir,
+                store_file=args.store_file,
+                join=args.join,
+                tmp_dir=args.tmp_dir,
+                cache_dir=args.cache_dir,
+                processes=args.processes,
+                compact=args.compact)
+        elif args.command in (
+                'build_search_index', 'search', 'benchmark_search'):
+            # Imported here because this requires NumPy, which is not otherwise
+            # needed.
+            from .search_index import benchmark_search_index
+            from .search_index import build_search_index
+            from .search_index import SearchIndex
+            if args.command == 'build_search_index':
+                build_search_index(
+                    raw_data_dir=args.raw_data_dir,
+                    index_file=args.index_file,
+                    join=args.join,
+                    tmp_dir=args.tmp_dir,
+                    cache_dir=args.cache_dir,
+                    processes=args.processes,
+                    compact=args.compact)
+            elif args.command == 'search':
+                with SearchIndex(args.index_file) as index:
+                    for result in index.search(args.query, limit=args.limit):
+                        print('%d\t%.3f\t%s' % (
+                            result.fdc_id, result.score, result.description))
+            else:
+                benchmark_search_index(
+                    index_file=args.index_file,
+                    num_queries=args.num_queries,
+                    limit=args.limit)
+        elif args.command in ('serve', 'benchmark_server'):
+            # Imported here because this requires NumPy, which is not otherwise
+            # needed.
+            from .server import benchmark_server
+            from .server import serve
+            if args.command == 'serve':
+                serve(
+                    store_file=args.store_file,
+                    index_file=args.index_file,
+                    host=args.host,
+                    port=args.port)
+            else:
+                benchmark_server(
+                    store_file=args.store_file,
+                    index_file=args.index_file,
+                    num_requests=args.num_requests,
+                    concurrency=args.connections,
+                    results_file=args.results_file)
+        elif args.command == 'evaluate_recipes':
+            # Imported here because this requires NumPy, which is not otherwise
+            # needed.
+            from .recipes import evaluate_recipes_file
+            evaluate_recipes_file(
+                recipes_file=args.recipes_file,
+                config_file=args.config_file,
+                raw_data_dir=args.raw_data_dir,
+                output_file=args.output_file)
+        elif args.command == 'benchmark_quantities':
+            # Imported here because this requires NumPy, which is not otherwise
+            # needed.
+            from .bulk_quantities import benchmark_quantities
+            benchmark_quantities(
+                raw_data_dir=args.raw_data_dir,
+                config_file=args.config_file,
+                num_quantities=args.num_quantities,
+                results_file=args.results_file)
+        elif args.command == 'test':
+            test_case = IntegrationTest(
+                test_data_dir=args.test_data_dir, cache_dir=args.cache_dir,
+                processes=args.processes, compact=args.compact)
+            test_case.test_load_and_merge()
+        elif args.command == 'create_test_data':
+            create_test_data(
+                raw_data_dir=args.raw_data_dir,
+                fdc_api_key=args.fdc_api_key,
+                test_data_dir=args.test_data_dir,
+                fdc_ids_file=args.fdc_ids_file,
+                processes=args.processes,
+                fdc_api_url=args.fdc_api_url,
+                concurrency=args.concurrency,
+                rate_limit=args.rate_limit)
+        elif args.command == 'benchmark':
+            regressions = run_benchmarks(
+                data_dir=args.benchmark_data_dir,
+                num_foods=args.num_foods,
+                repeat=args.repeat,
+                stages=args.stages.split(','),
+                results_file=args.results_file,
+                baseline_file=args.baseline_file)
+            if regressions:
+                sys.exit('regressions in stages: %s' % ', '.join(regressions))
+        else:
+            raise ValueError("Unknown command %s" % args.command)
+    finally:
+        # Write the trace and profiles even if the command fails.
+        stop_tracing()
@@ -0,0 +1,337 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for loading, merging, exporting and summarizing raw data.
+
+The benchmarks run on synthetic data with the same schemas as the FDC
+Branded Foods data (see `file_schemas`), which is generated deterministically
+from a seed, so that runs with the same options are comparable.
+
+Each run of a stage is in a fresh process, so that its peak resident set
+size is not affected by other runs.  The time of a stage doesn't include
+preparing its inputs (e.g. loading raw data before merging), but its peak
+resident set size does.  The results are written as JSON, and can be
+compared with the results of an earlier run to catch regressions.
+"""
+import concurrent.futures
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from .export_csv import _export
+from .export_csv import _export_config_from_json
+from .file_schemas import RAW_DATA_FILES
+from .load_raw_data import load_raw_data
+from .merge_sources import merge_sources
+from .merge_sources import MERGE_COLUMNS
+from .summarize import summarize
+
+
+# Version of the results format.
+_RESULTS_VERSION = 1
+
+# Nutrients in the synthetic data, as rows of `nutrient.csv`.  These are the
+# nutrients used by the sample export config.
+_NUTRIENTS = [
+    ('1003', 'Protein', 'G', '203', '600'),
+    ('1004', 'Total lipid (fat)', 'G', '204', '800'),
+    ('1005', 'Carbohydrate, by difference', 'G', '205', '1110'),
+    ('1008', 'Energy', 'KCAL', '208', '300'),
+    ('1079', 'Fiber, total dietary', 'G', '291', '1200'),
+    ('1087', 'Calcium, Ca', 'MG', '301', '5300'),
+    ('1089', 'Iron, Fe', 'MG', '303', '5400'),
+    ('1093', 'Sodium, Na', 'MG', '307', '5800'),
+    ('1104', 'Vitamin A, IU', 'IU', '318', '7500'),
+    ('1162', 'Vitamin C, total ascorbic acid', 'MG', '401', '6300'),
+    ('1253', 'Cholesterol', 'MG', '601', '15700'),
+    ('1257', 'Fatty acids, total trans', 'G', '605', '15400'),
+    ('1258', 'Fatty acids, total saturated', 'G', '606', '9700'),
+    ('1292', 'Fatty acids, total monounsaturated', 'G', '645', '11400'),
+    ('1293', 'Fatty acids, total polyunsaturated', 'G', '646', '12900'),
+    ('2000', 'Sugars, total including NLEA', 'G', '269', '1510'),
+]
+
+_CATEGORIES = [
+    'Candy', 'Cheese', 'Chips, Pretzels & Snacks', 'Cookies & Biscuits',
+    'Frozen Dinners & Entrees', 'Popcorn, Peanuts, Seeds & Related Snacks',
+    'Soda', 'Yogurt',
+]
+
+_INGREDIENTS = [
+    'WATER', 'SUGAR', 'SALT', 'ENRICHED WHEAT FLOUR', 'SOYBEAN OIL',
+    'CORN SYRUP', 'NATURAL FLAVORS', 'CITRIC ACID', 'MILK', 'EGGS',
+]
+
+# The stages that are benchmarked.
+STAGES = ['load', 'merge', 'export', 'summarize']
+
+_EXPORT_CONFIG_FILE = os.path.join(
+    os.path.dirname(__file__), 'sample_export_config.json')
+
+# Name of the file in the data directory recording how it was generated.
+_DATA_CONFIG_FILENAME = 'benchmark_data.json'
+
+
+def _random_date(rng):
+    return '20%02d-%02d-%02d' % (
+        rng.randint(15, 21), rng.randint(1, 12), rng.randint(1, 28))
+
+
+def generate_synthetic_data(data_dir, num_foods, nutrients_per_food=12,
+                            seed=0):
+    """Generate synthetic raw data.
+
+    Rows are generated one food at a time and written to all files together,
+    so memory use doesn't depend on `num_foods`.  If `data_dir` already
+    contains data generated with the same arguments, it is reused.
+
+    Args:
+        data_dir: The directory to write raw data files to.
+        num_foods: The number of branded foods.
+        nutrients_per_food: The average number of nutrients for each food.
+        seed: The seed for the random number generator.
+    """
+    data_config = {
+        'num_foods': num_foods,
+        'nutrients_per_food': nutrients_per_food,
+        'seed': seed,
+    }
+    data_config_file = os.path.join(data_dir, _DATA_CONFIG_FILENAME)
+    if os.path.exists(data_config_file):
+        with open(data_config_file) as f:
+            if json.load(f) == data_config:
+                print('reusing synthetic data in %s' % data_dir)
+                return
+    print('generating synthetic data for %d foods' % num_foods)
+    os.makedirs(data_dir, exist_ok=True)
+    rng = random.Random(seed)
+    files = {}
+    writers = {}
+    for field, (filename, data_cls) in RAW_DATA_FILES.items():
+        files[field] = open(
+            os.path.join(data_dir, filename), 'w', newline='')
+        writers[field] = csv.writer(files[field], quoting=csv.QUOTE_ALL)
+        writers[field].writerow(data_cls._fields)
+    try:
+        writers['nutrients'].writerows(_NUTRIENTS)
+        food_nutrient_id = 1
+        for index in range(num_foods):
+            fdc_id = str(1000000 + index)
+            modified_date = _random_date(rng)
+            ingredients = ', '.join(
+                rng.sample(_INGREDIENTS, rng.randint(1, len(_INGREDIENTS))))
+            writers['branded_foods'].writerow([
+                fdc_id, 'Owner %d' % rng.randint(1, num_foods // 20 + 1),
+                'Brand %d' % rng.randint(1, 1000), '',
+                '%012d' % rng.randrange(10 ** 12), ingredients, '',
+                rng.choice(['28', '30', '240', '1.5', '']),
+                rng.choice(['g', 'ml', '']),
+                rng.choice(['1 cup', '2 PIECES', '']),
+                rng.choice(_CATEGORIES), rng.choice(['LI', 'GDSN']),
+                modified_date, modified_date, 'United States',
+                _random_date(rng) if rng.random() < 0.05 else ''])
+            writers['foods'].writerow([
+                fdc_id, 'branded_food', 'FOOD %s' % fdc_id, '',
+                _random_date(rng)])
+            writers['food_update_log_entries'].writerow(
+                [fdc_id, 'desc', modified_date])
+            writers['food_attributes'].writerow(
+                [str(index + 1), fdc_id, '', '999', 'Added', 'x'])
+            num_nutrients = min(
+                len(_NUTRIENTS), rng.randint(0, 2 * nutrients_per_food))
+            for nutrient in rng.sample(_NUTRIENTS, num_nutrients):
+                writers['food_nutrients'].writerow([
+                    str(food_nutrient_id), fdc_id, nutrient[3],
+                    '%g' % round(rng.expovariate(0.1), 2),
+                    '', '71', '', '', '', '', ''])
+                food_nutrient_id += 1
+    finally:
+        for f in files.values():
+            f.close()
+    with open(data_config_file, 'w') as f:
+        json.dump(data_config, f)
+
+
+def _peak_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _run_stage(stage, data_dir):
+    """Run a stage, returning a pair of the time taken and number of rows.
+
+    Only the stage itself is timed, not loading its inputs.
+    """
+    if stage == 'summarize':
+        with tempfile.TemporaryDirectory() as summary_dir:
+            start_time = time.perf_counter()
+            summarize(data_dir, summary_dir)
+            seconds = time.perf_counter() - start_time
+        raw_data = load_raw_data(data_dir, streaming=True)
+        num_rows = sum(1 for _ in raw_data.branded_foods) + sum(
+            1 for _ in raw_data.food_nutrients)
+        return seconds, num_rows
+
+    start_time = time.perf_counter()
+    raw_data = load_raw_data(data_dir, columns=MERGE_COLUMNS)
+    seconds = time.perf_counter() - start_time
+    if stage == 'load':
+        return seconds, sum(
+            len(rows) for rows in raw_data if rows is not None)
+
+    start_time = time.perf_counter()
+    merged_data = merge_sources(raw_data)
+    seconds = time.perf_counter() - start_time
+    if stage == 'merge':
+        return seconds, len(merged_data)
+
+    del raw_data
+    with open(_EXPORT_CONFIG_FILE) as f:
+        export_config = _export_config_from_json(json.load(f))
+    with tempfile.TemporaryFile('w', newline='') as f:
+        csv_writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        start_time = time.perf_counter()
+        _export(merged_data, export_config, csv_writer)
+        seconds = time.perf_counter() - start_time
+    return seconds, len(merged_data)
+
+
+def _run_stage_in_process(stage, data_dir):
+    # Discard the output of the stage, which would swamp the results.
+    with open(os.devnull, 'w') as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            seconds, num_rows = _run_stage(stage, data_dir)
+        finally:
+            sys.stdout = stdout
+    return seconds, num_rows, _peak_rss_bytes()
+
+
+def _benchmark_stage(stage, data_dir, repeat):
+    runs = []
+    for _ in range(repeat):
+        # A new process for each run, so that peak RSS only covers one run.
+        with concurrent.futures.ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context('spawn')
+                ) as executor:
+            runs.append(executor.submit(
+                _run_stage_in_process, stage, data_dir).result())
+    seconds = [run[0] for run in runs]
+    num_rows = runs[0][1]
+    median_seconds = statistics.median(seconds)
+    return {
+        'seconds': median_seconds,
+        'min_seconds': min(seconds),
+        'max_seconds': max(seconds),
+        'rows': num_rows,
+        'rows_per_second': num_rows / median_seconds,
+        'peak_rss_bytes': max(run[2] for run in runs),
+    }
+
+
+def _compare_results(results, baseline, threshold):
+    """Print a comparison with baseline results.
+
+    Returns:
+        A list of the stages that are slower or use more memory than the
+        baseline by more than `threshold`.
+    """
+    if baseline['config'] != results['config']:
+        print('WARNING: baseline was run with a different config: %s'
+              % baseline['config'])
+    regressions = []
+    for stage, stage_results in results['stages'].items():
+        baseline_results = baseline['stages'].get(stage)
+        if baseline_results is None:
+            continue
+        time_ratio = (
+            stage_results['seconds'] / baseline_results['seconds'])
+        memory_ratio = (
+            stage_results['peak_rss_bytes'] /
+            baseline_results['peak_rss_bytes'])
+        regressed = max(time_ratio, memory_ratio) > 1 + threshold
+        if regressed:
+            regressions.append(stage)
+        print('%-10s time x%.2f, peak RSS x%.2f%s' % (
+            stage, time_ratio, memory_ratio,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def run_benchmarks(data_dir, num_foods=100000, nutrients_per_food=12,
+                   seed=0, repeat=3, stages=None, results_file=None,
+                   baseline_file=None, threshold=0.1):
+    """Run benchmarks on synthetic data.
+
+    Args:
+        data_dir: The directory to generate synthetic data in.
+        num_foods: The number of branded foods to generate.
+        nutrients_per_food: The average number of nutrients for each food.
+        seed: The seed for generating data.
+        repeat: The number of times to run each stage.  The median time is
+            reported.
+        stages: A list of the stages to run, or None for all `STAGES`.
+        results_file: If set, a file to write the results to as JSON.
+        baseline_file: If set, a results file from an earlier run to compare
+            with.
+        threshold: The relative increase in time or peak RSS over the
+            baseline that is reported as a regression.
+
+    Returns:
+        A list of the stages that regressed compared to the baseline.
+    """
+    generate_synthetic_data(data_dir, num_foods, nutrients_per_food, seed)
+    results = {
+        'version': _RESULTS_VERSION,
+        'config': {
+            'num_foods': num_foods,
+            'nutrients_per_food': nutrients_per_food,
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'stages': {},
+    }
+    for stage in stages or STAGES:
+        if stage not in STAGES:
+            raise ValueError('Unknown stage %s' % stage)
+        print('benchmarking stage: %s' % stage)
+        stage_results = _benchmark_stage(stage, data_dir, repeat)
+        results['stages'][stage] = stage_results
+        print('%-10s %8.3fs %12.0f rows/s %8.1f MB peak RSS' % (
+            stage, stage_results['seconds'],
+            stage_results['rows_per_second'],
+            stage_results['peak_rss_bytes'] / 1e6))
+    if results_file is not None:
+        with open(results_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline_file is None:
+        return []
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    return _compare_results(results, baseline, threshold)
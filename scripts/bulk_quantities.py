@@ -0,0 +1,329 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Parsing and conversion of many quantities at once.
+
+`QuantityParser` parses quantity strings, e.g. "2 cups", into amounts and
+canonical units, with the same results as `parse_quantity` followed by
+`canonicalize_quantity`, but for a whole batch of strings.  Ingredient
+quantities repeat a lot, so each distinct string is only parsed once, and
+units are looked up in a table built from the config.  Canonical units are
+represented by integer codes, indexing `QuantityParser.units`.
+
+`food_servings` then computes the serving equivalents of foods (as
+`normalize_fdc_food` does, from servingSize and householdServingFullText)
+and `convert_quantities` converts quantities of foods to servings and grams,
+as arrays over all quantities.
+
+This module requires NumPy.
+"""
+from collections import namedtuple
+import json
+import random
+import time
+
+import numpy as np
+
+from .load_raw_data import load_raw_data
+from .merge_sources import iter_merged_sources
+from .merge_sources import MERGE_COLUMNS
+from .quantities import canonicalize_quantity
+from .quantities import canonicalize_quantity_config_from_json
+from .quantities import parse_quantity
+
+
+# Codes of the canonical units, and of a missing unit.
+GRAMS = 0
+MILLILITERS = 1
+NO_UNIT = -1
+
+# Parsed quantities, as arrays of amounts and unit codes.
+ParsedQuantities = namedtuple('ParsedQuantities', ['amounts', 'units'])
+
+# The serving equivalents of foods, as arrays indexed by food.  A serving is
+# 100 of `serving_units`, and `household_amounts` of `household_units` (if
+# the unit isn't `NO_UNIT`).  `grams_per_serving` is NaN if the weight of a
+# serving isn't known.
+FoodServings = namedtuple(
+    'FoodServings',
+    ['serving_units', 'household_amounts', 'household_units',
+     'grams_per_serving'])
+
+# Quantities converted to servings and grams of foods.  Both are NaN for
+# quantities that can't be converted.
+ConvertedQuantities = namedtuple('ConvertedQuantities', ['servings', 'grams'])
+
+
+class QuantityParser(object):
+    """Parses and canonicalizes quantity strings."""
+
+    def __init__(self, config, max_memo_size=1000000):
+        """Create a parser.
+
+        Args:
+            config: A `CanonicalizeQuantityConfig`.
+            max_memo_size: The maximum number of distinct strings to
+                remember the parsed quantities of between calls of `parse`.
+        """
+        # The names of units, indexed by code.
+        self.units = ['g', 'ml']
+        self._unit_codes = {'g': GRAMS, 'ml': MILLILITERS}
+        # A dict from lower case unit to its canonical unit code and the
+        # amount of the canonical unit in one of it.  As in
+        # `canonicalize_quantity`, mass units take precedence over volume
+        # units, and units with a scale of 0 aren't converted.
+        self._unit_table = {}
+        for unit, scale in config.volume_units.items():
+            if scale:
+                self._unit_table[unit] = (MILLILITERS, scale)
+        for unit, scale in config.mass_units.items():
+            if scale:
+                self._unit_table[unit] = (GRAMS, scale)
+        # The same, for units as written.
+        self._raw_unit_table = {}
+        self._max_memo_size = max_memo_size
+        # A dict from string to its amount and unit code.
+        self._memo = {}
+
+    def unit_code(self, unit):
+        """Return the code of a canonical unit, or `NO_UNIT` for None."""
+        if unit is None:
+            return NO_UNIT
+        code = self._unit_codes.get(unit)
+        if code is None:
+            code = self._unit_codes[unit] = len(self.units)
+            self.units.append(unit)
+        return code
+
+    def _canonical_unit(self, unit):
+        entry = self._raw_unit_table.get(unit)
+        if entry is None:
+            lower_unit = unit.lower()
+            entry = self._unit_table.get(lower_unit)
+            if entry is None:
+                entry = (self.unit_code(lower_unit), 1)
+            self._raw_unit_table[unit] = entry
+        return entry
+
+    def _parse(self, text):
+        amount, unit = parse_quantity(text)
+        code, scale = self._canonical_unit(unit)
+        return amount * scale, code
+
+    def parse(self, texts):
+        """Parse and canonicalize quantities.
+
+        Args:
+            texts: A sequence of strings.
+
+        Returns:
+            A `ParsedQuantities`, with an element for each string.
+        """
+        # The index of each distinct string, in order of first occurrence.
+        distinct = {}
+        inverse = np.fromiter(
+            (distinct.setdefault(text, len(distinct)) for text in texts),
+            dtype=np.int64, count=len(texts))
+        if len(self._memo) + len(distinct) > self._max_memo_size:
+            self._memo.clear()
+        amounts = np.empty(len(distinct))
+        units = np.empty(len(distinct), dtype=np.int32)
+        memo = self._memo
+        for i, text in enumerate(distinct):
+            parsed = memo.get(text)
+            if parsed is None:
+                parsed = memo[text] = self._parse(text)
+            amounts[i], units[i] = parsed
+        return ParsedQuantities(amounts[inverse], units[inverse])
+
+
+def food_servings(parser, items):
+    """Compute the serving equivalents of foods.
+
+    Args:
+        parser: A `QuantityParser`.
+        items: An iterable of merged foods, as produced by `merge_sources`.
+
+    Returns:
+        A `FoodServings`, indexed by the position of each food in `items`.
+    """
+    serving_units = []
+    serving_sizes = []
+    household_texts = []
+    for item in items:
+        serving_units.append(parser.unit_code(item.get('servingSizeUnit')))
+        serving_size = item.get('servingSize')
+        serving_sizes.append(np.nan if serving_size is None else serving_size)
+        household_texts.append(item.get('householdServingFullText'))
+    serving_units = np.array(serving_units, dtype=np.int32)
+    has_household = np.array(
+        [text is not None for text in household_texts], dtype=bool)
+    household = parser.parse(
+        [text for text in household_texts if text is not None])
+    household_amounts = np.full(len(household_texts), np.nan)
+    household_units = np.full(len(household_texts), NO_UNIT, dtype=np.int32)
+    # As in JavaScript, dividing by a serving size of 0 gives infinity or
+    # NaN.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        household_amounts[has_household] = (
+            100.0 * household.amounts /
+            np.array(serving_sizes, dtype=np.float64)[has_household])
+    household_units[has_household] = household.units
+    grams_per_serving = np.where(
+        serving_units == GRAMS, 100.0,
+        np.where(household_units == GRAMS, household_amounts, np.nan))
+    return FoodServings(
+        serving_units=serving_units,
+        household_amounts=household_amounts,
+        household_units=household_units,
+        grams_per_serving=grams_per_serving)
+
+
+def convert_quantities(quantities, food_indices, servings):
+    """Convert quantities of foods to servings and grams.
+
+    A quantity is converted using the first serving equivalent of its food
+    with the same unit, as in `nutrientsForIngredient`.
+
+    Args:
+        quantities: A `ParsedQuantities`.
+        food_indices: An array of the index of the food of each quantity.
+        servings: The `FoodServings` of the foods.
+
+    Returns:
+        A `ConvertedQuantities`.
+    """
+    amounts, units = quantities
+    with np.errstate(divide='ignore', invalid='ignore'):
+        num_servings = np.where(
+            units == servings.serving_units[food_indices],
+            amounts / 100.0,
+            np.where(
+                units == servings.household_units[food_indices],
+                amounts / servings.household_amounts[food_indices],
+                np.nan))
+        grams = num_servings * servings.grams_per_serving[food_indices]
+    return ConvertedQuantities(servings=num_servings, grams=grams)
+
+
+def _sample_quantities(household_texts, config, num_quantities, rng):
+    """Sample ingredient quantities, with a realistic amount of repetition.
+
+    Half are household servings of foods, and half are numbers with units
+    from the config.
+    """
+    units = (list(config.mass_units) + list(config.volume_units) +
+             ['serving', 'piece', 'slice'])
+    numbers = ['', '1', '2', '3', '0.5', '1.5', '1 ½', '¼', '¾', '10', '100']
+    generated = ['%s %s' % (number, unit)
+                 for number in numbers for unit in units]
+    texts = rng.choices(household_texts or generated, k=num_quantities // 2)
+    texts.extend(rng.choices(generated, k=num_quantities - len(texts)))
+    rng.shuffle(texts)
+    return texts
+
+
+def _same_quantity(quantity, amount, unit):
+    return quantity.unit == unit and (
+        quantity.amount == amount or
+        (np.isnan(quantity.amount) and np.isnan(amount)))
+
+
+def benchmark_quantities(raw_data_dir, config_file, num_quantities=1000000,
+                         seed=0, results_file=None):
+    """Measure the throughput of parsing and converting quantities.
+
+    Quantities of foods in `raw_data_dir` are sampled, and parsed and
+    converted in bulk.  A sample is also parsed one at a time with
+    `parse_quantity` and `canonicalize_quantity`, both for comparison and
+    to check that the results are the same.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        config_file: A JSON config containing massUnits and volumeUnits.
+        num_quantities: The number of quantities to parse.
+        seed: The seed used to sample quantities.
+        results_file: If set, a file to write the results to as JSON.
+
+    Returns:
+        A dict of the results, with throughputs in quantities per second.
+    """
+    with open(config_file) as f:
+        config = canonicalize_quantity_config_from_json(json.load(f))
+    raw_data = load_raw_data(
+        raw_data_dir, streaming=True, columns=MERGE_COLUMNS)
+    items = list(iter_merged_sources(raw_data))
+    if not items:
+        raise ValueError('No foods in %s' % raw_data_dir)
+    household_texts = [
+        item['householdServingFullText'] for item in items
+        if item.get('householdServingFullText') is not None]
+    rng = random.Random(seed)
+    texts = _sample_quantities(household_texts, config, num_quantities, rng)
+    food_indices = np.array(
+        [rng.randrange(len(items)) for _ in range(num_quantities)],
+        dtype=np.int64)
+
+    parser = QuantityParser(config)
+    start = time.perf_counter()
+    servings = food_servings(parser, items)
+    servings_time = time.perf_counter() - start
+    start = time.perf_counter()
+    quantities = parser.parse(texts)
+    parse_time = time.perf_counter() - start
+    start = time.perf_counter()
+    parser.parse(texts)
+    memoized_parse_time = time.perf_counter() - start
+    start = time.perf_counter()
+    converted = convert_quantities(quantities, food_indices, servings)
+    convert_time = time.perf_counter() - start
+
+    sample = texts[:100000]
+    start = time.perf_counter()
+    expected = [
+        canonicalize_quantity(parse_quantity(text), config)
+        for text in sample]
+    scalar_time = time.perf_counter() - start
+    for i, quantity in enumerate(expected):
+        if not _same_quantity(
+                quantity, quantities.amounts[i],
+                parser.units[quantities.units[i]]):
+            raise AssertionError('Quantity %r parsed as %r, expected %r' % (
+                sample[i], (quantities.amounts[i],
+                            parser.units[quantities.units[i]]), quantity))
+
+    results = {
+        'quantities': num_quantities,
+        'distinct_quantities': len(set(texts)),
+        'foods': len(items),
+        'food_servings_per_s': len(items) / servings_time,
+        'parse_per_s': num_quantities / parse_time,
+        'memoized_parse_per_s': num_quantities / memoized_parse_time,
+        'scalar_parse_per_s': len(sample) / scalar_time,
+        'convert_per_s': num_quantities / convert_time,
+        'converted_to_grams': int(np.count_nonzero(
+            ~np.isnan(converted.grams))),
+    }
+    print('%d quantities (%d distinct) of %d foods' % (
+        results['quantities'], results['distinct_quantities'],
+        results['foods']))
+    print('serving equivalents: %.0f foods/s' % results['food_servings_per_s'])
+    print('parse: %.0f/s, memoized %.0f/s, one at a time %.0f/s' % (
+        results['parse_per_s'], results['memoized_parse_per_s'],
+        results['scalar_parse_per_s']))
+    print('convert to servings and grams: %.0f/s (%d converted to grams)' % (
+        results['convert_per_s'], results['converted_to_grams']))
+    if results_file is not None:
+        with open(results_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
@@ -0,0 +1,114 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export merged data to Parquet or Arrow IPC format.
+
+The columns are those of an export config, as for `export_csv`, but each
+column has a type instead of being formatted as a string: nutrient columns
+and servingSize are float64, fdcId is int64, dates are timestamps and other
+fields are strings.  Missing values are null.  The `floatFormat` and
+`dateFormat` of the config are not used.
+
+Merged foods are converted in batches, and each batch is written as a
+record batch (a row group in Parquet), so consumers can read a subset of
+columns or rows without parsing the whole file.
+
+This module requires PyArrow.
+"""
+import itertools
+
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet
+
+from .dates import parse_api_date
+from .export_csv import _column_layout
+from .export_csv import _DATE_FIELDS
+from .export_csv import _fill_row
+from .export_csv import _FLOAT_FIELDS
+from .export_csv import NutrientColumn
+from .instrumentation import count_rows
+
+
+# Number of foods in each record batch.
+_BATCH_SIZE = 65536
+
+_INT_FIELDS = ['fdcId']
+# Dates that are exported as timestamps.  discontinuedDate isn't formatted
+# by `export_csv`, but is a date in the same format as the others.
+_TIMESTAMP_FIELDS = _DATE_FIELDS + ['discontinuedDate']
+
+
+def _column_type(column):
+    """Return the Arrow type of a column."""
+    if isinstance(column, NutrientColumn):
+        return pa.float64()
+    if column.field in _INT_FIELDS:
+        return pa.int64()
+    if column.field in _FLOAT_FIELDS:
+        return pa.float64()
+    if column.field in _TIMESTAMP_FIELDS:
+        return pa.timestamp('s')
+    return pa.string()
+
+
+def _field_converter(field):
+    """Return the function to convert values of a merged field, or None."""
+    return parse_api_date if field in _TIMESTAMP_FIELDS else None
+
+
+class _RecordBatchBuilder(object):
+    """Converts merged foods to record batches of an export config."""
+
+    def __init__(self, columns):
+        self._layout = _column_layout(columns, _field_converter)
+        self.schema = pa.schema([
+            pa.field(column.name, _column_type(column))
+            for column in columns])
+
+    def record_batch(self, batch):
+        """Convert a list of merged foods to a `pyarrow.RecordBatch`."""
+        rows = [
+            _fill_row([None] * len(self.schema), item, self._layout, float)
+            for item in batch]
+        return pa.RecordBatch.from_arrays(
+            [pa.array(column_values, type=field.type)
+             for column_values, field in zip(zip(*rows), self.schema)],
+            schema=self.schema)
+
+
+def export_columnar(merged_data, export_config, filename, output_format):
+    """Export merged data to a Parquet or Arrow IPC file.
+
+    Args:
+        merged_data: An iterable of dictionaries of JSON format data.  This
+            is iterated over once, so it may be a generator.
+        export_config: An `ExportConfig`.
+        filename: The file to write.
+        output_format: 'parquet' or 'arrow'.
+    """
+    print('writing merged data to %s file' % output_format)
+    builder = _RecordBatchBuilder(export_config.columns)
+    if output_format == 'parquet':
+        writer = pa.parquet.ParquetWriter(filename, builder.schema)
+    elif output_format == 'arrow':
+        writer = pa.ipc.new_file(filename, builder.schema)
+    else:
+        raise ValueError('Unknown output format %s' % output_format)
+    with writer:
+        merged_data = iter(count_rows(merged_data, 'export'))
+        while True:
+            batch = list(itertools.islice(merged_data, _BATCH_SIZE))
+            if not batch:
+                break
+            writer.write_batch(builder.record_batch(batch))
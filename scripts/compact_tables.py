@@ -0,0 +1,196 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compact in-memory representations of large data files.
+
+`food_nutrient.csv` has tens of millions of rows, and representing each as
+a `FoodNutrient` namedtuple of 11 strings uses most of the memory needed to
+load the raw data.  `CompactFoodNutrients` instead stores only the columns
+used by `merge_sources`, as typed parallel arrays.
+"""
+from array import array
+from collections.abc import Sequence
+
+from .file_schemas import FoodNutrient
+from .file_schemas import projected_schema
+
+
+# Columns of `FoodNutrient` that are stored.  All other columns are
+# represented by the empty string.
+COMPACT_FOOD_NUTRIENT_FIELDS = ['id', 'fdc_id', 'nutrient_id', 'amount']
+
+
+def _parse_int(value, field):
+    """Parse an int, raising ValueError if it won't print as `value`."""
+    int_value = int(value)
+    if str(int_value) != value:
+        raise ValueError(
+            'Cannot store %s=%r compactly, because it is not an integer in '
+            'canonical form' % (field, value))
+    return int_value
+
+
+class _FoodNutrientGroups(object):
+    """The rows of a `CompactFoodNutrients` grouped by fdc_id.
+
+    This can be used in place of a `defaultdict(list)` mapping fdc_id to
+    `FoodNutrient`s.  Rows are only created when a group is looked up.
+    """
+
+    def __init__(self, food_nutrients, ranges):
+        self._food_nutrients = food_nutrients
+        self._ranges = ranges
+
+    def __getitem__(self, fdc_id):
+        start, end = self._ranges.get(int(fdc_id), (0, 0))
+        return self._food_nutrients[start:end]
+
+
+class CompactFoodNutrients(Sequence):
+    """The rows of `food_nutrient.csv`, stored as typed parallel arrays.
+
+    The id, fdc_id and nutrient_id columns are stored as 32 bit ints and
+    the amount column as a 64 bit float.  This is a sequence of
+    `FoodNutrient`s, which are created as they are accessed, so that it
+    can be used in place of a list of `FoodNutrient`s.  In these, the
+    stored columns are formatted as strings (amounts are formatted with
+    `repr`, which converts back to the same float but may not be the
+    original string), and all other columns are empty strings.
+
+    If `column_types` is set, rows are instead projected to those columns
+    (which must be a subset of `COMPACT_FOOD_NUTRIENT_FIELDS`) and have
+    values of those types, as for `load_raw_data(..., columns=...)`.
+    """
+
+    def __init__(self, ids, fdc_ids, nutrient_ids, amounts,
+                 column_types=None):
+        self.ids = ids
+        self.fdc_ids = fdc_ids
+        self.nutrient_ids = nutrient_ids
+        self.amounts = amounts
+        self.column_types = column_types
+        if column_types is not None:
+            for field in column_types:
+                if field not in COMPACT_FOOD_NUTRIENT_FIELDS:
+                    raise ValueError(
+                        'Field %s is not stored compactly' % field)
+            self._row_cls = projected_schema(
+                FoodNutrient, tuple(column_types))
+
+    def _columns(self):
+        """Return a list of (array, type) pairs for the projected columns."""
+        if self.column_types is None:
+            return None
+        arrays = {
+            'id': self.ids,
+            'fdc_id': self.fdc_ids,
+            'nutrient_id': self.nutrient_ids,
+            'amount': self.amounts,
+        }
+        return [
+            (arrays[field], column_type)
+            for field, column_type in self.column_types.items()]
+
+    @classmethod
+    def from_rows(cls, rows, column_types=None):
+        """Create from an iterable of `FoodNutrient`s.
+
+        Args:
+            rows: An iterable of `FoodNutrient`s with string values.
+            column_types: If set, a dict of the columns to keep and their
+                types (see `file_schemas.row_converter`).
+        """
+        result = cls(array('i'), array('i'), array('i'), array('d'),
+                     column_types)
+        for row in rows:
+            result.ids.append(_parse_int(row.id, 'id'))
+            result.fdc_ids.append(_parse_int(row.fdc_id, 'fdc_id'))
+            result.nutrient_ids.append(
+                _parse_int(row.nutrient_id, 'nutrient_id'))
+            result.amounts.append(float(row.amount))
+        return result
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _row(self, index, columns=None):
+        if columns is not None:
+            return self._row_cls._make(
+                (repr if values.typecode == 'd' else str)(values[index])
+                if column_type is str else column_type(values[index])
+                for values, column_type in columns)
+        return FoodNutrient(
+            id=str(self.ids[index]),
+            fdc_id=str(self.fdc_ids[index]),
+            nutrient_id=str(self.nutrient_ids[index]),
+            amount=repr(self.amounts[index]),
+            data_points='',
+            derivation_id='',
+            min='',
+            max='',
+            median='',
+            footnote='',
+            min_year_acquired='')
+
+    def __getitem__(self, index):
+        columns = self._columns()
+        if isinstance(index, slice):
+            return [
+                self._row(i, columns)
+                for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('row index out of range')
+        return self._row(index, columns)
+
+    def __iter__(self):
+        columns = self._columns()
+        return (self._row(i, columns) for i in range(len(self)))
+
+    def _is_sorted_by_fdc_id(self):
+        fdc_ids = self.fdc_ids
+        return all(
+            fdc_ids[i] <= fdc_ids[i + 1] for i in range(len(fdc_ids) - 1))
+
+    def sort_by_fdc_id(self):
+        """Stable sort the rows by fdc_id, in place."""
+        if self._is_sorted_by_fdc_id():
+            return
+        order = sorted(range(len(self)), key=self.fdc_ids.__getitem__)
+        for name in ['ids', 'fdc_ids', 'nutrient_ids', 'amounts']:
+            values = getattr(self, name)
+            setattr(self, name, array(
+                values.typecode, map(values.__getitem__, order)))
+
+    def grouped_by_fdc_id(self):
+        """Group the rows by fdc_id.
+
+        This sorts the rows by fdc_id (which for the FDC data is usually a
+        no-op), so that each group is a contiguous range of rows, and only a
+        start and end index needs to be stored for each fdc_id.
+
+        Returns:
+            An object which, when indexed by an fdc_id (as a string or int)
+            returns a list of the `FoodNutrient`s with that fdc_id, in their
+            original order.
+        """
+        self.sort_by_fdc_id()
+        ranges = {}
+        start = 0
+        fdc_ids = self.fdc_ids
+        for end in range(1, len(fdc_ids) + 1):
+            if end == len(fdc_ids) or fdc_ids[end] != fdc_ids[start]:
+                ranges[fdc_ids[start]] = (start, end)
+                start = end
+        return _FoodNutrientGroups(self, ranges)
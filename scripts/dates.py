@@ -0,0 +1,53 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Functions to convert between date formats.
+
+Dates are converted several times for every branded food, but there are
+only a few thousand distinct dates in the data, so parsing each one with
+`strptime` dominates the time to merge and export.  The conversions here
+are memoized with a bounded cache, so each distinct date is only parsed
+once.
+"""
+from datetime import datetime
+import functools
+
+
+# Maximum number of distinct dates to cache for each conversion.
+_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def file_date_to_api_date(d):
+    """Convert from file format to API format.
+
+    For example '2019-04-01' is converted to '4/1/2019'.  Empty dates are
+    converted to None.
+    """
+    if not d:
+        return None
+    dt = datetime.strptime(d, '%Y-%m-%d')
+    return '%d/%d/%d' % (dt.month, dt.day, dt.year)
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def format_api_date(d, date_format):
+    """Convert a date from API format to `date_format`."""
+    dt = datetime.strptime(d, '%m/%d/%Y')
+    return dt.strftime(date_format)
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def parse_api_date(d):
+    """Convert a date from API format to a `datetime`."""
+    return datetime.strptime(d, '%m/%d/%Y')
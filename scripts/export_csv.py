@@ -25,12 +25,16 @@ converted to 0.05.
 """
 from collections import namedtuple
 import csv
-from datetime import datetime
 import json
 import os
 
+from .dates import format_api_date
+from .instrumentation import count_rows
+from .instrumentation import traced_stage
 from .load_raw_data import load_raw_data
-from .merge_sources import merge_sources
+from .merge_join import iter_merge_joined_sources
+from .merge_sources import iter_merged_sources
+from .merge_sources import MERGE_COLUMNS
 
 
 # A mapping from JSON format to a column
@@ -44,14 +48,22 @@ NutrientColumn = namedtuple(
     'NutrientColumn',
     ['name', 'nutrient_id', 'scale'])
 
+# `extract_row` is a function that takes a merged food and returns the
+# values of its CSV row (see `_compile_row_extractor`).
 ExportConfig = namedtuple(
     'ExportConfig',
-    ['columns', 'float_format', 'date_format'])
+    ['columns', 'float_format', 'date_format', 'extract_row'])
 
 
+# The formats written by `columnar_export`.
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+
 _FLOAT_FIELDS = ['servingSize']
 _DATE_FIELDS = ['modifiedDate', 'availableDate', 'publicationDate']
 
+# Marker for a field that is missing from a merged food.
+_MISSING = object()
+
 
 def _column_config_from_json(obj):
     if 'field' in obj:
@@ -60,70 +72,214 @@ def _column_config_from_json(obj):
         return NutrientColumn(**obj)
 
 
+# The positions of the columns of an export config in a row (see
+# `_column_layout`).  `field_getters` is a tuple of (position, field,
+# conversion function) for each field column, where the conversion function
+# may be None.  `nutrient_positions` is a dict from nutrient id to a list of
+# (position, scale) for each nutrient column with that id.
+_ColumnLayout = namedtuple(
+    '_ColumnLayout', ['field_getters', 'nutrient_positions'])
+
+
+def _column_layout(columns, field_converter):
+    """Resolve the position and conversion of each column once.
+
+    Nutrient columns are looked up by nutrient id to find their positions in
+    the row, so each food's nutrients only need to be iterated over once.
+
+    Args:
+        columns: A list of `FieldColumn`s and `NutrientColumn`s.
+        field_converter: A function that takes the name of a field and
+            returns the function to convert its values with, or None to
+            use them unchanged.
+
+    Returns:
+        A `_ColumnLayout`.
+    """
+    field_getters = []
+    nutrient_positions = {}
+    for position, column in enumerate(columns):
+        if isinstance(column, FieldColumn):
+            field_getters.append(
+                (position, column.field, field_converter(column.field)))
+        elif isinstance(column, NutrientColumn):
+            nutrient_positions.setdefault(column.nutrient_id, []).append(
+                (position, column.scale))
+        else:
+            assert False, 'bad type for column'
+    return _ColumnLayout(tuple(field_getters), nutrient_positions)
+
+
+def _fill_row(row, item, layout, convert_amount):
+    """Set the values of the columns of a merged food in a row.
+
+    Columns for fields and nutrients that the food doesn't have are left
+    unchanged.
+
+    Args:
+        row: A list with an element for each column.
+        item: A merged food.
+        layout: A `_ColumnLayout`.
+        convert_amount: A function to convert each scaled nutrient amount
+            with.
+
+    Returns:
+        `row`.
+    """
+    get = item.get
+    for position, field, convert in layout.field_getters:
+        value = get(field, _MISSING)
+        if value is not _MISSING:
+            row[position] = value if convert is None else convert(value)
+    nutrient_positions = layout.nutrient_positions
+    if not nutrient_positions:
+        return row
+    # If a nutrient appears more than once, the last amount is used.
+    for nutrient in item['foodNutrients']:
+        positions = nutrient_positions.get(nutrient['nutrient']['id'])
+        if positions is not None:
+            amount = nutrient['amount']
+            for position, scale in positions:
+                row[position] = convert_amount(amount * scale)
+    return row
+
+
+def _compile_row_extractor(columns, float_format, date_format):
+    """Create a function that extracts the values of a CSV row.
+
+    The type of each column, and the formatting it needs, is resolved once
+    here rather than for every cell.
+
+    Args:
+        columns: A list of `FieldColumn`s and `NutrientColumn`s.
+        float_format: The format string for numeric values.
+        date_format: The format string for dates.
+
+    Returns:
+        A function that takes a merged food and returns a list of the values
+        of each column.  Missing values are the empty string.
+    """
+    def format_date(value):
+        return format_api_date(value, date_format)
+
+    def field_formatter(field):
+        if field in _FLOAT_FIELDS:
+            return float_format.__mod__
+        if field in _DATE_FIELDS:
+            return format_date
+        return None
+
+    layout = _column_layout(columns, field_formatter)
+    format_amount = float_format.__mod__
+    num_columns = len(columns)
+
+    def extract_row(item):
+        return _fill_row([''] * num_columns, item, layout, format_amount)
+    return extract_row
+
+
 def _export_config_from_json(obj):
+    columns = list(map(_column_config_from_json, obj['columns']))
     return ExportConfig(
-        columns=list(map(_column_config_from_json, obj['columns'])),
+        columns=columns,
         float_format=obj['floatFormat'],
-        date_format=obj['dateFormat'])
-
-
-def _extract_column_value(column, item, nutrients_by_id, float_format,
-                          date_format):
-    if isinstance(column, FieldColumn):
-        try:
-            value = item[column.field]
-        except KeyError:
-            # Always write empty string for missing fields
-            return ''
-        if column.field in _FLOAT_FIELDS:
-            return float_format % value
-        elif column.field in _DATE_FIELDS:
-            dt = datetime.strptime(value, '%m/%d/%Y')
-            return dt.strftime(date_format)
-        else:
-            # String field.
-            return value
-    elif isinstance(column, NutrientColumn):
-        try:
-            scaled_value = nutrients_by_id[column.nutrient_id] * column.scale
-        except KeyError:
-            return ''
-        return float_format % scaled_value
-    else:
-        assert False, 'bad type for column'
+        date_format=obj['dateFormat'],
+        extract_row=_compile_row_extractor(
+            columns, obj['floatFormat'], obj['dateFormat']))
 
 
 def _export(merged_data, export_config, csv_writer):
     """Export merged data to CSV format.
 
     Args:
-        merged_data: A list of dictionaries of JSON format data.
+        merged_data: An iterable of dictionaries of JSON format data.  This
+            is iterated over once, so it may be a generator.
         column_mappings: A list of `ColumnMapping`s.  Columns will be written
             in this order.
     """
     print('writing merged data to CSV file')
     columns = export_config.columns
     csv_writer.writerow(column.name for column in columns)
-    for item in merged_data:
-        nutrients_by_name = {
-            nutrient['nutrient']['id']: nutrient['amount']
-            for nutrient in item['foodNutrients']}
-        csv_writer.writerow(
-            _extract_column_value(
-                column,
-                item,
-                nutrients_by_name,
-                float_format=export_config.float_format,
-                date_format=export_config.date_format)
-            for column in columns)
-
-
-def export_csv(raw_data_dir, export_config_file, merged_data_dir):
+    for item in count_rows(merged_data, 'export'):
+        csv_writer.writerow(export_config.extract_row(item))
+
+
+def check_join(join):
+    """Raise a ValueError if `join` is not a join of `iter_merged_data`."""
+    if join not in ('hash', 'sort_merge'):
+        raise ValueError('Unknown join %s' % join)
+
+
+def iter_merged_data(raw_data_dir, join='hash', tmp_dir=None, cache_dir=None,
+                     processes=None, compact=False):
+    """Load raw data and return an iterator over the merged foods.
+
+    Rows are streamed from the raw CSV files through the merge.  With the
+    hash join the food nutrients are still held in memory, grouped by
+    fdc_id; only the sort-merge join keeps memory bounded independently of
+    the dataset size.  The arguments are as for `export_csv`.
+
+    Returns:
+        An iterator of JSON-like objects, as for `iter_merged_sources`.
+    """
+    check_join(join)
+    raw_data = load_raw_data(
+        raw_data_dir, streaming=True, cache_dir=cache_dir,
+        processes=processes, compact=compact, columns=MERGE_COLUMNS)
+    if join == 'hash':
+        return iter_merged_sources(raw_data)
+    return iter_merge_joined_sources(raw_data, tmp_dir=tmp_dir)
+
+
+def export_csv(raw_data_dir, export_config_file, merged_data_dir,
+               join='hash', tmp_dir=None, cache_dir=None, processes=None,
+               compact=False, vectorized=False, output_format='csv'):
+    """Export raw data to merged CSV format.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        export_config_file: A JSON file containing an `ExportConfig`.
+        merged_data_dir: The directory to write merged.csv to.
+        join: 'hash' to merge using in-memory lookup tables, which hold
+            every food nutrient, or 'sort_merge' to use a sort-merge join by
+            fdc_id, whose memory doesn't grow with the dataset but which
+            writes foods in order of fdc_id.
+        tmp_dir: The directory for temporary files used by the sort-merge
+            join, or None to use the system default.
+        cache_dir: If set, a directory used to cache parsed raw data.
+        processes: The number of processes to parse files with.
+        compact: If True, store food nutrients as typed arrays.
+        vectorized: If True, compute nutrient columns in batches using NumPy
+            (see `vectorized_export`).  The output is the same.
+        output_format: 'csv' to write merged.csv, or 'parquet' or 'arrow'
+            to write the same columns with types to merged.parquet or
+            merged.arrow (see `columnar_export`).
+    """
     with open(export_config_file) as f:
         export_config = _export_config_from_json(json.load(f))
-    raw_data = load_raw_data(raw_data_dir)
-    merged_data = merge_sources(raw_data)
-    merged_data_csv_file = os.path.join(merged_data_dir, 'merged.csv')
-    with open(merged_data_csv_file, 'w', newline='') as f:
-        csv_writer = csv.writer(f,  quoting=csv.QUOTE_ALL)
-        _export(merged_data, export_config, csv_writer)
+    check_join(join)
+    if output_format not in ('csv',) + COLUMNAR_FORMATS:
+        raise ValueError('Unknown output format %s' % output_format)
+    with traced_stage('export_csv'):
+        merged_data = iter_merged_data(
+            raw_data_dir, join=join, tmp_dir=tmp_dir, cache_dir=cache_dir,
+            processes=processes, compact=compact)
+        if output_format in COLUMNAR_FORMATS:
+            # Imported here because this requires PyArrow, which is not
+            # otherwise needed.
+            from .columnar_export import export_columnar
+            export_columnar(
+                merged_data, export_config,
+                os.path.join(merged_data_dir, 'merged.' + output_format),
+                output_format)
+            return
+        merged_data_csv_file = os.path.join(merged_data_dir, 'merged.csv')
+        with open(merged_data_csv_file, 'w', newline='') as f:
+            csv_writer = csv.writer(f,  quoting=csv.QUOTE_ALL)
+            if vectorized:
+                # Imported here because this requires NumPy, which is not
+                # otherwise needed.
+                from .vectorized_export import export_vectorized
+                export_vectorized(merged_data, export_config, csv_writer)
+            else:
+                _export(merged_data, export_config, csv_writer)
@@ -0,0 +1,194 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Functions to export merged data to JSON Lines format.
+
+Each merged food is written, in the same format as the FoodDataCentral API,
+as a single line of JSON.  Foods are split into shards by fdc_id, so a food
+is always in the same shard, and within a shard foods are in the order they
+are merged.
+
+The output is byte for byte stable: it only depends on the raw data and the
+arguments.  Keys are written in the order they are merged, with fixed
+separators, and gzip headers have no timestamp or file name.
+
+Foods are serialized in the main process.  Encoded lines are buffered for
+each shard and handed to a writer thread for that shard, which compresses
+and writes them, so that compression and I/O overlap with merging and with
+each other.  Each shard is written to a temporary file, and the files are
+only renamed once every shard is complete.
+"""
+import concurrent.futures
+import json
+import os
+import zlib
+
+from .export_csv import check_join
+from .export_csv import iter_merged_data
+from .instrumentation import count_rows
+from .instrumentation import traced_stage
+
+
+# Size of the buffer of encoded lines for each shard, in bytes.
+_BUFFER_SIZE = 1 << 20
+# Maximum number of shards.  Each shard has a thread and an open file while
+# it is written.
+MAX_SHARDS = 256
+# Compression level for gzip files.
+_COMPRESS_LEVEL = 6
+
+# A gzip member header with no file name, no timestamp (MTIME 0), and
+# "unknown" OS, so that the output doesn't depend on when or where it was
+# written.
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def shard_filename(shard, num_shards, compress):
+    """Return the name of a shard file, e.g. merged-00000-of-00004.jsonl."""
+    return 'merged-%05d-of-%05d.jsonl%s' % (
+        shard, num_shards, '.gz' if compress else '')
+
+
+class _ShardWriter(object):
+    """Writes the lines of a shard on a thread of its own.
+
+    At most one buffer is being written at a time, so there are at most two
+    buffers of lines per shard in memory.
+    """
+
+    def __init__(self, filename, compress):
+        self._filename = filename
+        self._tmp_filename = filename + '.tmp'
+        self._file = open(self._tmp_filename, 'wb')
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._pending = None
+        self._lines = []
+        self._size = 0
+        if compress:
+            # Write a raw deflate stream with our own header and trailer,
+            # because `gzip.GzipFile` can't write a header without an
+            # (empty) file name.
+            self._compressor = zlib.compressobj(
+                _COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self._crc = 0
+            self._length = 0
+            self._file.write(_GZIP_HEADER)
+        else:
+            self._compressor = None
+
+    def write(self, line):
+        self._lines.append(line)
+        self._size += len(line)
+        if self._size >= _BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        data = b''.join(self._lines)
+        self._lines = []
+        self._size = 0
+        self._wait()
+        self._pending = self._executor.submit(self._write_data, data)
+
+    def _wait(self):
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def _write_data(self, data):
+        if self._compressor is not None:
+            self._crc = zlib.crc32(data, self._crc)
+            self._length += len(data)
+            data = self._compressor.compress(data)
+        self._file.write(data)
+
+    def finish(self):
+        """Write the remaining lines and close the temporary file."""
+        self._flush()
+        self._wait()
+        self._executor.shutdown()
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+            self._file.write(self._crc.to_bytes(4, 'little'))
+            self._file.write((self._length & 0xffffffff).to_bytes(4, 'little'))
+        self._file.close()
+
+    def rename(self):
+        """Rename the temporary file, once `finish` has been called."""
+        os.replace(self._tmp_filename, self._filename)
+
+    def abort(self):
+        """Stop writing and remove the temporary file.
+
+        This can be called at any time, including after `finish` fails.
+        """
+        self._executor.shutdown()
+        self._file.close()
+        if os.path.exists(self._tmp_filename):
+            os.remove(self._tmp_filename)
+
+
+def _export(merged_data, writers):
+    """Write merged foods to shards.
+
+    Args:
+        merged_data: An iterable of merged foods.
+        writers: A `_ShardWriter` for each shard.
+    """
+    print('writing merged data to JSON Lines files')
+    # The C encoder is used when, as here, there is no indentation.
+    # `check_circular` is turned off because merged foods are trees.
+    encode = json.JSONEncoder(
+        ensure_ascii=False, check_circular=False,
+        separators=(',', ':')).encode
+    num_shards = len(writers)
+    for item in count_rows(merged_data, 'export'):
+        line = (encode(item) + '\n').encode('utf8')
+        writers[item['fdcId'] % num_shards].write(line)
+
+
+def export_jsonl(raw_data_dir, merged_data_dir, num_shards=1, compress=False,
+                 join='hash', tmp_dir=None, cache_dir=None, processes=None,
+                 compact=False):
+    """Export raw data to merged JSON Lines format.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        merged_data_dir: The directory to write shards to.
+        num_shards: The number of files to split foods into by fdc_id.
+        compress: If True, gzip each shard.
+        join, tmp_dir, cache_dir, processes, compact: As for `export_csv`.
+    """
+    if not 1 <= num_shards <= MAX_SHARDS:
+        raise ValueError('num_shards must be between 1 and %d' % MAX_SHARDS)
+    check_join(join)
+    with traced_stage('export_jsonl'):
+        merged_data = iter_merged_data(
+            raw_data_dir, join=join, tmp_dir=tmp_dir, cache_dir=cache_dir,
+            processes=processes, compact=compact)
+        writers = []
+        try:
+            for shard in range(num_shards):
+                writers.append(_ShardWriter(
+                    os.path.join(
+                        merged_data_dir,
+                        shard_filename(shard, num_shards, compress)),
+                    compress))
+            _export(merged_data, writers)
+            for writer in writers:
+                writer.finish()
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+        for writer in writers:
+            writer.rename()
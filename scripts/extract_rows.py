@@ -0,0 +1,126 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Functions to extract the rows for a set of foods from raw data files.
+
+Rows are selected by the value of a single key column (e.g. fdc_id), which
+is the only column that is parsed.  Each file is split into byte ranges
+which are read in one go and filtered in parallel, and all files are
+processed together.  Selected rows are copied byte for byte.
+"""
+import concurrent.futures
+import functools
+import os
+
+from .parallel_csv import _RANGES_PER_PROCESS
+from .parallel_csv import check_header
+from .parallel_csv import split_into_ranges
+
+
+def _column_value(line, column):
+    """Return the value of a column from the first line of a row.
+
+    This assumes that the columns before `column` don't contain commas,
+    which is true of the id columns of the raw data files.
+    """
+    fields = line.split(b',', column + 1)
+    if len(fields) <= column:
+        return None
+    return fields[column].strip().strip(b'"')
+
+
+def _extract_range(filename, column, keys, byte_range):
+    """Return the rows in a byte range whose key column is in `keys`.
+
+    Args:
+        filename: The name of a CSV file.
+        column: The index of the key column.
+        keys: A set of the keys to select, as bytes.
+        byte_range: A pair (start, end) of offsets of the starts of rows.
+
+    Returns:
+        The bytes of the selected rows.
+    """
+    start, end = byte_range
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.split(b'\n')
+    # The last element is empty if the range ends with a newline.
+    last_line = lines.pop()
+    selected = []
+    in_quotes = False
+    keep = False
+    for line in lines:
+        # A line only starts a row if it isn't inside a quoted value.
+        if not in_quotes:
+            keep = _column_value(line, column) in keys
+        if keep:
+            selected.append(line)
+            selected.append(b'\n')
+        if line.count(b'"') % 2:
+            in_quotes = not in_quotes
+    if last_line and (keep if in_quotes else
+                      _column_value(last_line, column) in keys):
+        selected.append(last_line)
+    return b''.join(selected)
+
+
+def extract_rows(input_dir, output_dir, files, keys, processes=None):
+    """Copy the rows with given keys from CSV files.
+
+    Args:
+        input_dir: The directory to read files from.
+        output_dir: The directory to write files to.
+        files: A list of (filename, data_cls, key_field) tuples, where
+            `data_cls` is the namedtuple for the file and `key_field` is the
+            name of the column to select rows by, or None to copy the whole
+            file.
+        keys: An iterable of the keys (strings) of rows to copy.
+        processes: The number of processes to use, or None to use one per
+            CPU.
+    """
+    keys = frozenset(key.encode('utf8') for key in keys)
+    processes = processes or os.cpu_count()
+    # A list of (filename, header_end, futures) for each file, where
+    # `futures` is None if the whole file is copied.
+    outputs = []
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for filename, data_cls, key_field in files:
+            input_filename = os.path.join(input_dir, filename)
+            header_end, ranges = split_into_ranges(
+                input_filename, processes * _RANGES_PER_PROCESS, executor)
+            check_header(input_filename, header_end, data_cls)
+            if key_field is None:
+                outputs.append((filename, header_end, None))
+                continue
+            extract = functools.partial(
+                _extract_range,
+                input_filename,
+                data_cls._fields.index(key_field),
+                keys)
+            outputs.append((
+                filename,
+                header_end,
+                [executor.submit(extract, byte_range)
+                 for byte_range in ranges]))
+        for filename, header_end, futures in outputs:
+            print('Creating test data file: %s' % filename)
+            with open(os.path.join(input_dir, filename), 'rb') as fin:
+                with open(os.path.join(output_dir, filename), 'wb') as fout:
+                    if futures is None:
+                        fout.write(fin.read())
+                        continue
+                    fout.write(fin.read(header_end))
+                    for future in futures:
+                        fout.write(future.result())
@@ -0,0 +1,179 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Functions to download foods from the FoodDataCentral API.
+
+Foods are downloaded concurrently by a pool of threads, each of which keeps
+a persistent connection to the server.  Requests are rate limited across all
+threads, and failed requests (connection errors, 429 and 5xx responses) are
+retried with exponential backoff.  Each food is written to
+`<fdc_id>.json` only once it has been downloaded completely, so an
+interrupted download can be resumed by skipping the files that exist.
+"""
+import concurrent.futures
+import http.client
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+
+# URL for FoodDataCentral API.
+FDC_API_URL = 'https://api.nal.usda.gov/fdc/v1/'
+
+# Status codes of responses that are retried.
+_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class _RateLimiter(object):
+    """Limits the rate of calls to `wait` across threads."""
+
+    def __init__(self, rate):
+        # The minimum time between calls, in seconds.
+        self._interval = 1.0 / rate if rate else 0.0
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class _Downloader(object):
+    """Downloads foods using a connection per thread."""
+
+    def __init__(self, base_url, api_key, rate_limit, max_retries, backoff):
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme == 'https':
+            self._connection_cls = http.client.HTTPSConnection
+        elif url.scheme == 'http':
+            self._connection_cls = http.client.HTTPConnection
+        else:
+            raise ValueError('Unsupported URL %s' % base_url)
+        self._netloc = url.netloc
+        self._path = url.path if url.path.endswith('/') else url.path + '/'
+        self._api_key = api_key
+        self._rate_limiter = _RateLimiter(rate_limit)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connection_cls(
+                self._netloc, timeout=60)
+        return connection
+
+    def _close_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def fetch(self, fdc_id):
+        """Return the body of the API response for a food."""
+        # Typically we should escape URL params but here we know they
+        # don't need escaping.
+        path = self._path + fdc_id + '?API_KEY=' + self._api_key
+        for attempt in range(self._max_retries + 1):
+            self._rate_limiter.wait()
+            retry_after = None
+            try:
+                connection = self._connection()
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                error = e
+                self._close_connection()
+            else:
+                if response.status == 200:
+                    return body
+                error = IOError(
+                    'HTTP %d for fdc_id %s' % (response.status, fdc_id))
+                if response.status not in _RETRY_STATUSES:
+                    raise error
+                retry_after = response.getheader('Retry-After')
+            if attempt == self._max_retries:
+                raise error
+            # Exponential backoff with jitter, unless the server says how
+            # long to wait.
+            if retry_after is not None and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = self._backoff * 2 ** attempt * random.uniform(0.5, 1)
+            print('Retrying fdc_id %s in %.1fs: %s' % (fdc_id, delay, error))
+            time.sleep(delay)
+
+    def download(self, fdc_id, filename):
+        body = self.fetch(fdc_id)
+        # Write to a temporary file first, so that a partially written file
+        # is never mistaken for a complete one when resuming.
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_filename, filename)
+
+
+def download_foods(fdc_ids, api_key, output_dir, base_url=FDC_API_URL,
+                   concurrency=8, rate_limit=None, max_retries=5,
+                   backoff=1.0):
+    """Download the API response for each food to `<fdc_id>.json`.
+
+    Foods whose file already exists are skipped.
+
+    Args:
+        fdc_ids: A list of fdc_ids (strings).
+        api_key: An API key for the FDC API.
+        output_dir: The directory to write files to.
+        base_url: The URL of the FDC API, which may be a local server for
+            testing.
+        concurrency: The maximum number of concurrent requests.
+        rate_limit: If set, the maximum number of requests per second.
+        max_retries: The number of times to retry a failed request.
+        backoff: The delay before the first retry, in seconds, which is
+            doubled for each later retry.
+    """
+    downloader = _Downloader(
+        base_url, api_key, rate_limit, max_retries, backoff)
+    pending = []
+    for fdc_id in fdc_ids:
+        filename = os.path.join(output_dir, fdc_id + '.json')
+        if not os.path.exists(filename):
+            pending.append((fdc_id, filename))
+    print('Downloading %d foods (%d already downloaded)' % (
+        len(pending), len(fdc_ids) - len(pending)))
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        futures = {
+            executor.submit(downloader.download, fdc_id, filename): fdc_id
+            for fdc_id, filename in pending}
+        for num_done, future in enumerate(
+                concurrent.futures.as_completed(futures), 1):
+            # Raise the first error, after which the remaining downloads are
+            # cancelled.
+            try:
+                future.result()
+            except Exception:
+                for other in futures:
+                    other.cancel()
+                raise
+            if num_done % 100 == 0 or num_done == len(pending):
+                print('Downloaded %d of %d foods' % (num_done, len(pending)))
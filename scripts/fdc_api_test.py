@@ -0,0 +1,132 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of `download_foods` against a local stand-in for the FDC API.
+
+Run with `python -m unittest scripts.fdc_api_test`.
+"""
+import http.server
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from .fdc_api import download_foods
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    """Responds with the next planned response for the requested food.
+
+    Once the planned responses for a food are used up, the food is returned.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        fdc_id = self.path.split('?')[0].rsplit('/', 1)[-1]
+        with server.lock:
+            server.requests.append(self.path)
+            planned = server.planned.get(fdc_id)
+            status, headers = planned.pop(0) if planned else (200, {})
+        body = b''
+        if status == 200:
+            body = json.dumps({'fdcId': int(fdc_id)}).encode('utf8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadFoodsTest(unittest.TestCase):
+    def setUp(self):
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _StubHandler)
+        self._server.lock = threading.Lock()
+        self._server.requests = []
+        # A dict from fdc_id to a list of (status, headers) to respond with.
+        self._server.planned = {}
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._base_url = 'http://127.0.0.1:%d/fdc/v1/' % (
+            self._server.server_address[1])
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._tmp_dir.cleanup()
+
+    def _download(self, fdc_ids, **kwargs):
+        download_foods(
+            fdc_ids, 'KEY', self._tmp_dir.name, base_url=self._base_url,
+            concurrency=2, backoff=0.01, **kwargs)
+
+    def _requests_for(self, fdc_id):
+        return [
+            path for path in self._server.requests
+            if path.split('?')[0].endswith('/' + fdc_id)]
+
+    def _read_food(self, fdc_id):
+        with open(os.path.join(self._tmp_dir.name, fdc_id + '.json')) as f:
+            return json.load(f)
+
+    def test_downloads_foods(self):
+        self._download(['1', '2'])
+        self.assertEqual(self._read_food('1'), {'fdcId': 1})
+        self.assertEqual(self._read_food('2'), {'fdcId': 2})
+        self.assertEqual(self._requests_for('1'), ['/fdc/v1/1?API_KEY=KEY'])
+
+    def test_retries_server_errors(self):
+        self._server.planned['1'] = [(503, {}), (500, {})]
+        self._download(['1'])
+        self.assertEqual(self._read_food('1'), {'fdcId': 1})
+        self.assertEqual(len(self._requests_for('1')), 3)
+
+    def test_retries_rate_limited_requests_after_retry_after(self):
+        self._server.planned['1'] = [(429, {'Retry-After': '0'})]
+        self._download(['1'])
+        self.assertEqual(self._read_food('1'), {'fdcId': 1})
+        self.assertEqual(len(self._requests_for('1')), 2)
+
+    def test_gives_up_after_max_retries(self):
+        self._server.planned['1'] = [(503, {})] * 10
+        with self.assertRaises(IOError):
+            self._download(['1'], max_retries=2)
+        self.assertEqual(len(self._requests_for('1')), 3)
+        self.assertEqual(os.listdir(self._tmp_dir.name), [])
+
+    def test_does_not_retry_not_found(self):
+        self._server.planned['1'] = [(404, {})]
+        with self.assertRaises(IOError):
+            self._download(['1'])
+        self.assertEqual(len(self._requests_for('1')), 1)
+        self.assertEqual(os.listdir(self._tmp_dir.name), [])
+
+    def test_resumes_by_skipping_downloaded_foods(self):
+        with open(os.path.join(self._tmp_dir.name, '1.json'), 'w') as f:
+            json.dump({'fdcId': 1, 'cached': True}, f)
+        self._download(['1', '2'])
+        self.assertEqual(self._requests_for('1'), [])
+        self.assertEqual(self._read_food('1'), {'fdcId': 1, 'cached': True})
+        self.assertEqual(self._read_food('2'), {'fdcId': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,7 @@
 These are just `namedtuple`s based on the column header names.
 """
 import collections
+import functools
 
 
 BrandedFood = collections.namedtuple(
@@ -100,7 +101,8 @@ Nutrient = collections.namedtuple(
 
 
 # The data from all files.  Each field is a list whose values are namedtuples
-# of the type for that file.
+# of the type for that file (or an iterable over such namedtuples, when loaded
+# with `load_raw_data(..., streaming=True)`).
 RawData = collections.namedtuple(
     'RawData',
     [
@@ -111,3 +113,77 @@ RawData = collections.namedtuple(
         'foods',
         'nutrients',
     ])
+
+
+# The fields of `RawData`, mapped to the name and schema of each file.
+RAW_DATA_FILES = collections.OrderedDict([
+    ('branded_foods', ('branded_food.csv', BrandedFood)),
+    ('food_nutrients', ('food_nutrient.csv', FoodNutrient)),
+    ('food_attributes', ('food_attribute.csv', FoodAttribute)),
+    ('food_update_log_entries',
+     ('food_update_log_entry.csv', FoodUpdateLogEntry)),
+    ('foods', ('food.csv', Food)),
+    ('nutrients', ('nutrient.csv', Nutrient)),
+])
+
+
+@functools.lru_cache(maxsize=None)
+def projected_schema(data_cls, fields):
+    """Return a namedtuple with a subset of the fields of a schema.
+
+    The same class is returned for the same arguments, so rows projected
+    in different places can be compared and combined.
+
+    Args:
+        data_cls: The namedtuple for a data file.
+        fields: A tuple of the names of fields of `data_cls`.
+    """
+    for field in fields:
+        if field not in data_cls._fields:
+            raise ValueError(
+                'Unknown field %s for %s' % (field, data_cls.__name__))
+    if tuple(fields) == data_cls._fields:
+        return data_cls
+    return collections.namedtuple(data_cls.__name__, fields)
+
+
+def column_converter(column_type):
+    """Return a function that converts a column value to `column_type`.
+
+    Empty values are converted to None, except for `str` columns, which are
+    left unchanged.
+
+    Args:
+        column_type: One of `str`, `int` or `float`.
+    """
+    if column_type is str:
+        return str
+    elif column_type in (int, float):
+        return lambda value: column_type(value) if value else None
+    else:
+        raise ValueError('Unsupported column type %s' % column_type)
+
+
+def row_converter(data_cls, column_types):
+    """Return a function that projects and converts the rows of a file.
+
+    Args:
+        data_cls: The namedtuple for a data file.
+        column_types: None to keep every field as a string, or a dict whose
+            keys are the fields to keep, in order, and whose values are the
+            type of each field (see `column_converter`).
+
+    Returns:
+        A function taking a list of the string values of a row of the file
+        and returning an instance of the projected schema.
+    """
+    if column_types is None:
+        return data_cls._make
+    row_cls = projected_schema(data_cls, tuple(column_types))
+    columns = [
+        (data_cls._fields.index(field), column_converter(column_type))
+        for field, column_type in column_types.items()]
+
+    def convert_row(row):
+        return row_cls._make([convert(row[i]) for i, convert in columns])
+    return convert_row
@@ -0,0 +1,253 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""An on-disk store of merged foods, indexed by fdcId and gtinUpc.
+
+`build_food_store` merges raw data once and writes each merged food to a
+SQLite database, as zlib compressed JSON keyed by fdc_id, together with an
+index from GTIN to fdc_id.  `FoodStore` then looks up foods by fdc_id or
+GTIN without loading the rest of the data, keeping recently used foods in
+an LRU cache.
+
+GTINs are indexed without leading zeros, so a UPC-A code and the same code
+padded to a GTIN-14 find the same foods.  Several foods (e.g. different
+releases of a product) can have the same GTIN.
+"""
+from collections import OrderedDict
+import json
+import os
+import pathlib
+import sqlite3
+import zlib
+
+from .export_csv import check_join
+from .export_csv import iter_merged_data
+from .instrumentation import traced_stage
+
+
+# Version of the format of the database, checked when it is opened.
+_FORMAT_VERSION = '1'
+
+_SCHEMA = [
+    'CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE foods (fdc_id INTEGER PRIMARY KEY, food BLOB)',
+    'CREATE TABLE gtins (gtin TEXT, fdc_id INTEGER, '
+    'PRIMARY KEY (gtin, fdc_id)) WITHOUT ROWID',
+]
+
+# Maximum number of fdc_ids in a single query, which must be below SQLite's
+# limit on the number of parameters.
+_MAX_QUERY_IDS = 500
+
+
+def _normalize_gtin(gtin):
+    return gtin.strip().lstrip('0')
+
+
+def _encode_food(item):
+    return zlib.compress(
+        json.dumps(item, separators=(',', ':')).encode('utf8'))
+
+
+def _decode_food(data):
+    return json.loads(zlib.decompress(data).decode('utf8'))
+
+
+def _write_foods(connection, merged_data):
+    """Write merged foods to a new database, and return how many."""
+    # The file is only used once it is complete, so there is no need for a
+    # journal.
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    gtins = []
+    with connection:
+        for statement in _SCHEMA:
+            connection.execute(statement)
+        connection.execute(
+            "INSERT INTO metadata VALUES ('format_version', ?)",
+            (_FORMAT_VERSION,))
+        print('writing merged foods to food store')
+        num_foods = 0
+        for item in merged_data:
+            fdc_id = item['fdcId']
+            connection.execute(
+                'INSERT OR REPLACE INTO foods VALUES (?, ?)',
+                (fdc_id, _encode_food(item)))
+            gtin = _normalize_gtin(item.get('gtinUpc', ''))
+            if gtin:
+                gtins.append((gtin, fdc_id))
+            num_foods += 1
+        # Inserting in order is faster than maintaining the index as foods
+        # are inserted.
+        print('indexing %d GTINs' % len(gtins))
+        gtins.sort()
+        connection.executemany(
+            'INSERT OR IGNORE INTO gtins VALUES (?, ?)', gtins)
+    return num_foods
+
+
+def build_food_store(raw_data_dir, store_file, join='hash', tmp_dir=None,
+                     cache_dir=None, processes=None, compact=False):
+    """Merge raw data and write the merged foods to a `FoodStore`.
+
+    The store is written to a temporary file which replaces `store_file`
+    when it is complete, so an existing store can be used until then.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        store_file: The SQLite database to write.
+        join, tmp_dir, cache_dir, processes, compact: As for `export_csv`.
+    """
+    check_join(join)
+    tmp_store_file = store_file + '.tmp'
+    if os.path.exists(tmp_store_file):
+        os.remove(tmp_store_file)
+    with traced_stage('build_food_store'):
+        merged_data = iter_merged_data(
+            raw_data_dir, join=join, tmp_dir=tmp_dir, cache_dir=cache_dir,
+            processes=processes, compact=compact)
+        connection = sqlite3.connect(tmp_store_file)
+        try:
+            num_foods = _write_foods(connection, merged_data)
+            connection.execute('VACUUM')
+            connection.close()
+            os.replace(tmp_store_file, store_file)
+        finally:
+            # If writing failed, don't leave the incomplete store behind.
+            connection.close()
+            if os.path.exists(tmp_store_file):
+                os.remove(tmp_store_file)
+    print('wrote %d foods to %s' % (num_foods, store_file))
+
+
+class FoodStore(object):
+    """Looks up merged foods by fdcId or gtinUpc.
+
+    Foods are returned as JSON-like objects, in the same format as
+    `merge_sources`.  Foods may be shared with the cache, so they shouldn't
+    be modified.
+    """
+
+    def __init__(self, store_file, cache_size=1024):
+        """Open a store written by `build_food_store`.
+
+        Args:
+            store_file: The SQLite database.
+            cache_size: The maximum number of foods to keep in the LRU
+                cache.
+        """
+        if not os.path.exists(store_file):
+            raise IOError('No such food store: %s' % store_file)
+        # The path is quoted in the URI, so that e.g. '#' or '?' in it isn't
+        # taken as part of the URI syntax.
+        self._connection = sqlite3.connect(
+            pathlib.Path(store_file).resolve().as_uri() + '?mode=ro',
+            uri=True)
+        try:
+            row = self._connection.execute(
+                "SELECT value FROM metadata WHERE key = 'format_version'"
+            ).fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        if row is None or row[0] != _FORMAT_VERSION:
+            self._connection.close()
+            raise ValueError(
+                'Unsupported food store format in %s' % store_file)
+        self._cache_size = cache_size
+        # An `OrderedDict` from fdc_id to food, from least to most recently
+        # used.
+        self._cache = OrderedDict()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _cache_get(self, fdc_id):
+        item = self._cache.get(fdc_id)
+        if item is not None:
+            self._cache.move_to_end(fdc_id)
+        return item
+
+    def _cache_put(self, fdc_id, item):
+        self._cache[fdc_id] = item
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, fdc_id):
+        """Return the food with an fdc_id, or None if there is none."""
+        fdc_id = int(fdc_id)
+        item = self._cache_get(fdc_id)
+        if item is not None:
+            return item
+        row = self._connection.execute(
+            'SELECT food FROM foods WHERE fdc_id = ?', (fdc_id,)).fetchone()
+        if row is None:
+            return None
+        item = _decode_food(row[0])
+        self._cache_put(fdc_id, item)
+        return item
+
+    def get_many(self, fdc_ids):
+        """Look up several foods at once.
+
+        Args:
+            fdc_ids: An iterable of fdc_ids.
+
+        Returns:
+            A dict from fdc_id (an int) to food, for each fdc_id that is in
+            the store.
+        """
+        result = {}
+        missing = []
+        for fdc_id in fdc_ids:
+            fdc_id = int(fdc_id)
+            item = self._cache_get(fdc_id)
+            if item is not None:
+                result[fdc_id] = item
+            else:
+                missing.append(fdc_id)
+        for start in range(0, len(missing), _MAX_QUERY_IDS):
+            chunk = missing[start:start + _MAX_QUERY_IDS]
+            for fdc_id, data in self._connection.execute(
+                    'SELECT fdc_id, food FROM foods WHERE fdc_id IN (%s)' %
+                    ','.join('?' * len(chunk)), chunk):
+                item = _decode_food(data)
+                self._cache_put(fdc_id, item)
+                result[fdc_id] = item
+        return result
+
+    def fdc_ids(self):
+        """Return the fdc_ids of all foods, in increasing order."""
+        return [fdc_id for fdc_id, in self._connection.execute(
+            'SELECT fdc_id FROM foods ORDER BY fdc_id')]
+
+    def fdc_ids_for_gtin(self, gtin_upc):
+        """Return the fdc_ids of the foods with a GTIN, in increasing order."""
+        return [fdc_id for fdc_id, in self._connection.execute(
+            'SELECT fdc_id FROM gtins WHERE gtin = ? ORDER BY fdc_id',
+            (_normalize_gtin(gtin_upc),))]
+
+    def get_by_gtin(self, gtin_upc):
+        """Return the food with a GTIN, or None if there is none.
+
+        If several foods have the GTIN, the one with the highest fdc_id,
+        which is usually the most recent, is returned.
+        """
+        fdc_ids = self.fdc_ids_for_gtin(gtin_upc)
+        return self.get(fdc_ids[-1]) if fdc_ids else None
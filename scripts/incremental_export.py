@@ -0,0 +1,212 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Functions to incrementally export merged data to CSV format.
+
+Each FDC release changes only a small fraction of the Branded Foods.  Instead
+of merging every food again, `export_csv_incremental` keeps a SQLite
+database with the exported CSV row of every food from the previous export,
+keyed by fdc_id, together with a version of the raw data for that food.
+
+The version is a digest of the food's rows in `branded_food.csv`, `food.csv`
+and `food_update_log_entry.csv`, and of its rows in `food_nutrient.csv`.
+When a new release is applied, only foods whose version changed are merged
+and their rows updated, and foods that are no longer in the release are
+removed.  When a delta dump (containing only the foods that were added or
+changed) is applied, every food in it is merged and updated, and no foods
+are removed.  Discontinued foods have a `discontinued_date` and so are
+updated like any other change.
+
+`nutrient.csv` is shared by all foods, so it isn't part of their versions.
+Instead a digest of it is kept with the state, and if it changes, every food
+is merged again, as when the export config changes.
+
+In both cases merged.csv is then rewritten from the database, with foods in
+order of fdc_id.
+"""
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+
+from .export_csv import _export_config_from_json
+from .load_raw_data import load_raw_data
+from .merge_sources import iter_merged_sources
+from .merge_sources import MERGE_COLUMNS
+
+
+# The columns used to compute versions and merge foods.
+_INCREMENTAL_COLUMNS = dict(
+    MERGE_COLUMNS,
+    food_update_log_entries={'id': int, 'last_updated': str})
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS foods '
+    '(fdc_id INTEGER PRIMARY KEY, version TEXT, row TEXT)',
+]
+
+
+def _food_nutrient_checksums(food_nutrients):
+    """Return a dict from fdc_id to a checksum of its food nutrient rows.
+
+    The checksum depends on the order of the rows, since this determines
+    the order of the merged food nutrients.
+    """
+    checksums = {}
+    for food_nutrient in food_nutrients:
+        fdc_id = food_nutrient.fdc_id
+        checksums[fdc_id] = zlib.crc32(
+            repr(tuple(food_nutrient)).encode('utf8'),
+            checksums.get(fdc_id, 0))
+    return checksums
+
+
+def _food_versions(raw_data):
+    """Return a dict from fdc_id to a version for each branded food."""
+    print('computing versions of foods')
+    food_nutrient_checksums = _food_nutrient_checksums(raw_data.food_nutrients)
+    foods = {food.fdc_id: tuple(food) for food in raw_data.foods}
+    last_updated = {
+        entry.id: entry.last_updated
+        for entry in raw_data.food_update_log_entries}
+    versions = {}
+    for branded_food in raw_data.branded_foods:
+        fdc_id = branded_food.fdc_id
+        versions[fdc_id] = hashlib.sha1(repr((
+            tuple(branded_food),
+            foods.get(fdc_id),
+            last_updated.get(fdc_id),
+            food_nutrient_checksums.get(fdc_id),
+        )).encode('utf8')).hexdigest()
+    return versions
+
+
+def _nutrients_digest(nutrients):
+    """Return a digest of the rows of `nutrient.csv`."""
+    digest = hashlib.sha1()
+    for nutrient in nutrients:
+        digest.update(repr(tuple(nutrient)).encode('utf8'))
+    return digest.hexdigest()
+
+
+def _open_state(state_file, export_config_json, nutrients_digest, delta):
+    """Open the state database.
+
+    The state is cleared if the export config or nutrients changed.
+
+    Raises:
+        ValueError: If the nutrients changed and `delta` is set, since the
+            foods that are not in a delta dump can't be merged again.
+    """
+    connection = sqlite3.connect(state_file)
+    try:
+        with connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+            metadata = dict(connection.execute(
+                'SELECT key, value FROM metadata'))
+            has_foods = connection.execute(
+                'SELECT 1 FROM foods LIMIT 1').fetchone() is not None
+            if has_foods and metadata.get('nutrients') != nutrients_digest:
+                if delta:
+                    raise ValueError(
+                        'nutrient.csv changed since the previous export, so '
+                        'a full release must be applied')
+                print('nutrients changed, exporting all foods')
+                connection.execute('DELETE FROM foods')
+            if metadata.get('export_config') != export_config_json:
+                if 'export_config' in metadata:
+                    print('export config changed, exporting all foods')
+                connection.execute('DELETE FROM foods')
+            connection.executemany(
+                'INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                [('export_config', export_config_json),
+                 ('nutrients', nutrients_digest)])
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+def _write_merged_csv(connection, export_config, merged_data_csv_file):
+    print('writing merged data to CSV file')
+    with open(merged_data_csv_file, 'w', newline='') as f:
+        csv_writer = csv.writer(f,  quoting=csv.QUOTE_ALL)
+        csv_writer.writerow(column.name for column in export_config.columns)
+        for row, in connection.execute(
+                'SELECT row FROM foods ORDER BY fdc_id'):
+            csv_writer.writerow(json.loads(row))
+
+
+def export_csv_incremental(raw_data_dir, export_config_file, merged_data_dir,
+                           state_file, delta=False):
+    """Export raw data to merged CSV format, reusing a previous export.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data, either a full
+            release or (if `delta` is True) a delta dump.
+        export_config_file: A JSON file containing an `ExportConfig`.
+        merged_data_dir: The directory to write merged.csv to.
+        state_file: A SQLite database containing the state of the previous
+            export.  It is created if it doesn't exist.
+        delta: If True, `raw_data_dir` only contains foods that were added or
+            changed, so foods that are missing from it are not removed.
+    """
+    with open(export_config_file) as f:
+        export_config_obj = json.load(f)
+    export_config = _export_config_from_json(export_config_obj)
+    raw_data = load_raw_data(
+        raw_data_dir, streaming=True, columns=_INCREMENTAL_COLUMNS)
+    connection = _open_state(
+        state_file, json.dumps(export_config_obj, sort_keys=True),
+        _nutrients_digest(raw_data.nutrients), delta)
+
+    versions = _food_versions(raw_data)
+    previous_versions = dict(
+        connection.execute('SELECT fdc_id, version FROM foods'))
+    changed_fdc_ids = {
+        fdc_id for fdc_id, version in versions.items()
+        if delta or previous_versions.get(fdc_id) != version}
+    if delta:
+        removed_fdc_ids = []
+    else:
+        removed_fdc_ids = [
+            fdc_id for fdc_id in previous_versions if fdc_id not in versions]
+    num_added = sum(
+        1 for fdc_id in changed_fdc_ids if fdc_id not in previous_versions)
+    print('%d foods added, %d changed, %d removed, %d unchanged' % (
+        num_added,
+        len(changed_fdc_ids) - num_added,
+        len(removed_fdc_ids),
+        len(versions) - len(changed_fdc_ids)))
+
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO foods VALUES (?, ?, ?)',
+            ((item['fdcId'],
+              versions[item['fdcId']],
+              json.dumps(export_config.extract_row(item)))
+             for item in iter_merged_sources(
+                 raw_data, fdc_ids=changed_fdc_ids)))
+        connection.executemany(
+            'DELETE FROM foods WHERE fdc_id = ?',
+            ((fdc_id,) for fdc_id in removed_fdc_ids))
+
+    _write_merged_csv(
+        connection,
+        export_config,
+        os.path.join(merged_data_dir, 'merged.csv'))
+    connection.close()
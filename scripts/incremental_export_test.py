@@ -0,0 +1,140 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests that incremental exports match full exports.
+
+Run with `python -m unittest scripts.incremental_export_test`.
+"""
+import csv
+import os
+import tempfile
+import unittest
+
+from .export_csv import export_csv
+from .file_schemas import RAW_DATA_FILES
+from .incremental_export import export_csv_incremental
+
+
+_EXPORT_CONFIG_FILE = os.path.join(
+    os.path.dirname(__file__), 'sample_export_config.json')
+
+_NUTRIENTS = [
+    {'id': '1003', 'name': 'Protein', 'unit_name': 'G',
+     'nutrient_nbr': '203', 'rank': '600'},
+    {'id': '1004', 'name': 'Total lipid (fat)', 'unit_name': 'G',
+     'nutrient_nbr': '204', 'rank': '800'},
+]
+
+
+def _raw_data_rows(fdc_ids):
+    """Return a dict from field of `RawData` to rows, as dicts."""
+    rows = {field: [] for field in RAW_DATA_FILES}
+    rows['nutrients'] = [dict(nutrient) for nutrient in _NUTRIENTS]
+    for fdc_id in fdc_ids:
+        rows['branded_foods'].append({
+            'fdc_id': str(fdc_id), 'brand_owner': 'Owner',
+            'gtin_upc': '%012d' % fdc_id, 'serving_size': '30',
+            'serving_size_unit': 'g', 'data_source': 'GDSN',
+            'modified_date': '2019-03-19', 'available_date': '2019-03-19',
+            'market_country': 'United States'})
+        rows['foods'].append({
+            'fdc_id': str(fdc_id), 'data_type': 'branded_food',
+            'description': 'FOOD %d' % fdc_id,
+            'publication_date': '2019-04-01'})
+        rows['food_update_log_entries'].append({
+            'id': str(fdc_id), 'description': 'desc',
+            'last_updated': '2019-03-19'})
+        for i, nutrient_nbr in enumerate(['203', '204']):
+            rows['food_nutrients'].append({
+                'id': str(fdc_id * 10 + i), 'fdc_id': str(fdc_id),
+                'nutrient_id': nutrient_nbr, 'amount': str(i + 1.5)})
+    return rows
+
+
+def _write_raw_data(raw_data_dir, rows):
+    os.makedirs(raw_data_dir, exist_ok=True)
+    for field, (filename, data_cls) in RAW_DATA_FILES.items():
+        with open(os.path.join(raw_data_dir, filename), 'w',
+                  newline='') as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+            writer.writerow(data_cls._fields)
+            for row in rows[field]:
+                writer.writerow(
+                    row.get(name, '') for name in data_cls._fields)
+
+
+class IncrementalExportTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._raw_data_dir = self._path('raw')
+        self._state_file = self._path('state.db')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _path(self, name):
+        return os.path.join(self._tmp_dir.name, name)
+
+    def _export(self, name, incremental, delta=False):
+        merged_data_dir = self._path(name)
+        os.makedirs(merged_data_dir)
+        if incremental:
+            export_csv_incremental(
+                self._raw_data_dir, _EXPORT_CONFIG_FILE, merged_data_dir,
+                self._state_file, delta=delta)
+        else:
+            export_csv(
+                self._raw_data_dir, _EXPORT_CONFIG_FILE, merged_data_dir)
+        with open(os.path.join(merged_data_dir, 'merged.csv')) as f:
+            return f.read()
+
+    def test_matches_full_export_after_foods_change(self):
+        rows = _raw_data_rows([100, 101, 102])
+        _write_raw_data(self._raw_data_dir, rows)
+        self._export('first', incremental=True)
+        rows = _raw_data_rows([100, 102, 103])
+        rows['branded_foods'][0]['brand_owner'] = 'New owner'
+        _write_raw_data(self._raw_data_dir, rows)
+        self.assertEqual(
+            self._export('second', incremental=True),
+            self._export('full', incremental=False))
+
+    def test_matches_full_export_after_nutrients_change(self):
+        rows = _raw_data_rows([100, 101, 102])
+        _write_raw_data(self._raw_data_dir, rows)
+        first = self._export('first', incremental=True)
+        rows['nutrients'] = [
+            nutrient for nutrient in rows['nutrients']
+            if nutrient['nutrient_nbr'] != '203']
+        _write_raw_data(self._raw_data_dir, rows)
+        second = self._export('second', incremental=True)
+        self.assertNotEqual(second, first)
+        self.assertEqual(second, self._export('full', incremental=False))
+
+    def test_delta_with_changed_nutrients_is_rejected(self):
+        rows = _raw_data_rows([100, 101])
+        _write_raw_data(self._raw_data_dir, rows)
+        first = self._export('first', incremental=True)
+        rows = _raw_data_rows([101])
+        rows['nutrients'][0]['name'] = 'Protein (new)'
+        _write_raw_data(self._raw_data_dir, rows)
+        with self.assertRaises(ValueError):
+            self._export('second', incremental=True, delta=True)
+        # The state is unchanged, so a delta without the change still works.
+        _write_raw_data(self._raw_data_dir, _raw_data_rows([101]))
+        self.assertEqual(
+            self._export('third', incremental=True, delta=True), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,354 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Instrumentation of the stages of the pipeline.
+
+The pipeline is divided into named stages (e.g. 'load food.csv', 'merge',
+'export'), using `traced_stage` for a block of code or `count_rows` for an
+iterable whose rows are counted as they are consumed.  Stages can be nested.
+
+Instrumentation is off unless `start_tracing` is called, in which case for
+each stage the time taken, the number of rows, rows per second and the
+process's peak resident set size are recorded.  Progress of long stages is
+printed periodically, with an estimated time remaining when the total
+amount of work is known.  When tracing stops a summary is printed, and a
+trace is written in the Chrome trace event format, which can be viewed
+with chrome://tracing or https://ui.perfetto.dev.
+
+Each outermost stage can also be profiled, with either `cProfile` (writing
+`<stage>.prof` files, which can be read with `pstats`) or a sampling
+profiler (writing `<stage>.folded` files of collapsed stacks, which can be
+turned into flame graphs).
+"""
+import collections
+import cProfile
+import datetime
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+
+# Number of rows between checks for whether progress should be printed.
+_CHECK_ROWS = 10000
+# Interval between samples of the sampling profiler, in seconds.
+_SAMPLE_INTERVAL = 0.005
+
+# The current `Tracer`, or None if instrumentation is off.
+_tracer = None
+
+
+def _peak_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class _SamplingProfiler(object):
+    """Samples the stack of a thread at regular intervals."""
+
+    def __init__(self, thread_id):
+        self._thread_id = thread_id
+        # A `Counter` of collapsed stacks, e.g. 'main;load;parse'.
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def dump_stats(self, filename):
+        with open(filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+
+class Stage(object):
+    """A stage of the pipeline that is being traced."""
+
+    def __init__(self, tracer, name, total, progress):
+        self._tracer = tracer
+        self.name = name
+        self.rows = 0
+        self._total = total
+        self._progress = progress
+        self.start_time = time.monotonic()
+        self._next_report_time = self.start_time + tracer.progress_interval
+
+    def add(self, rows=1):
+        """Add to the number of rows processed by this stage."""
+        self.set_rows(self.rows + rows)
+
+    def set_rows(self, rows):
+        self.rows = rows
+        now = time.monotonic()
+        if now >= self._next_report_time:
+            self._next_report_time = now + self._tracer.progress_interval
+            self._tracer.report_progress(self, now)
+
+    def fraction_done(self):
+        """Return the fraction of the stage that is done, or None."""
+        if self._progress is not None:
+            return self._progress()
+        if self._total:
+            return min(self.rows / self._total, 1.0)
+        return None
+
+
+class _NullStage(object):
+    """A stage that does nothing, used when instrumentation is off."""
+
+    def add(self, rows=1):
+        pass
+
+    def set_rows(self, rows):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Tracer(object):
+    """Records stages and writes a trace of them."""
+
+    def __init__(self, trace_file=None, profile_dir=None, profiler='cprofile',
+                 progress_interval=10.0):
+        """Create a tracer.
+
+        Args:
+            trace_file: If set, a file to write the trace to as JSON.
+            profile_dir: If set, a directory to write a profile of each
+                outermost stage to.
+            profiler: 'cprofile' or 'sampling'.
+            progress_interval: The interval between progress reports, in
+                seconds.
+        """
+        if profiler not in ('cprofile', 'sampling'):
+            raise ValueError('Unknown profiler %s' % profiler)
+        self.trace_file = trace_file
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self.progress_interval = progress_interval
+        self._start_time = time.monotonic()
+        self._stack = []
+        # Trace events, in the Chrome trace event format.
+        self._events = []
+        # A list of (start time, depth, name, seconds, rows, peak RSS) for
+        # the summary.
+        self._summary = []
+
+    def _timestamp(self, t):
+        """Convert a `time.monotonic` time to microseconds since the start."""
+        return int((t - self._start_time) * 1e6)
+
+    def report_progress(self, stage, now):
+        elapsed = now - stage.start_time
+        message = '%s: %d rows in %.0fs (%.0f rows/s)' % (
+            stage.name, stage.rows, elapsed, stage.rows / elapsed)
+        fraction_done = stage.fraction_done()
+        if fraction_done:
+            remaining = elapsed * (1 - fraction_done) / fraction_done
+            message += ', %.0f%% done, ETA %s' % (
+                100 * fraction_done,
+                datetime.timedelta(seconds=int(remaining)))
+        print(message)
+        self._events.append({
+            'name': stage.name,
+            'ph': 'C',
+            'ts': self._timestamp(now),
+            'pid': os.getpid(),
+            'args': {'rows': stage.rows},
+        })
+
+    def _start_profiler(self):
+        if self.profiler == 'cprofile':
+            profiler = cProfile.Profile()
+        else:
+            profiler = _SamplingProfiler(threading.get_ident())
+        profiler.enable()
+        return profiler
+
+    def _write_profile(self, profiler, name):
+        profiler.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        filename = os.path.join(
+            self.profile_dir,
+            re.sub(r'[^\w.-]+', '_', name) +
+            ('.prof' if self.profiler == 'cprofile' else '.folded'))
+        profiler.dump_stats(filename)
+        print('wrote profile of %s to %s' % (name, filename))
+
+    def run_stage(self, name, total, progress):
+        """A generator which runs a stage around its single yield."""
+        stage = Stage(self, name, total, progress)
+        depth = len(self._stack)
+        self._stack.append(stage)
+        profiler = None
+        if self.profile_dir is not None and depth == 0:
+            profiler = self._start_profiler()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                self._write_profile(profiler, name)
+            end_time = time.monotonic()
+            # Stages that count the rows of iterables may end in any order.
+            self._stack.remove(stage)
+            seconds = end_time - stage.start_time
+            peak_rss_bytes = _peak_rss_bytes()
+            args = {'rows': stage.rows, 'peak_rss_bytes': peak_rss_bytes}
+            if seconds > 0:
+                args['rows_per_second'] = stage.rows / seconds
+            self._events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': self._timestamp(stage.start_time),
+                'dur': int(seconds * 1e6),
+                'pid': os.getpid(),
+                'tid': depth,
+                'args': args,
+            })
+            self._summary.append((
+                stage.start_time, depth, name, seconds, stage.rows,
+                peak_rss_bytes))
+            if depth == 0:
+                # Write the trace after each outermost stage, so that it is
+                # available during long runs.
+                self.write_trace()
+
+    def write_trace(self):
+        if self.trace_file is None:
+            return
+        with open(self.trace_file, 'w') as f:
+            json.dump({'traceEvents': self._events}, f)
+
+    def print_summary(self):
+        print('%-40s %10s %12s %12s %10s' % (
+            'stage', 'seconds', 'rows', 'rows/s', 'peak MB'))
+        # Stages are recorded when they end, so sort by start time.
+        for _, depth, name, seconds, rows, peak_rss_bytes in sorted(
+                self._summary, key=lambda item: item[:2]):
+            print('%-40s %10.3f %12d %12.0f %10.1f' % (
+                '  ' * depth + name, seconds, rows,
+                rows / seconds if seconds > 0 else 0,
+                peak_rss_bytes / 1e6))
+
+
+class _StageContext(object):
+    """A context manager for a stage, created by `traced_stage`."""
+
+    def __init__(self, tracer, name, total, progress):
+        self._run = tracer.run_stage(name, total, progress)
+
+    def __enter__(self):
+        return next(self._run)
+
+    def __exit__(self, *exc_info):
+        self._run.close()
+        return False
+
+
+class _NullStageContext(object):
+
+    def __enter__(self):
+        return _NULL_STAGE
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE_CONTEXT = _NullStageContext()
+
+
+def traced_stage(name, total=None, progress=None):
+    """Return a context manager for a stage.
+
+    Args:
+        name: The name of the stage.
+        total: If set, the total number of rows the stage will process,
+            used to estimate the time remaining.
+        progress: If set, a function returning the fraction of the stage
+            that is done, used instead of `total`.
+
+    Returns:
+        A context manager whose value is a `Stage`, whose `add` method
+        should be called with the number of rows processed.
+    """
+    if _tracer is None:
+        return _NULL_STAGE_CONTEXT
+    return _StageContext(_tracer, name, total, progress)
+
+
+def _count(tracer, iterable, name, total, progress):
+    with _StageContext(tracer, name, total, progress) as stage:
+        rows = 0
+        for rows, item in enumerate(iterable, 1):
+            yield item
+            if rows % _CHECK_ROWS == 0:
+                stage.set_rows(rows)
+        stage.set_rows(rows)
+
+
+def count_rows(iterable, name, total=None, progress=None):
+    """Count the rows of an iterable as a stage.
+
+    The stage lasts from when iteration starts until it ends.  If
+    instrumentation is off, `iterable` is returned unchanged.
+
+    Args:
+        iterable: An iterable of rows.
+        name, total, progress: As for `traced_stage`.  If `total` is None and
+            `iterable` has a length, that is used.
+
+    Returns:
+        An iterable over the same rows.
+    """
+    if _tracer is None:
+        return iterable
+    if total is None and hasattr(iterable, '__len__'):
+        total = len(iterable)
+    return _count(_tracer, iterable, name, total, progress)
+
+
+def start_tracing(**kwargs):
+    """Turn instrumentation on.  The arguments are passed to `Tracer`."""
+    global _tracer
+    _tracer = Tracer(**kwargs)
+
+
+def stop_tracing():
+    """Turn instrumentation off, printing a summary and writing the trace."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.print_summary()
+        tracer.write_trace()
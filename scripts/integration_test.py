@@ -16,14 +16,24 @@
 The Branded Foods database is available at
 https://fdc.nal.usda.gov/download-datasets.html
 """
+from collections import Counter
+from collections import deque
+from collections import namedtuple
+import concurrent.futures
+import itertools
 import json
 import os
 import re
+import time
 import unittest
-import urllib.request
 
+from .extract_rows import extract_rows
+from .fdc_api import download_foods
+from .fdc_api import FDC_API_URL
+from .file_schemas import RAW_DATA_FILES
 from .load_raw_data import load_raw_data
-from .merge_sources import merge_sources
+from .merge_sources import iter_merged_sources
+from .merge_sources import MERGE_COLUMNS
 
 
 def _remove_keys(obj, keys_to_remove):
@@ -178,74 +188,283 @@ _FDC_IDS = [
     '772410',
 ]
 
-# URL for FoodDataCentral API.
-_FDC_API_URL = 'https://api.nal.usda.gov/fdc/v1/'
-
-
-def create_test_data(raw_data_dir, fdc_api_key, test_data_dir):
-    # Construct a regex like '"123"|"456"'.  Using the quotes helps to
-    # avoid matchig a row where the fdc_id is a substring of another id,
-    # which can happen.
-    filter_regex = re.compile('|'.join('"%s"' % id for id in _FDC_IDS))
-
-    def copy_and_filter(filename, filter):
-        """Copy and CSV file and optinally filter."""
-        print('Creating test data file: %s' % filename)
-        input_filename = os.path.join(raw_data_dir, filename)
-        output_filename = os.path.join(test_data_dir, filename)
-        with open(input_filename) as fin:
-            with open(output_filename, 'w') as fout:
-                line = fin.readline()
-                fout.write(line)
-                while True:
-                    line = fin.readline()
-                    if not line:
-                        break
-                    if filter and not filter_regex.search(line):
-                        continue
-                    fout.write(line)
-    copy_and_filter('branded_food.csv', True)
-    copy_and_filter('food_nutrient.csv', True)
-    copy_and_filter('food_attribute.csv', True)
-    copy_and_filter('food_update_log_entry.csv', True)
-    copy_and_filter('food.csv', True)
-    copy_and_filter('nutrient.csv', False)
-
-    for fdc_id in _FDC_IDS:
-        print('Downloading golden data for fdc_id: %s' % fdc_id)
-        # Typically we should escape URL params but here we know they
-        # don't need escaping.
-        url = _FDC_API_URL + fdc_id + '?API_KEY=' + fdc_api_key
-        # NOTE: if you get an error message containing
-        # CERTIFICATE_VERIFY_FAILED and are using OSX,
-        # see https://stackoverflow.com/a/42334357.
-        response = urllib.request.urlopen(url)
+# The column to select the rows for a food by, for each raw data file, or
+# None if the whole file is copied.
+_TEST_DATA_KEY_FIELDS = {
+    'branded_food.csv': 'fdc_id',
+    'food_nutrient.csv': 'fdc_id',
+    'food_attribute.csv': 'fdc_id',
+    'food_update_log_entry.csv': 'id',
+    'food.csv': 'fdc_id',
+    'nutrient.csv': None,
+}
+
+# A file in the test data directory listing the fdc_ids in the test data, one
+# per line.  If this is missing, `_FDC_IDS` is used.
+_FDC_IDS_FILENAME = 'fdc_ids.txt'
+
+
+def _read_fdc_ids(filename):
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def create_test_data(raw_data_dir, fdc_api_key, test_data_dir,
+                     fdc_ids_file=None, processes=None,
+                     fdc_api_url=FDC_API_URL, concurrency=8, rate_limit=None):
+    """Create test data for a sample of foods.
+
+    Golden data for foods that were already downloaded to `test_data_dir` is
+    not downloaded again.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        fdc_api_key: An API key for the FDC API.
+        test_data_dir: The directory to write test data to.
+        fdc_ids_file: If set, a file listing the fdc_ids to sample, one per
+            line.  Otherwise `_FDC_IDS` is used.
+        processes: The number of processes to extract rows with, or None to
+            use one per CPU.
+        fdc_api_url: The URL of the FDC API to download golden data from.
+        concurrency: The maximum number of concurrent API requests.
+        rate_limit: If set, the maximum number of API requests per second.
+    """
+    fdc_ids = _FDC_IDS if fdc_ids_file is None else _read_fdc_ids(fdc_ids_file)
+    files = [
+        (filename, data_cls, _TEST_DATA_KEY_FIELDS[filename])
+        for filename, data_cls in RAW_DATA_FILES.values()
+        if filename in _TEST_DATA_KEY_FIELDS]
+    extract_rows(
+        raw_data_dir, test_data_dir, files, fdc_ids, processes=processes)
+    with open(os.path.join(test_data_dir, _FDC_IDS_FILENAME), 'w') as f:
+        f.writelines(fdc_id + '\n' for fdc_id in fdc_ids)
+
+    print('Downloading golden data')
+    # NOTE: if you get an error message containing
+    # CERTIFICATE_VERIFY_FAILED and are using OSX,
+    # see https://stackoverflow.com/a/42334357.
+    download_foods(
+        fdc_ids, fdc_api_key, test_data_dir, base_url=fdc_api_url,
+        concurrency=concurrency, rate_limit=rate_limit)
+
+
+# A difference between the expected and actual merged data for a food.
+# `path` is the location of the difference, e.g. 'foodNutrients[3].amount'.
+Mismatch = namedtuple('Mismatch', ['path', 'expected', 'actual'])
+
+
+class _Missing(object):
+    """The type of `_MISSING`.
+
+    Mismatches are returned from worker processes, so this pickles as a
+    reference to `_MISSING`, which keeps `is _MISSING` checks working.
+    """
+
+    def __repr__(self):
+        return '<missing>'
+
+    def __reduce__(self):
+        return '_MISSING'
+
+
+# Value of `Mismatch.expected` or `Mismatch.actual` for a missing value.
+# This is distinct from every JSON value, including the string '<missing>'.
+_MISSING = _Missing()
+
+# Number of foods checked together by a worker process.
+_CHECK_BATCH_SIZE = 100
+# Number of batches being checked ahead of the results being reported, per
+# process.  This bounds the merged foods held in memory.
+_PENDING_BATCHES_PER_PROCESS = 2
+# Maximum number of mismatches printed for each food.
+_MAX_MISMATCHES_PER_FOOD = 10
+
+
+def _diff_json(expected, actual, path=''):
+    """Compare two JSON-like objects.
+
+    Numbers are only equal if they have the same type, since e.g. 1 and 1.0
+    are written differently.
+
+    Returns:
+        A list of `Mismatch`es.
+    """
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        mismatches = []
+        for key in sorted(set(expected) | set(actual)):
+            key_path = '%s.%s' % (path, key) if path else key
+            if key not in actual:
+                mismatches.append(Mismatch(key_path, expected[key], _MISSING))
+            elif key not in expected:
+                mismatches.append(Mismatch(key_path, _MISSING, actual[key]))
+            else:
+                mismatches.extend(
+                    _diff_json(expected[key], actual[key], key_path))
+        return mismatches
+    if isinstance(expected, list) and isinstance(actual, list):
+        mismatches = []
+        for index, (expected_item, actual_item) in enumerate(
+                itertools.zip_longest(expected, actual, fillvalue=_MISSING)):
+            index_path = '%s[%d]' % (path, index)
+            if expected_item is _MISSING or actual_item is _MISSING:
+                mismatches.append(
+                    Mismatch(index_path, expected_item, actual_item))
+            else:
+                mismatches.extend(
+                    _diff_json(expected_item, actual_item, index_path))
+        return mismatches
+    if type(expected) is not type(actual) or expected != actual:
+        return [Mismatch(path, expected, actual)]
+    return []
+
+
+def _field_of_path(path):
+    """The field a mismatch is in, e.g. 'foodNutrients[].amount'."""
+    return re.sub(r'\[\d+\]', '[]', path)
+
+
+def _check_foods(test_data_dir, items):
+    """Compare merged foods with their golden data.
+
+    Args:
+        test_data_dir: The directory containing test data.
+        items: A list of pairs of an fdc_id and the merged food with that
+            fdc_id, or None if it is missing.
+
+    Returns:
+        A list of pairs of an fdc_id and a list of `Mismatch`es.
+    """
+    results = []
+    for fdc_id, actual in items:
         filename = os.path.join(test_data_dir, fdc_id + '.json')
-        with open(filename, 'w') as f:
-            f.write(response.read().decode('utf8'))
+        with open(filename) as f:
+            expected = _remove_keys(json.load(f), _MISSING_KEYS)
+        if actual is None:
+            mismatches = [Mismatch('', '<food>', _MISSING)]
+        else:
+            mismatches = _diff_json(expected, actual)
+        results.append((fdc_id, mismatches))
+    return results
+
+
+def _test_fdc_ids(test_data_dir):
+    fdc_ids_filename = os.path.join(test_data_dir, _FDC_IDS_FILENAME)
+    if os.path.exists(fdc_ids_filename):
+        return _read_fdc_ids(fdc_ids_filename)
+    return _FDC_IDS
+
+
+def _iter_check_batches(merged_data, fdc_ids):
+    """Split merged foods into batches for `_check_foods`.
+
+    Args:
+        merged_data: An iterable of pairs of an fdc_id and a merged food.
+        fdc_ids: The fdc_ids of all the test foods.
+
+    Yields:
+        Lists of pairs of an fdc_id and a merged food, or None for the
+        foods that are not in `merged_data`, which are in the last batch.
+    """
+    merged_data = iter(merged_data)
+    found_fdc_ids = set()
+    while True:
+        batch = list(itertools.islice(merged_data, _CHECK_BATCH_SIZE))
+        if not batch:
+            break
+        found_fdc_ids.update(fdc_id for fdc_id, _ in batch)
+        yield batch
+    missing = [
+        (fdc_id, None) for fdc_id in fdc_ids if fdc_id not in found_fdc_ids]
+    if missing:
+        yield missing
+
+
+def run_integration_test(test_data_dir, cache_dir=None, processes=None,
+                         compact=False):
+    """Compare the merged test data with golden data for every food.
+
+    Only the test foods are merged, in this process, and they are compared
+    with their golden data in batches by a pool of worker processes.  Only
+    a few batches per process are merged ahead of the comparisons.  Every
+    mismatch is reported, followed by the number of mismatches for each
+    field.
+
+    Args:
+        test_data_dir: The directory containing test data.
+        cache_dir: If set, a directory used to cache parsed raw data.
+        processes: The number of processes to parse files and compare foods
+            with, or None to use one per CPU for comparing foods.
+        compact: If True, store food nutrients as typed arrays.
+
+    Returns:
+        A pair of the number of foods that passed, and a dict from fdc_id to
+        a list of `Mismatch`es for each food that failed.
+    """
+    start_time = time.time()
+    fdc_ids = _test_fdc_ids(test_data_dir)
+    raw_data = load_raw_data(
+        test_data_dir, streaming=True, cache_dir=cache_dir,
+        processes=processes, compact=compact, columns=MERGE_COLUMNS)
+    # The fdc_id field of the raw data rows is an int.
+    merged_data = (
+        (str(item['fdcId']), item)
+        for item in iter_merged_sources(
+            raw_data, fdc_ids={int(fdc_id) for fdc_id in fdc_ids}))
+
+    num_passed = 0
+    failures = {}
+
+    def report(results):
+        nonlocal num_passed
+        for fdc_id, mismatches in results:
+            if not mismatches:
+                num_passed += 1
+                continue
+            failures[fdc_id] = mismatches
+            print('FAIL fdc_id %s: %d mismatches' % (
+                fdc_id, len(mismatches)))
+            for mismatch in mismatches[:_MAX_MISMATCHES_PER_FOOD]:
+                print('    %s: expected %r, actual %r' % mismatch)
+            if len(mismatches) > _MAX_MISMATCHES_PER_FOOD:
+                print('    ...')
+
+    max_pending = _PENDING_BATCHES_PER_PROCESS * (
+        processes or os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        # Results are reported in the order the batches were submitted.
+        pending = deque()
+        for batch in _iter_check_batches(merged_data, fdc_ids):
+            pending.append(
+                executor.submit(_check_foods, test_data_dir, batch))
+            if len(pending) >= max_pending:
+                report(pending.popleft().result())
+        while pending:
+            report(pending.popleft().result())
+
+    if failures:
+        print('mismatches by field:')
+        field_counts = Counter(
+            _field_of_path(mismatch.path)
+            for mismatches in failures.values() for mismatch in mismatches)
+        for field, count in field_counts.most_common():
+            print('    %s: %d' % (field or '<food>', count))
+    print('%d passed, %d failed in %.1fs' % (
+        num_passed, len(failures), time.time() - start_time))
+    return num_passed, failures
 
 
 class IntegrationTest(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         self.test_data_dir = kwargs.pop('test_data_dir')
+        self.cache_dir = kwargs.pop('cache_dir', None)
+        self.processes = kwargs.pop('processes', None)
+        self.compact = kwargs.pop('compact', False)
         super(IntegrationTest, self).__init__(*args, **kwargs)
 
     def test_load_and_merge(self):
-        raw_data = load_raw_data(self.test_data_dir)
-        merged_data = merge_sources(raw_data)
-        merged_data = {str(item['fdcId']): item for item in merged_data}
-
-        for fdc_id in _FDC_IDS:
-            print('validating food with fdc_id: %s' % fdc_id)
-            actual = merged_data[fdc_id]
-
-            filename = os.path.join(self.test_data_dir, fdc_id + '.json')
-            with open(filename) as f:
-                expected = json.load(f)
-
-            expected = _remove_keys(expected, _MISSING_KEYS)
-
-            self.maxDiff = None
-            self.assertMultiLineEqual(
-                json.dumps(expected, indent=2, sort_keys=True),
-                json.dumps(actual, indent=2, sort_keys=True))
+        _, failures = run_integration_test(
+            self.test_data_dir, cache_dir=self.cache_dir,
+            processes=self.processes, compact=self.compact)
+        if failures:
+            self.fail('merged data differs from golden data for fdc_ids: %s'
+                      % ', '.join(sorted(failures)))
@@ -15,16 +15,52 @@
 import csv
 import os
 
-from .file_schemas import BrandedFood
-from .file_schemas import Food
-from .file_schemas import FoodAttribute
+from .compact_tables import CompactFoodNutrients
 from .file_schemas import FoodNutrient
-from .file_schemas import FoodUpdateLogEntry
-from .file_schemas import Nutrient
+from .file_schemas import RAW_DATA_FILES
 from .file_schemas import RawData
+from .file_schemas import row_converter
+from .instrumentation import count_rows
+from .parallel_csv import iter_data_file_in_parallel
+from .parallel_csv import load_data_file_in_parallel
 
 
-def _load_data_file(data_dir, filename, data_cls):
+def _iter_data_file(data_dir, filename, data_cls, column_types=None):
+    """Iterate over the rows of a data file.
+
+    Like `_load_data_file` but yields rows one at a time instead of
+    building a list, so only a single row is held in memory.
+
+    Args:
+        data_dir: The directory containing USDA data.
+        filename: The name of the file within `data_dir`.
+        data_cls: The namedtuple for this data file.
+        column_types: If set, a dict of the columns to keep and their
+            types (see `file_schemas.row_converter`).
+
+    Yields:
+        Instances of `data_cls` (or its projection to `column_types`), one
+        for each row after the header row.
+    """
+    print('loading file: %s' % filename)
+    path = os.path.join(data_dir, filename)
+    file_size = os.path.getsize(path)
+    with open(path) as f:
+        reader = csv.reader(f)
+        header_row = next(reader)
+        # Verify the header rows match the fields
+        assert header_row == list(data_cls._fields), (header_row, data_cls)
+        # For each row after the header row, convert from a
+        # list to an instance of data_cls.
+        yield from count_rows(
+            map(row_converter(data_cls, column_types), reader),
+            'load %s' % filename,
+            # Progress is the position in the file, which is read ahead of
+            # the rows by at most a buffer.
+            progress=lambda: f.buffer.tell() / max(file_size, 1))
+
+
+def _load_data_file(data_dir, filename, data_cls, column_types=None):
     """Load a data file, returning a list of dicts.
 
     Loads a data file in the USDA FDC data dump format.  Each
@@ -35,24 +71,38 @@ def _load_data_file(data_dir, filename, data_cls):
     Args:
         data_dir: The directory containing USDA data.
         data_cls: The namedtuple for this data file.
+        column_types: If set, a dict of the columns to keep and their
+            types (see `file_schemas.row_converter`).
 
     Returns:
         A list of dicts, whose keys are the column names.
     """
-    print('loading file: %s' % filename)
-    with open(os.path.join(data_dir, filename)) as f:
-        reader = csv.reader(f)
-        header_row = next(reader)
-        print (header_row)
-        print (data_cls._fields)
-        # Verify the header rows match the fields
-        assert header_row == list(data_cls._fields)
-        # For each row after the header row, convert from a
-        # list to an instance of data_cls.
-        return list(map(data_cls._make, reader))
+    return list(_iter_data_file(data_dir, filename, data_cls, column_types))
+
+
+class _DataFileStream(object):
+    """An iterable over the rows of a data file.
+
+    Each call to `__iter__` re-opens and re-reads the file, so the
+    rows are never all held in memory at once but the file can still
+    be iterated over more than once.
+    """
+
+    def __init__(self, data_dir, filename, data_cls, column_types=None,
+                 iter_fn=_iter_data_file):
+        self.data_dir = data_dir
+        self.filename = filename
+        self.data_cls = data_cls
+        self.column_types = column_types
+        self.iter_fn = iter_fn
+
+    def __iter__(self):
+        return self.iter_fn(
+            self.data_dir, self.filename, self.data_cls, self.column_types)
 
 
-def load_raw_data(data_dir):
+def load_raw_data(data_dir, streaming=False, cache_dir=None, processes=None,
+                  compact=False, columns=None):
     """Load raw CSV data.
 
     Loads raw CSV data, converting to RawData.  RawData is a
@@ -71,17 +121,80 @@ def load_raw_data(data_dir):
     from there into the directory containing Branded Food data.
     Currently from the supporting data, only nutrient.csv is
     used.
+
+    Args:
+        data_dir: The directory containing USDA data.
+        streaming: If True, each file is represented as an iterable
+            that reads rows from disk as it is iterated over, instead
+            of as a list.  Use this with `iter_merged_sources` to avoid
+            holding the whole dataset in memory.
+        cache_dir: If set, a directory used to cache parsed files (see
+            `raw_data_cache`).  Files loaded from the cache are sequences
+            that decode rows from memory-mapped arrays as they are
+            accessed, so they can be used whether or not `streaming` is set.
+        processes: If greater than 1, large files are parsed using this
+            many processes (see `parallel_csv`).  When streaming, rows
+            are still yielded in order, with only a few blocks of the file
+            per process parsed ahead of them.
+        compact: If True, `food_nutrients` is loaded as a
+            `CompactFoodNutrients`, which stores only the columns used by
+            `merge_sources` as typed arrays.  The rows are read one at a
+            time (or from the cache), so the full file is never held in
+            memory as namedtuples.
+        columns: If set, a dict declaring which files and columns are
+            needed, such as `merge_sources.MERGE_COLUMNS`.  The keys are
+            fields of `RawData` and the values are dicts mapping column
+            names to types (see `file_schemas.row_converter`).  Files that
+            are not included are not loaded and are None in the result,
+            and each row only has the included columns, already converted
+            to their types.
     """
-    return RawData(
-        branded_foods=_load_data_file(
-            data_dir, 'branded_food.csv', BrandedFood),
-        food_nutrients=_load_data_file(
-            data_dir, 'food_nutrient.csv', FoodNutrient),
-        food_attributes=_load_data_file(
-            data_dir, 'food_attribute.csv', FoodAttribute),
-        food_update_log_entries=_load_data_file(
-            data_dir, 'food_update_log_entry.csv', FoodUpdateLogEntry),
-        foods=_load_data_file(
-            data_dir, 'food.csv', Food),
-        nutrients=_load_data_file(
-            data_dir, 'nutrient.csv', Nutrient))
+    if processes is not None and processes > 1:
+        def parse_fn(data_dir, filename, data_cls, column_types=None):
+            return load_data_file_in_parallel(
+                data_dir, filename, data_cls, processes,
+                row_converter(data_cls, column_types))
+
+        def iter_fn(data_dir, filename, data_cls, column_types=None):
+            return iter_data_file_in_parallel(
+                data_dir, filename, data_cls, processes,
+                row_converter(data_cls, column_types))
+    else:
+        parse_fn = _load_data_file
+        iter_fn = _iter_data_file
+
+    if cache_dir is not None:
+        # Imported here because the cache requires NumPy, which is not
+        # otherwise needed.
+        from .raw_data_cache import load_cached_data_file
+
+        def load_fn(data_dir, filename, data_cls, column_types=None):
+            return load_cached_data_file(
+                data_dir, filename, data_cls, cache_dir,
+                _iter_data_file if parse_fn is _load_data_file else parse_fn,
+                column_types)
+    elif streaming:
+        def load_fn(data_dir, filename, data_cls, column_types=None):
+            return _DataFileStream(
+                data_dir, filename, data_cls, column_types, iter_fn)
+    else:
+        load_fn = parse_fn
+
+    def load_file(field):
+        filename, data_cls = RAW_DATA_FILES[field]
+        if columns is None:
+            column_types = None
+        elif field in columns:
+            column_types = columns[field]
+        else:
+            print('skipping file: %s' % filename)
+            return None
+        if compact and data_cls is FoodNutrient:
+            # The compact representation is built from the unconverted rows.
+            return CompactFoodNutrients.from_rows(
+                (load_fn if cache_dir is not None else iter_fn)(
+                    data_dir, filename, data_cls),
+                column_types)
+        return load_fn(data_dir, filename, data_cls, column_types)
+
+    return RawData(**{field: load_file(field) for field in RAW_DATA_FILES})
@@ -0,0 +1,191 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Functions to merge data files using a sort-merge join.
+
+`merge_sources` indexes every food nutrient by fdc_id before merging, which
+requires holding all of `food_nutrient.csv` in memory.  The functions here
+instead iterate over `branded_food.csv`, `food.csv` and `food_nutrient.csv`
+in order of fdc_id, so that only the rows for a single food are held in
+memory at a time.
+
+The FDC data dumps are usually sorted by fdc_id already.  Each file is first
+checked for this, and if it is not sorted it is sorted on disk by splitting
+it into sorted chunks, which are then merged.  The check is a separate pass,
+so each file is read (and, when streaming, parsed) twice even when it is
+sorted.  It can't be done while merging, since a row that is out of order
+may belong to a food that has already been merged.
+"""
+import heapq
+import itertools
+import os
+import pickle
+import tempfile
+
+from .instrumentation import count_rows
+from .merge_sources import _convert_nutrient
+from .merge_sources import _merge
+
+
+# Number of rows in each sorted chunk when sorting a file on disk.
+_DEFAULT_CHUNK_SIZE = 1000000
+# Number of rows pickled together when writing a chunk.
+_PICKLE_BATCH_SIZE = 10000
+
+
+def _fdc_id_key(row):
+    return int(row.fdc_id)
+
+
+def _is_sorted_by_fdc_id(rows):
+    """Return True if `rows` are in (non-strict) increasing order of fdc_id."""
+    previous_key = None
+    for row in rows:
+        key = _fdc_id_key(row)
+        if previous_key is not None and key < previous_key:
+            return False
+        previous_key = key
+    return True
+
+
+def _write_chunk(rows, chunk_dir, chunk_index):
+    """Write a list of rows to a file, returning the filename.
+
+    Rows are written as plain tuples, so that rows with typed values (see
+    `load_raw_data(..., columns=...)`) are read back unchanged.
+    """
+    filename = os.path.join(chunk_dir, 'chunk_%d.pickle' % chunk_index)
+    with open(filename, 'wb') as f:
+        for start in range(0, len(rows), _PICKLE_BATCH_SIZE):
+            batch = rows[start:start + _PICKLE_BATCH_SIZE]
+            pickle.dump(
+                [tuple(row) for row in batch], f, pickle.HIGHEST_PROTOCOL)
+    return filename
+
+
+def _read_chunk(filename, row_cls):
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from map(row_cls._make, batch)
+
+
+def _sorted_by_fdc_id(rows, tmp_dir, chunk_size):
+    """Iterate over rows in order of fdc_id.
+
+    The sort is stable, so rows with the same fdc_id are returned in the
+    order they appear in `rows`.
+
+    `rows` is first iterated over in full to check whether it is already
+    sorted, and then again to yield (or sort) the rows.  For a file loaded
+    with `load_raw_data(..., streaming=True)` this parses the file twice;
+    load it from a cache (see `raw_data_cache`) to avoid this.
+
+    Args:
+        rows: An iterable of namedtuples with an fdc_id field.  This is
+            iterated over twice, so it must not be an iterator.
+        tmp_dir: The directory to write sorted chunks to, or None to use
+            the system default.
+        chunk_size: The number of rows in each sorted chunk.
+
+    Yields:
+        The rows in `rows`, in order of fdc_id.
+    """
+    if _is_sorted_by_fdc_id(rows):
+        yield from rows
+        return
+    row_cls = None
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as chunk_dir:
+        chunk_filenames = []
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            if row_cls is None:
+                row_cls = type(chunk[0])
+                print('sorting %s rows by fdc_id' % row_cls.__name__)
+            chunk.sort(key=_fdc_id_key)
+            chunk_filenames.append(
+                _write_chunk(chunk, chunk_dir, len(chunk_filenames)))
+            del chunk
+        # `heapq.merge` returns equal elements from earlier iterables first,
+        # which keeps the sort stable across chunks.
+        yield from heapq.merge(
+            *(_read_chunk(filename, row_cls)
+              for filename in chunk_filenames),
+            key=_fdc_id_key)
+
+
+def iter_merge_joined_sources(
+        raw_data, tmp_dir=None, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """Merge all the sources in raw_data using a sort-merge join.
+
+    Produces the same JSON-like objects as `merge_sources`, but only holds
+    the rows for a single food in memory at once (in addition to the small
+    `nutrients` table).  Foods are produced in order of fdc_id, which is the
+    same order as `merge_sources` when `branded_food.csv` is sorted.
+
+    Args:
+        raw_data: A `RawData`.  Each field used is iterated over more than
+            once (see `_sorted_by_fdc_id`), so this should be loaded with
+            `streaming=True` (or be made of lists, or from a cache).
+        tmp_dir: The directory to write temporary files to when a file has
+            to be sorted, or None to use the system default.
+        chunk_size: The number of rows to sort in memory at once when a file
+            has to be sorted.
+
+    Yields:
+        JSON-like objects, in order of fdc_id.
+    """
+    print('merging raw data rows using sort-merge join')
+    nutrients = {
+        nutrient.nutrient_nbr: _convert_nutrient(nutrient)
+        for nutrient in raw_data.nutrients}
+
+    def grouped(rows):
+        return itertools.groupby(
+            _sorted_by_fdc_id(rows, tmp_dir, chunk_size), key=_fdc_id_key)
+
+    food_groups = grouped(raw_data.foods)
+    food_nutrient_groups = grouped(raw_data.food_nutrients)
+    # The current group of each file.  The group is kept until a later
+    # fdc_id is requested, so that branded foods with a repeated fdc_id see
+    # the same rows as they would in `merge_sources`.
+    food_key, food = -1, None
+    food_nutrients_key, food_nutrients = -1, []
+
+    for branded_food in count_rows(
+            _sorted_by_fdc_id(raw_data.branded_foods, tmp_dir, chunk_size),
+            'merge'):
+        key = _fdc_id_key(branded_food)
+        while food_key < key:
+            food_key, group = next(food_groups, (None, None))
+            if food_key is None:
+                break
+            # As in `merge_sources`, the last row for an fdc_id wins.
+            for food in group:
+                pass
+        if food_key != key:
+            raise KeyError(branded_food.fdc_id)
+        while food_nutrients_key is not None and food_nutrients_key < key:
+            food_nutrients_key, group = next(food_nutrient_groups, (None, ()))
+            food_nutrients = list(group)
+        yield _merge(
+            branded_food,
+            food,
+            food_nutrients if food_nutrients_key == key else [],
+            nutrients)
@@ -17,15 +17,65 @@ This produces an output which is a list of JSON like objects
 with the same format as the FoodDataCentral API.
 """
 from collections import defaultdict
-from datetime import datetime
+
+from .compact_tables import CompactFoodNutrients
+from .dates import file_date_to_api_date
+from .instrumentation import count_rows
+
+
+# The files and columns used by `merge_sources`, and their types.  Pass this
+# as the `columns` argument of `load_raw_data` to skip loading anything else,
+# and to convert values to their types once, when they are loaded.
+MERGE_COLUMNS = {
+    'branded_foods': {
+        'fdc_id': int,
+        'brand_owner': str,
+        'brand_name': str,
+        'subbrand_name': str,
+        'gtin_upc': str,
+        'ingredients': str,
+        'not_a_significant_source_of': str,
+        'serving_size': float,
+        'serving_size_unit': str,
+        'household_serving_fulltext': str,
+        'branded_food_category': str,
+        'data_source': str,
+        'modified_date': str,
+        'available_date': str,
+        'market_country': str,
+        'discontinued_date': str,
+    },
+    'food_nutrients': {
+        'id': int,
+        'fdc_id': int,
+        'nutrient_id': str,
+        'amount': float,
+    },
+    'foods': {
+        'fdc_id': int,
+        'data_type': str,
+        'description': str,
+        'publication_date': str,
+    },
+    'nutrients': {
+        'id': int,
+        'name': str,
+        'unit_name': str,
+        'nutrient_nbr': str,
+        'rank': int,
+    },
+}
 
 
-def _convert_date_format(d):
-    """Convert from file format to API format."""
-    if not d:
+def _convert_optional(value, convert):
+    """Convert a value that may be missing.
+
+    Missing values are '' when loaded as strings and None when loaded with
+    a type (see `MERGE_COLUMNS`).
+    """
+    if value is None or value == '':
         return None
-    dt = datetime.strptime(d, '%Y-%m-%d')
-    return '%d/%d/%d' % (dt.month, dt.day, dt.year)
+    return convert(value)
 
 
 _NEW_UNIT_NAMES = {
@@ -51,7 +101,7 @@ def _convert_nutrient(nutrient):
         'name': nutrient.name,
         'unitName': _NEW_UNIT_NAMES.get(nutrient.unit_name, _UNKNOWN_UNIT),
         'nutrient_nbr': nutrient.nutrient_nbr,
-        'rank': int(nutrient.rank) if nutrient.rank else None
+        'rank': _convert_optional(nutrient.rank, int)
     })
 
 
@@ -86,16 +136,16 @@ def _merge(branded_food, food, food_nutrients, nutrients):
         'dataSource': branded_food.data_source,
         'ingredients': branded_food.ingredients,
         "marketCountry": branded_food.market_country,
-        'modifiedDate': _convert_date_format(branded_food.modified_date),
-        'availableDate': _convert_date_format(branded_food.available_date),
-        'discontinuedDate': _convert_date_format(branded_food.discontinued_date),
-        'servingSize': float(branded_food.serving_size) if branded_food.serving_size else None,
+        'modifiedDate': file_date_to_api_date(branded_food.modified_date),
+        'availableDate': file_date_to_api_date(branded_food.available_date),
+        'discontinuedDate': file_date_to_api_date(branded_food.discontinued_date),
+        'servingSize': _convert_optional(branded_food.serving_size, float),
         'servingSizeUnit': branded_food.serving_size_unit or None,
         'householdServingFullText': branded_food.household_serving_fulltext or None,
         'brandedFoodCategory': branded_food.branded_food_category,
         'fdcId': int(branded_food.fdc_id),
         'dataType': 'Branded',
-        'publicationDate': _convert_date_format(food.publication_date),
+        'publicationDate': file_date_to_api_date(food.publication_date),
         'foodPortions': [],
         # additions
         'brand_name': branded_food.brand_name,
@@ -106,19 +156,29 @@ def _merge(branded_food, food, food_nutrients, nutrients):
     })
 
 
-def merge_sources(raw_data):
-    """Merge all the sources in raw_data.
+def iter_merged_sources(raw_data, fdc_ids=None):
+    """Merge all the sources in raw_data, yielding one food at a time.
 
-    Each field in raw_data represents a single CSV file.  This function
-    merges these into a single list, where each element of the list is
-    a JSON-like object containing the same data as the output of the
-    FoodDataCentral API.
+    Like `merge_sources` but returns a generator, so that merged foods
+    can be consumed (e.g. written to a file) as they are produced.  The
+    branded foods are iterated over exactly once, so this can be used with
+    `load_raw_data(..., streaming=True)`.
+
+    This is a hash join, so the lookup tables for foods, nutrients and food
+    nutrients are held in memory.  The food nutrients table has a row for
+    every row of food_nutrient.csv (unless `fdc_ids` is set), so memory
+    still grows with the size of the dataset.  Use
+    `merge_join.iter_merge_joined_sources` for memory that is bounded
+    independently of the dataset size.
 
     Args:
         raw_data: A `RawData`.
+        fdc_ids: If set, a set of fdc_ids (with the same type as the fdc_id
+            field of the raw data rows).  Only foods with these fdc_ids are
+            merged, and only their food nutrients are held in memory.
 
-    Returns:
-        A list of JSON-like objects.
+    Yields:
+        JSON-like objects, in the order of `raw_data.branded_foods`.
     """
     print('merging raw data rows')
     # Convert branded_food_data.foods to dict for merging.
@@ -131,14 +191,34 @@ def merge_sources(raw_data):
         nutrient.nutrient_nbr: _convert_nutrient(nutrient)
         for nutrient in raw_data.nutrients}
 
-    food_nutrients = defaultdict(list)
-    for food_nutrient in raw_data.food_nutrients:
-        food_nutrients[food_nutrient.fdc_id].append(food_nutrient)
+    if isinstance(raw_data.food_nutrients, CompactFoodNutrients):
+        food_nutrients = raw_data.food_nutrients.grouped_by_fdc_id()
+    else:
+        food_nutrients = defaultdict(list)
+        for food_nutrient in raw_data.food_nutrients:
+            if fdc_ids is None or food_nutrient.fdc_id in fdc_ids:
+                food_nutrients[food_nutrient.fdc_id].append(food_nutrient)
 
-    result = []
-    for branded_food in raw_data.branded_foods:
+    for branded_food in count_rows(raw_data.branded_foods, 'merge'):
         fdc_id = branded_food.fdc_id
-        result.append(_merge(
-            branded_food, foods[fdc_id], food_nutrients[fdc_id], nutrients))
+        if fdc_ids is not None and fdc_id not in fdc_ids:
+            continue
+        yield _merge(
+            branded_food, foods[fdc_id], food_nutrients[fdc_id], nutrients)
+
 
-    return result
+def merge_sources(raw_data):
+    """Merge all the sources in raw_data.
+
+    Each field in raw_data represents a single CSV file.  This function
+    merges these into a single list, where each element of the list is
+    a JSON-like object containing the same data as the output of the
+    FoodDataCentral API.
+
+    Args:
+        raw_data: A `RawData`.
+
+    Returns:
+        A list of JSON-like objects.
+    """
+    return list(iter_merged_sources(raw_data))
@@ -0,0 +1,186 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streaming statistics of the amounts of each nutrient.
+
+Amounts are added in chunks, and the statistics of each chunk are computed
+with NumPy for all nutrients at once, then combined with the statistics so
+far.  For each nutrient this keeps the count, min, max, mean and sum of
+squared deviations (combined using the parallel algorithm of Chan et al.),
+and a histogram of amounts with logarithmically sized buckets, from which
+quantiles are estimated with a relative error of at most
+`_RELATIVE_ACCURACY`.  The number of buckets depends only on the range of
+amounts, not on the number of amounts.
+
+Statistics of different parts of the data can be combined with `merge`.
+
+This module requires NumPy.
+"""
+from collections import Counter
+import math
+
+import numpy as np
+
+
+# Relative accuracy of quantile estimates.
+_RELATIVE_ACCURACY = 0.01
+_GAMMA = (1 + _RELATIVE_ACCURACY) / (1 - _RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+# Bucket indices are clipped to +/- this, which covers amounts from about
+# 1e-86 to 1e86.
+_MAX_BUCKET = 10000
+# Bucket keys are 0 for zero, _BUCKET_OFFSET + index for positive amounts
+# and -(_BUCKET_OFFSET + index) for negative amounts, so that keys are in
+# the same order as the amounts in them.
+_BUCKET_OFFSET = _MAX_BUCKET + 1
+
+# The quantiles written by `write_nutrient_stats`.
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+def _bucket_keys(amounts):
+    magnitudes = np.abs(amounts)
+    nonzero = magnitudes > 0
+    indices = np.zeros(len(amounts), dtype=np.int64)
+    indices[nonzero] = np.clip(
+        np.ceil(np.log(magnitudes[nonzero]) / _LOG_GAMMA),
+        -_MAX_BUCKET, _MAX_BUCKET)
+    signs = np.sign(amounts).astype(np.int64)
+    return np.where(nonzero, signs * (indices + _BUCKET_OFFSET), 0)
+
+
+def _bucket_value(key):
+    """An amount in the bucket with this key, within the relative accuracy."""
+    if key == 0:
+        return 0.0
+    value = 2 * _GAMMA ** (abs(key) - _BUCKET_OFFSET) / (_GAMMA + 1)
+    return value if key > 0 else -value
+
+
+class _Moments(object):
+    """The statistics of the amounts of a single nutrient."""
+
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        # The sum of squared deviations from the mean.
+        self.m2 = 0.0
+        # A `Counter` from bucket key to number of amounts.
+        self.buckets = Counter()
+
+    def merge(self, count, min_, max_, mean, m2, buckets):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, min_)
+        self.max = max(self.max, max_)
+        self.buckets.update(buckets)
+
+    @property
+    def variance(self):
+        """The sample variance."""
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def quantile(self, q):
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return min(max(_bucket_value(key), self.min), self.max)
+        return self.max
+
+
+class NutrientStatistics(object):
+    """Statistics of the amounts of each nutrient."""
+
+    def __init__(self):
+        # A dict from nutrient_id to `_Moments`.
+        self.moments = {}
+
+    def add_chunk(self, nutrient_ids, amounts):
+        """Add the amounts in a chunk of food nutrients.
+
+        Args:
+            nutrient_ids: A sequence of nutrient ids.
+            amounts: A sequence of the amount for each nutrient id.
+        """
+        if not len(amounts):
+            return
+        keys, inverse = np.unique(
+            np.asarray(nutrient_ids), return_inverse=True)
+        amounts = np.asarray(amounts, dtype=np.float64)
+        num_keys = len(keys)
+        counts = np.bincount(inverse, minlength=num_keys)
+        means = np.bincount(
+            inverse, weights=amounts, minlength=num_keys) / counts
+        m2s = np.bincount(
+            inverse, weights=(amounts - means[inverse]) ** 2,
+            minlength=num_keys)
+        mins = np.full(num_keys, np.inf)
+        np.minimum.at(mins, inverse, amounts)
+        maxs = np.full(num_keys, -np.inf)
+        np.maximum.at(maxs, inverse, amounts)
+        # Count amounts by (nutrient, bucket).
+        pairs, pair_counts = np.unique(
+            np.stack([inverse, _bucket_keys(amounts)], axis=1),
+            axis=0, return_counts=True)
+        buckets = [{} for _ in range(num_keys)]
+        for (index, key), count in zip(pairs.tolist(), pair_counts.tolist()):
+            buckets[index][key] = count
+        for index, nutrient_id in enumerate(keys.tolist()):
+            self._moments(nutrient_id).merge(
+                int(counts[index]), float(mins[index]), float(maxs[index]),
+                float(means[index]), float(m2s[index]), buckets[index])
+
+    def _moments(self, nutrient_id):
+        moments = self.moments.get(nutrient_id)
+        if moments is None:
+            moments = self.moments[nutrient_id] = _Moments()
+        return moments
+
+    def merge(self, other):
+        """Add the statistics of another `NutrientStatistics`."""
+        for nutrient_id, moments in other.moments.items():
+            if moments.count:
+                self._moments(nutrient_id).merge(
+                    moments.count, moments.min, moments.max, moments.mean,
+                    moments.m2, moments.buckets)
+
+
+def write_nutrient_stats(nutrient_stats, nutrients, csv_writer):
+    """Write statistics of the amounts of each nutrient.
+
+    Args:
+        nutrient_stats: A `NutrientStatistics`.
+        nutrients: A dict from nutrient id to the nutrient, as in
+            `merge_sources`.
+        csv_writer: A `csv.writer`.
+    """
+    print('writing statistics of nutrient amounts')
+    csv_writer.writerow(
+        ['id', 'name', 'unit', 'count', 'min', 'max', 'mean', 'variance'] +
+        ['p%g' % (100 * q) for q in QUANTILES])
+    for nutrient, moments in sorted(
+            ((nutrients[nutrient_id], moments)
+             for nutrient_id, moments in nutrient_stats.moments.items()),
+            key=lambda item: item[0]['id']):
+        csv_writer.writerow(
+            [nutrient['id'], nutrient['name'], nutrient['unitName'],
+             str(moments.count), str(moments.min), str(moments.max),
+             str(moments.mean), str(moments.variance)] +
+            [str(moments.quantile(q)) for q in QUANTILES])
@@ -0,0 +1,380 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Functions to parse large CSV files using multiple processes.
+
+A file is split into byte ranges that start and end at row boundaries, and
+each range is parsed by a separate process.  Because quoted fields may
+contain newlines, a newline is only a row boundary if it is preceded by an
+even number of quote characters.  This holds for any CSV file where quotes
+only appear in quoted fields (escaped as a pair of quotes), which is the case
+for the FDC data files.
+
+So that no process has to read the whole file, the file is first cut into
+chunks at approximate offsets, and the quotes in each chunk are counted in
+parallel.  This gives the parity of the number of quotes before each offset,
+from which a process can find the first row boundary after an offset by
+reading just past it.
+"""
+import concurrent.futures
+import csv
+import io
+import os
+
+from .instrumentation import count_rows
+from .instrumentation import traced_stage
+
+# Files smaller than this are parsed in a single process.
+_MIN_PARALLEL_FILE_SIZE = 64 * 1024 * 1024
+# Number of ranges per process, more ranges than processes helps to balance
+# the load when some ranges are slower to parse than others.
+_RANGES_PER_PROCESS = 4
+# Size of blocks read when searching for row boundaries.
+_BLOCK_SIZE = 16 * 1024 * 1024
+# Size of blocks read when searching for the row boundary after an offset,
+# which is usually close to it.
+_SEARCH_BLOCK_SIZE = 64 * 1024
+# Approximate size of the ranges parsed when streaming rows, which bounds
+# the rows held in memory.
+_STREAM_RANGE_SIZE = 4 * 1024 * 1024
+# Number of ranges being parsed ahead of the rows being consumed when
+# streaming, per process.
+_STREAM_RANGES_PER_PROCESS = 2
+
+
+def find_row_boundaries(filename, offsets, start=0):
+    """Find the first row boundary at or after each of the given offsets.
+
+    Args:
+        filename: The name of a CSV file.
+        offsets: An increasing list of byte offsets into the file.
+        start: A row boundary to start searching from, which must be before
+            all of `offsets`.  Only the file after this offset is read.
+
+    Returns:
+        An increasing list of the byte offsets of the starts of rows, without
+        duplicates.  There is at most one for each offset, and there is none
+        for offsets that are after the start of the last row.
+    """
+    boundaries = []
+    offsets = iter(offsets)
+    target = next(offsets, None)
+    # Number of quotes in the file between `start` and `block_start`.
+    quote_count = 0
+    block_start = start
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        while target is not None:
+            block = f.read(_BLOCK_SIZE)
+            if not block:
+                break
+            search_from = 0
+            while target is not None:
+                newline = block.find(
+                    b'\n', max(target - block_start, search_from))
+                if newline == -1:
+                    break
+                if (quote_count + block.count(b'"', 0, newline)) % 2 == 0:
+                    boundary = block_start + newline + 1
+                    boundaries.append(boundary)
+                    while target is not None and target < boundary:
+                        target = next(offsets, None)
+                search_from = newline + 1
+            quote_count += block.count(b'"')
+            block_start += len(block)
+    file_size = os.path.getsize(filename)
+    return [boundary for boundary in boundaries if boundary < file_size]
+
+
+def _count_quotes(filename, start, end):
+    """Return the number of quote characters in a byte range of a file."""
+    count = 0
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            count += block.count(b'"')
+            remaining -= len(block)
+    return count
+
+
+def _next_row_start(f, offset, quote_parity):
+    """Find the first row boundary after an offset.
+
+    Args:
+        f: The CSV file, opened in binary mode.
+        offset: A byte offset into the file.
+        quote_parity: The parity of the number of quote characters in the
+            file before `offset`.
+
+    Returns:
+        The byte offset of the start of the first row that starts after
+        `offset`, or the size of the file if there is none.
+    """
+    f.seek(offset)
+    block_start = offset
+    while True:
+        block = f.read(_SEARCH_BLOCK_SIZE)
+        if not block:
+            return block_start
+        position = 0
+        while True:
+            newline = block.find(b'\n', position)
+            if newline == -1:
+                break
+            quote_parity = (
+                quote_parity + block.count(b'"', position, newline)) % 2
+            if quote_parity == 0:
+                return block_start + newline + 1
+            position = newline + 1
+        quote_parity = (quote_parity + block.count(b'"', position)) % 2
+        block_start += len(block)
+
+
+def _approximate_ranges(filename, num_ranges, executor=None):
+    """Cut the rows of a CSV file into ranges at approximate offsets.
+
+    Args:
+        filename: The name of a CSV file.
+        num_ranges: The number of ranges.
+        executor: If set, an executor used to count quotes in parallel, in
+            files of at least `_MIN_PARALLEL_FILE_SIZE`.
+
+    Returns:
+        A pair of the end of the header row, and a list of `(start,
+        start_parity, end, end_parity)` for each range, where `start` and
+        `end` are byte offsets, and the parities are the parity of the
+        number of quotes before them.  A parity of None means that the
+        offset is already a row boundary (the end of the header row or the
+        end of the file).  `_resolve_range` finds the rows in a range.
+    """
+    file_size = os.path.getsize(filename)
+    header_end = (find_row_boundaries(filename, [0]) or [file_size])[0]
+    body_size = file_size - header_end
+    offsets = sorted(set(
+        header_end + (body_size * i) // num_ranges
+        for i in range(1, num_ranges)))
+    chunk_starts = [0] + offsets[:-1]
+    if executor is not None and file_size >= _MIN_PARALLEL_FILE_SIZE:
+        map_fn = executor.map
+    else:
+        map_fn = map
+    counts = map_fn(
+        _count_quotes, [filename] * len(offsets), chunk_starts, offsets)
+    parities = []
+    total = 0
+    for count in counts:
+        total += count
+        parities.append(total % 2)
+    starts = [(header_end, None)] + list(zip(offsets, parities))
+    ends = list(zip(offsets, parities)) + [(file_size, None)]
+    return header_end, [start + end for start, end in zip(starts, ends)]
+
+
+def _resolve_range(f, start, start_parity, end, end_parity):
+    """Return the row boundaries of a range from `_approximate_ranges`.
+
+    Every row is in exactly one of the resolved ranges, some of which may
+    be empty.
+    """
+    if start_parity is not None:
+        start = _next_row_start(f, start, start_parity)
+    if end_parity is not None:
+        end = _next_row_start(f, end, end_parity)
+    return start, max(start, end)
+
+
+def split_into_ranges(filename, num_ranges, executor=None):
+    """Split a CSV file into byte ranges at row boundaries.
+
+    Args:
+        filename: The name of a CSV file.
+        num_ranges: The number of ranges to split the rows after the header
+            row into.  Fewer ranges may be returned for small files.
+        executor: If set, an executor used to read large files in
+            parallel.
+
+    Returns:
+        A pair of the end of the header row, and a list of `(start, end)`
+        pairs of byte offsets, which cover all the rows after the header row.
+    """
+    header_end, approximate_ranges = _approximate_ranges(
+        filename, num_ranges, executor)
+    with open(filename, 'rb') as f:
+        ranges = [
+            _resolve_range(f, *approximate_range)
+            for approximate_range in approximate_ranges]
+    return header_end, [(start, end) for start, end in ranges if start < end]
+
+
+def _parse_range(filename, start, end):
+    """Parse the rows in a byte range of a CSV file, returning a list."""
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # Decode with the same encoding and newline translation that `open`
+    # uses in text mode, so that the result is the same as reading the
+    # whole file with `csv.reader(open(filename))`.
+    return list(csv.reader(io.TextIOWrapper(io.BytesIO(data))))
+
+
+def _parse_approximate_range(filename, start, start_parity, end, end_parity):
+    """Parse the rows in a range from `_approximate_ranges`."""
+    with open(filename, 'rb') as f:
+        start, end = _resolve_range(f, start, start_parity, end, end_parity)
+    return _parse_range(filename, start, end) if start < end else []
+
+
+def iter_rows_in_range(filename, start, end):
+    """Iterate over the rows in a byte range of a CSV file.
+
+    The range is parsed a block at a time, so that only a block of rows is
+    held in memory at once.
+
+    Args:
+        filename: The name of a CSV file.
+        start: The byte offset of the start of a row.
+        end: The byte offset of the start of a later row, or the end of the
+            file.
+
+    Yields:
+        Lists of the string values of each row.
+    """
+    boundaries = [
+        boundary for boundary in find_row_boundaries(
+            filename, range(start + _BLOCK_SIZE, end, _BLOCK_SIZE), start)
+        if boundary < end]
+    for block_start, block_end in zip(
+            [start] + boundaries, boundaries + [end]):
+        yield from _parse_range(filename, block_start, block_end)
+
+
+def check_header(filename, header_end, data_cls):
+    """Check the header row of a CSV file matches a schema.
+
+    Args:
+        filename: The name of a CSV file.
+        header_end: The byte offset of the end of the header row, as
+            returned by `split_into_ranges`.
+        data_cls: The namedtuple for this data file.
+    """
+    header_row = next(iter(_parse_range(filename, 0, header_end)), [])
+    # Verify the header rows match the fields
+    assert header_row == list(data_cls._fields), (header_row, data_cls)
+
+
+def load_data_file_in_parallel(data_dir, filename, data_cls, processes,
+                               convert_row=None):
+    """Load a data file using multiple processes.
+
+    Returns the same result as `_load_data_file` in `load_raw_data`.  Files
+    smaller than `_MIN_PARALLEL_FILE_SIZE` are parsed in this process.
+
+    Args:
+        data_dir: The directory containing USDA data.
+        filename: The name of the file within `data_dir`.
+        data_cls: The namedtuple for this data file.
+        processes: The number of processes to use.
+        convert_row: A function converting a list of strings to a row, or
+            None to use `data_cls._make`.
+
+    Returns:
+        A list of instances of `data_cls` (or the results of `convert_row`),
+        in the order they appear in the file.
+    """
+    if convert_row is None:
+        convert_row = data_cls._make
+    print('loading file: %s' % filename)
+    path = os.path.join(data_dir, filename)
+    with traced_stage('load %s' % filename) as stage:
+        if os.path.getsize(path) < _MIN_PARALLEL_FILE_SIZE:
+            header_end, ranges = split_into_ranges(path, 1)
+            check_header(path, header_end, data_cls)
+            result = [
+                convert_row(row)
+                for start, end in ranges
+                for row in _parse_range(path, start, end)]
+        else:
+            result = []
+            with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+                header_end, ranges = _approximate_ranges(
+                    path, processes * _RANGES_PER_PROCESS, executor)
+                check_header(path, header_end, data_cls)
+                # `map` returns results in the order of `ranges`.
+                for rows in executor.map(
+                        _parse_approximate_range,
+                        *zip(*((path,) + r for r in ranges))):
+                    result.extend(map(convert_row, rows))
+                    stage.add(len(rows))
+        stage.set_rows(len(result))
+    return result
+
+
+def iter_data_file_in_parallel(data_dir, filename, data_cls, processes,
+                               convert_row=None):
+    """Iterate over the rows of a data file, parsing them in parallel.
+
+    Like `load_data_file_in_parallel`, but the file is parsed in small
+    ranges, and only a few ranges per process are parsed ahead of the rows
+    that have been consumed, so the rows are never all held in memory.
+    Files smaller than `_MIN_PARALLEL_FILE_SIZE` are parsed in this
+    process.
+
+    Args:
+        data_dir, filename, data_cls, processes, convert_row: As for
+            `load_data_file_in_parallel`.
+
+    Yields:
+        Instances of `data_cls` (or the results of `convert_row`), in the
+        order they appear in the file.
+    """
+    if convert_row is None:
+        convert_row = data_cls._make
+    print('loading file: %s' % filename)
+    path = os.path.join(data_dir, filename)
+    file_size = os.path.getsize(path)
+    if file_size < _MIN_PARALLEL_FILE_SIZE:
+        header_end, ranges = split_into_ranges(path, 1)
+        check_header(path, header_end, data_cls)
+        yield from count_rows(
+            (convert_row(row)
+             for start, end in ranges
+             for row in iter_rows_in_range(path, start, end)),
+            'load %s' % filename)
+        return
+    num_ranges = max(
+        processes * _RANGES_PER_PROCESS,
+        -(-file_size // _STREAM_RANGE_SIZE))
+    max_pending = processes * _STREAM_RANGES_PER_PROCESS
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        header_end, ranges = _approximate_ranges(path, num_ranges, executor)
+        check_header(path, header_end, data_cls)
+
+        def iter_rows():
+            ranges_iter = iter(ranges)
+            pending = []
+            while True:
+                # Keep `max_pending` ranges being parsed, in order.
+                for approximate_range in ranges_iter:
+                    pending.append(executor.submit(
+                        _parse_approximate_range, path, *approximate_range))
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    return
+                yield from map(convert_row, pending.pop(0).result())
+
+        yield from count_rows(iter_rows(), 'load %s' % filename)
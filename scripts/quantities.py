@@ -0,0 +1,132 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Functions to parse and canonicalize quantities, e.g. "1 cup".
+
+These behave the same as `parseQuantity` and `canonicalizeQuantity` in
+src/core, so that nutrients computed here match those computed by the
+add-on.
+"""
+from collections import namedtuple
+import math
+import re
+
+
+Quantity = namedtuple('Quantity', ['amount', 'unit'])
+
+# Config for `canonicalize_quantity`, with the same fields as
+# `CanonicalizeQuantityConfig` (massUnits and volumeUnits in the JSON
+# config).
+CanonicalizeQuantityConfig = namedtuple(
+    'CanonicalizeQuantityConfig', ['mass_units', 'volume_units'])
+
+# The values of unicode fractions.  These are the same as in
+# parseQuantity.ts, including the values for ⅛ and ⅝.
+_FRACTION_VALUES = {
+    '': 0,
+    '½': 1 / 2,
+    '⅓': 1 / 3,
+    '⅔': 2 / 3,
+    '¼': 1 / 4,
+    '¾': 3 / 4,
+    '⅕': 1 / 5,
+    '⅖': 2 / 5,
+    '⅗': 3 / 5,
+    '⅘': 4 / 5,
+    '⅙': 1 / 6,
+    '⅚': 5 / 6,
+    '⅐': 1 / 7,
+    '⅛': 3 / 8,
+    '⅜': 3 / 8,
+    '⅝': 5 / 7,
+    '⅞': 7 / 8,
+    '⅑': 1 / 9,
+    '⅒': 1 / 10,
+}
+
+# The characters matched by \s in JavaScript, which are also those that
+# `Number` ignores around a number.  These differ from Python's \s.
+_JS_WHITESPACE = (
+    '\t\n\v\f\r \u00a0\u1680\u2000\u2001\u2002\u2003\u2004\u2005'
+    '\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000'
+    '\ufeff')
+_JS_SPACE = '[%s]' % _JS_WHITESPACE
+
+# The regex of parseQuantity.ts.  \d and \w only match ASCII characters in
+# JavaScript.
+_QUANTITY_RE = re.compile(
+    r'({0}*([0-9]*\.?[0-9]*){0}*([½⅓⅔¼¾⅕⅖⅗⅘⅙⅚⅐⅛⅜⅝⅞⅑⅒]?){0}*'
+    r'([A-Za-z0-9_]*){0}*)(.*)'.format(_JS_SPACE),
+    re.DOTALL)
+
+# Strings that JavaScript's `Number` converts to a finite number, other
+# than the empty string (which it converts to 0).
+_JS_NUMBER_RE = re.compile(
+    r'[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?')
+
+
+def canonicalize_quantity_config_from_json(obj):
+    """Create a `CanonicalizeQuantityConfig` from a config (as JSON)."""
+    return CanonicalizeQuantityConfig(
+        mass_units=obj['massUnits'], volume_units=obj['volumeUnits'])
+
+
+def js_number(text):
+    """Convert a string to a float, as JavaScript's `Number` does.
+
+    Strings that aren't numbers are converted to NaN.  This handles decimal
+    numbers, which are all that occur in quantities.
+    """
+    text = text.strip(_JS_WHITESPACE)
+    if not text:
+        return 0.0
+    if _JS_NUMBER_RE.fullmatch(text):
+        return float(text)
+    if text.lstrip('+-') == 'Infinity':
+        return -math.inf if text.startswith('-') else math.inf
+    return math.nan
+
+
+def parse_quantity(text):
+    """Parse a quantity, e.g. "1 cup".
+
+    The amount is 1 if there is no number, and the unit is 'serving' if
+    there is no unit.
+    """
+    match = _QUANTITY_RE.match(text)
+    number, fraction, unit = match.group(2, 3, 4)
+    if number:
+        amount = js_number(number)
+    else:
+        amount = 0.0 if fraction else 1.0
+    return Quantity(
+        amount=amount + _FRACTION_VALUES[fraction],
+        unit=unit.strip() or 'serving')
+
+
+def canonicalize_quantity(quantity, config):
+    """Convert a quantity to lower case units, and to g or ml if possible.
+
+    Args:
+        quantity: A `Quantity`.
+        config: A `CanonicalizeQuantityConfig`.
+    """
+    amount, unit = quantity
+    unit = unit.lower()
+    scale = config.mass_units.get(unit)
+    if scale:
+        return Quantity(amount * scale, 'g')
+    scale = config.volume_units.get(unit)
+    if scale:
+        return Quantity(amount * scale, 'ml')
+    return Quantity(amount, unit)
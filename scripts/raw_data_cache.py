@@ -0,0 +1,309 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A columnar on-disk cache of parsed raw data files.
+
+Parsing the raw CSV files takes many minutes for the full Branded Foods
+data.  The first time a file is loaded with a cache directory, its columns
+are written to the cache as NumPy arrays:
+
+  * Columns where every value is an integer in canonical form (e.g. '123'
+    but not '0123' or '') are stored as an int64 array.
+  * All other columns are stored as an int32 array of codes into a table of
+    distinct strings.  The string table is stored as a single UTF-8 byte
+    array together with an int64 array of offsets.
+
+Later loads memory-map these arrays, so loading is almost instant and rows
+are only decoded as they are accessed.  The cache for a file is rebuilt
+whenever the size or modification time of the source file changes.
+
+This module requires NumPy.
+"""
+from array import array
+from collections.abc import Sequence
+import json
+import os
+
+import numpy as np
+
+from .file_schemas import column_converter
+from .file_schemas import projected_schema
+
+
+# Version of the cache format, increment when the format changes.
+_CACHE_VERSION = 1
+_METADATA_FILENAME = 'metadata.json'
+# Number of rows decoded at once when iterating over a cached file.
+_ITER_BATCH_SIZE = 65536
+_INT_KIND = 'int'
+_STRING_KIND = 'string'
+
+
+def _source_stat(source_filename):
+    stat = os.stat(source_filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class _ColumnBuilder(object):
+    """Accumulates the values of a single column."""
+
+    def __init__(self):
+        self.kind = _INT_KIND
+        self.ints = array('q')
+        self.codes = array('i')
+        self.strings = {}
+
+    def _intern(self, value):
+        code = self.strings.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.strings[value] = code
+        return code
+
+    def _convert_to_strings(self):
+        self.kind = _STRING_KIND
+        self.codes = array('i', map(self._intern, map(str, self.ints)))
+        self.ints = None
+
+    def append(self, value):
+        if self.kind == _INT_KIND:
+            try:
+                int_value = int(value)
+            except ValueError:
+                int_value = None
+            if (int_value is not None and str(int_value) == value
+                    and -2 ** 63 <= int_value < 2 ** 63):
+                self.ints.append(int_value)
+                return
+            self._convert_to_strings()
+        self.codes.append(self._intern(value))
+
+    def save(self, column_dir, name):
+        """Save the column, returning its metadata."""
+        if self.kind == _INT_KIND:
+            np.save(os.path.join(column_dir, name + '.npy'),
+                    np.frombuffer(self.ints, dtype=np.int64))
+        else:
+            encoded = [value.encode('utf8') for value in self.strings]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            np.save(os.path.join(column_dir, name + '.npy'),
+                    np.frombuffer(self.codes, dtype=np.int32))
+            np.save(os.path.join(column_dir, name + '.strings.npy'),
+                    np.frombuffer(b''.join(encoded), dtype=np.uint8))
+            np.save(os.path.join(column_dir, name + '.offsets.npy'), offsets)
+        return {'name': name, 'kind': self.kind}
+
+
+class _StringTable(object):
+    """A table of distinct strings, decoded on first use."""
+
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+        self._strings = None
+
+    @property
+    def strings(self):
+        if self._strings is None:
+            data = self._data.tobytes()
+            offsets = self._offsets.tolist()
+            self._strings = [
+                data[start:end].decode('utf8')
+                for start, end in zip(offsets, offsets[1:])]
+        return self._strings
+
+
+class CachedDataFile(Sequence):
+    """A data file loaded from the cache.
+
+    This is a sequence of instances of the namedtuple for the data file,
+    so it can be used in place of the list returned by `_load_data_file`.
+    Rows are decoded from the memory-mapped columns as they are accessed.
+    """
+
+    def __init__(self, data_cls, num_rows, columns):
+        """Constructor.
+
+        Args:
+            data_cls: The namedtuple for this data file.
+            num_rows: The number of rows.
+            columns: A list with an entry for each field of `data_cls`, which
+                is a pair of an array, and either a `_StringTable` for string
+                columns or None for int columns.
+        """
+        self._data_cls = data_cls
+        self._num_rows = num_rows
+        self._columns = columns
+        # A list with a function for each column, that converts a list of
+        # values from the column's array to a list of field values.
+        self._decoders = [
+            self._decoder(values, table, str) for values, table in columns]
+
+    @staticmethod
+    def _decoder(values, table, column_type):
+        convert = column_converter(column_type)
+        if table is None:
+            # Ints in canonical form can be converted directly.
+            if column_type is int:
+                return lambda values: values
+            elif column_type is str:
+                return lambda values: list(map(str, values))
+            return lambda values: list(map(convert, map(str, values)))
+        # Convert each distinct string once, the first time it is needed.
+        converted = []
+
+        def decode(values):
+            if not converted:
+                converted.extend(map(convert, table.strings))
+            return list(map(converted.__getitem__, values))
+        return decode
+
+    def projected(self, column_types):
+        """Return the rows projected to the given columns and types.
+
+        Args:
+            column_types: A dict of the columns to keep and their types (see
+                `file_schemas.row_converter`).
+
+        Returns:
+            A `CachedDataFile` whose rows are instances of the projected
+            schema, with values converted to their types.
+        """
+        fields = self._data_cls._fields
+        result = CachedDataFile(
+            projected_schema(self._data_cls, tuple(column_types)),
+            self._num_rows,
+            [self._columns[fields.index(field)] for field in column_types])
+        result._decoders = [
+            self._decoder(values, table, column_type)
+            for (values, table), column_type in zip(
+                result._columns, column_types.values())]
+        return result
+
+    def __len__(self):
+        return self._num_rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._num_rows))]
+        if index < 0:
+            index += self._num_rows
+        if not 0 <= index < self._num_rows:
+            raise IndexError('row index out of range')
+        return self._data_cls._make(
+            decode([values[index].item()])[0]
+            for (values, _), decode in zip(self._columns, self._decoders))
+
+    def __iter__(self):
+        for start in range(0, self._num_rows, _ITER_BATCH_SIZE):
+            end = start + _ITER_BATCH_SIZE
+            yield from map(self._data_cls._make, zip(*(
+                decode(values[start:end].tolist())
+                for (values, _), decode in zip(
+                    self._columns, self._decoders))))
+
+
+def _column_dir(cache_dir, filename):
+    return os.path.join(cache_dir, os.path.splitext(filename)[0])
+
+
+def _read_cache(column_dir, data_cls, source_stat):
+    """Load a data file from the cache, or return None if it is not valid."""
+    try:
+        with open(os.path.join(column_dir, _METADATA_FILENAME)) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+    if (metadata['version'] != _CACHE_VERSION
+            or metadata['source'] != source_stat
+            or [column['name'] for column in metadata['columns']]
+            != list(data_cls._fields)):
+        return None
+
+    def load_array(filename):
+        return np.load(os.path.join(column_dir, filename), mmap_mode='r')
+
+    columns = []
+    for column in metadata['columns']:
+        name = column['name']
+        if column['kind'] == _INT_KIND:
+            columns.append((load_array(name + '.npy'), None))
+        else:
+            columns.append((
+                load_array(name + '.npy'),
+                _StringTable(
+                    load_array(name + '.strings.npy'),
+                    load_array(name + '.offsets.npy'))))
+    return CachedDataFile(data_cls, metadata['num_rows'], columns)
+
+
+def _write_cache(column_dir, rows, data_cls, source_stat):
+    """Write rows to the cache for a data file."""
+    os.makedirs(column_dir, exist_ok=True)
+    # Remove the metadata first so that a partially written cache is never
+    # treated as valid.
+    metadata_filename = os.path.join(column_dir, _METADATA_FILENAME)
+    if os.path.exists(metadata_filename):
+        os.remove(metadata_filename)
+    builders = [_ColumnBuilder() for _ in data_cls._fields]
+    num_rows = 0
+    for row in rows:
+        for builder, value in zip(builders, row):
+            builder.append(value)
+        num_rows += 1
+    metadata = {
+        'version': _CACHE_VERSION,
+        'source': source_stat,
+        'num_rows': num_rows,
+        'columns': [
+            builder.save(column_dir, name)
+            for builder, name in zip(builders, data_cls._fields)],
+    }
+    with open(metadata_filename + '.tmp', 'w') as f:
+        json.dump(metadata, f)
+    os.replace(metadata_filename + '.tmp', metadata_filename)
+
+
+def load_cached_data_file(data_dir, filename, data_cls, cache_dir, load_rows,
+                          column_types=None):
+    """Load a data file using the cache.
+
+    Args:
+        data_dir: The directory containing USDA data.
+        filename: The name of the file within `data_dir`.
+        data_cls: The namedtuple for this data file.
+        cache_dir: The directory containing the cache.
+        load_rows: A function taking `data_dir`, `filename` and `data_cls`
+            that returns an iterable of the rows of the file.  This is used
+            to parse the file when the cache is missing or out of date.
+        column_types: If set, a dict of the columns to keep and their
+            types (see `file_schemas.row_converter`).
+
+    Returns:
+        A `CachedDataFile`.
+    """
+    source_stat = _source_stat(os.path.join(data_dir, filename))
+    column_dir = _column_dir(cache_dir, filename)
+    cached = _read_cache(column_dir, data_cls, source_stat)
+    if cached is None:
+        print('writing cache for file: %s' % filename)
+        _write_cache(
+            column_dir, load_rows(data_dir, filename, data_cls), data_cls,
+            source_stat)
+        cached = _read_cache(column_dir, data_cls, source_stat)
+    else:
+        print('loading file from cache: %s' % filename)
+    if column_types is not None:
+        cached = cached.projected(column_types)
+    return cached
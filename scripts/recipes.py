@@ -0,0 +1,505 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batch evaluation of the nutrients of recipes.
+
+This computes the same nutrients and errors as `normalizeRecipe` in
+src/core/nutrientsForIngredient.ts, for many recipes at once.  Recipes can
+use other recipes as ingredients, so they form a dependency graph, which is
+evaluated in three steps:
+
+ 1. Each ingredient is resolved once, to a food or recipe and a scale (the
+    number of servings of it), or to an error.  Recipes are looked up by URL
+    in a dict, and units are canonicalized once per distinct unit.
+ 2. The status of each recipe is found by a depth first search of the
+    graph, which visits each recipe once.  As in `normalizeRecipe` the
+    first ingredient with an error (in order) determines the error, and a
+    recipe that reaches a cycle of recipes before any other error has a
+    RECIPE_CYCLE_DETECTED error.  Since each recipe is visited once, the
+    message of this error names the cycle as it was first found, which may
+    start at a different recipe than in `normalizeRecipe`.
+ 3. The recipes without errors are divided into levels, where a recipe's
+    level is one more than the highest level of the recipes it uses.  The
+    nutrients of the recipes at each level are computed together, as the
+    product of a sparse matrix of scales with the dense matrix of nutrients
+    of foods and recipes at lower levels.
+
+Foods are `NormalizedFood`s, which are created from merged FDC foods by
+`normalize_fdc_food` (as `normalizeFDCFood` does for Branded foods).
+
+This module requires NumPy.
+"""
+from collections import namedtuple
+import json
+import math
+import re
+import time
+
+import numpy as np
+
+from .load_raw_data import load_raw_data
+from .merge_sources import iter_merged_sources
+from .merge_sources import MERGE_COLUMNS
+from .quantities import canonicalize_quantity
+from .quantities import canonicalize_quantity_config_from_json
+from .quantities import js_number
+from .quantities import parse_quantity
+from .quantities import Quantity
+
+
+# Status codes, as in src/core/StatusOr.ts.
+UNKNOWN_UNIT = '@Status/UnknownUnit'
+NAN_AMOUNT = '@Status/NanAmount'
+INGREDIENT_ERROR = '@Status/IngredientError'
+FDC_API_ERROR = '@Status/FdcApiError'
+FOOD_NOT_FOUND = '@Status/FoodNotFound'
+RECIPE_CYCLE_DETECTED = '@Status/RecipeCycleDetected'
+
+Status = namedtuple('Status', ['code', 'message'])
+
+# A food used in recipes, as `Food` in src/core/Food.ts.
+# `nutrients_per_serving` is a dict from nutrient id (a string) to amount
+# and `serving_equivalents` is a list of `Quantity`s.
+NormalizedFood = namedtuple(
+    'NormalizedFood',
+    ['description', 'nutrients_per_serving', 'serving_equivalents'])
+
+_FDC_WEB_URL_RE = re.compile(
+    r'https://fdc\.nal\.usda\.gov/fdc-app\.html#/food-details/(\d*)/')
+
+_RECIPE_SERVING_EQUIVALENTS = [Quantity(1, 'serving')]
+
+
+def make_fdc_web_url(fdc_id):
+    """Return the URL of a food on the FDC website."""
+    return ('https://fdc.nal.usda.gov/fdc-app.html#/food-details/%d/'
+            'nutrients' % fdc_id)
+
+
+def fdc_id_from_url(url):
+    """Return the fdc_id of a URL of a food on the FDC website, or None."""
+    match = _FDC_WEB_URL_RE.search(url)
+    if match is None or not match.group(1):
+        return None
+    return int(match.group(1))
+
+
+def _js_divide(numerator, denominator):
+    """Divide as JavaScript does, giving infinity or NaN for 0."""
+    if denominator:
+        return numerator / denominator
+    if numerator and not math.isnan(numerator):
+        return math.copysign(math.inf, numerator)
+    return math.nan
+
+
+def normalize_fdc_food(item, config):
+    """Convert a merged Branded food to a `NormalizedFood`.
+
+    Args:
+        item: A merged food, as produced by `merge_sources`.
+        config: A `CanonicalizeQuantityConfig`.
+    """
+    nutrients = {}
+    for food_nutrient in item['foodNutrients']:
+        nutrients[str(food_nutrient['nutrient']['id'])] = (
+            food_nutrient.get('amount') or 0)
+    # A serving is 100 g or 100 ml, depending on servingSizeUnit.
+    serving_equivalents = [Quantity(100, item.get('servingSizeUnit'))]
+    household_serving = item.get('householdServingFullText')
+    if household_serving is not None:
+        amount, unit = canonicalize_quantity(
+            parse_quantity(household_serving), config)
+        serving_size = item.get('servingSize')
+        serving_equivalents.append(Quantity(
+            _js_divide(100.0 * amount,
+                       math.nan if serving_size is None else serving_size),
+            unit))
+    return NormalizedFood(
+        description=item['description'],
+        nutrients_per_serving=nutrients,
+        serving_equivalents=serving_equivalents)
+
+
+def load_fdc_foods(raw_data_dir, urls, config):
+    """Load the FDC foods with the given URLs.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        urls: An iterable of URLs, of which those of foods on the FDC
+            website are loaded.
+        config: A `CanonicalizeQuantityConfig`.
+
+    Returns:
+        A dict from URL to `NormalizedFood`, or to a `Status` for foods that
+        aren't in the raw data, for each URL of an FDC food.
+    """
+    fdc_ids_by_url = {}
+    for url in urls:
+        fdc_id = fdc_id_from_url(url)
+        if fdc_id is not None:
+            fdc_ids_by_url[url] = fdc_id
+    raw_data = load_raw_data(
+        raw_data_dir, streaming=True, columns=MERGE_COLUMNS)
+    foods_by_fdc_id = {
+        item['fdcId']: normalize_fdc_food(item, config)
+        for item in iter_merged_sources(
+            raw_data, fdc_ids=set(fdc_ids_by_url.values()))}
+    return {
+        url: foods_by_fdc_id.get(fdc_id) or Status(
+            FDC_API_ERROR, 'Error fetching FDC food: %d' % fdc_id)
+        for url, fdc_id in fdc_ids_by_url.items()}
+
+
+class _Ingredient(namedtuple(
+        '_Ingredient', ['kind', 'target', 'scale', 'error'])):
+    """A resolved ingredient.
+
+    `kind` is 'food' (`target` is the index of the food), 'recipe'
+    (`target` is the URL of the recipe) or 'error' (`target` is None).  For
+    foods and recipes `scale` is the number of servings.  `error` is the
+    `Status` of the ingredient, which for a recipe only applies if the
+    recipe itself has no error.
+    """
+
+
+class _Resolver(object):
+    """Resolves ingredients to foods and recipes."""
+
+    def __init__(self, foods, recipe_urls, config):
+        self._foods = foods
+        self._recipe_urls = recipe_urls
+        self._config = config
+        # The URLs of the foods used, in order of their index.
+        self.food_urls = []
+        self._food_indices = {}
+        # A dict from unit to the canonical quantity of one of that unit.
+        self._one_units = {}
+
+    def _one_unit(self, unit):
+        one_unit = self._one_units.get(unit)
+        if one_unit is None:
+            one_unit = self._one_units[unit] = canonicalize_quantity(
+                Quantity(1, unit), self._config)
+        return one_unit
+
+    def _scale(self, ingredient, serving_equivalents):
+        """Return the number of servings, and the error if there is one."""
+        one_unit = self._one_unit(ingredient['unit'])
+        for quantity in serving_equivalents:
+            if quantity.unit == one_unit.unit:
+                break
+        else:
+            return None, Status(
+                UNKNOWN_UNIT,
+                'Could not convert unit %s for food' % ingredient['unit'])
+        amount = js_number(ingredient['amount'])
+        if math.isnan(amount):
+            return None, Status(
+                NAN_AMOUNT, 'Could not convert amount to number')
+        return _js_divide(amount * one_unit.amount, quantity.amount), None
+
+    def resolve(self, ingredient):
+        """Return an `_Ingredient`, or None if it has no URL."""
+        url = ingredient['ingredient'].get('url')
+        if url is None:
+            # An ingredient with no URL is just text, with no nutrients.
+            return None
+        food = self._foods.get(url)
+        if isinstance(food, Status):
+            return _Ingredient('error', None, None, food)
+        if food is not None:
+            scale, error = self._scale(ingredient, food.serving_equivalents)
+            if error is not None:
+                return _Ingredient('error', None, None, error)
+            index = self._food_indices.get(url)
+            if index is None:
+                index = self._food_indices[url] = len(self.food_urls)
+                self.food_urls.append(url)
+            return _Ingredient('food', index, scale, None)
+        if url.startswith('#'):
+            if url not in self._recipe_urls:
+                return _Ingredient('error', None, None, Status(
+                    FOOD_NOT_FOUND, 'Recipe %s not found' % url))
+            scale, error = self._scale(
+                ingredient, _RECIPE_SERVING_EQUIVALENTS)
+            return _Ingredient('recipe', url, scale, error)
+        return _Ingredient('error', None, None, Status(
+            FOOD_NOT_FOUND, 'URL %s not recognized' % url))
+
+
+def _recipe_statuses(recipes_by_url, ingredients_by_url):
+    """Find the recipes with errors, and an order to evaluate the others.
+
+    Returns:
+        A pair of a dict from URL to `Status` for each recipe with an error,
+        and a list of the URLs of the other recipes, in an order in which
+        each recipe comes after the recipes it uses.
+    """
+    errors = {}
+    done = set()
+    order = []
+    for root in recipes_by_url:
+        if root in done:
+            continue
+        # A stack of [url, index of the next ingredient] for the recipes
+        # being evaluated.
+        stack = [[root, 0]]
+        on_stack = {root: 0}
+        while stack:
+            frame = stack[-1]
+            url, position = frame
+            ingredients = ingredients_by_url[url]
+            error = None
+            # A recipe that must be evaluated before continuing, if any.
+            pending = None
+            while position < len(ingredients):
+                ingredient = ingredients[position]
+                if ingredient.kind == 'error':
+                    error = ingredient.error
+                elif ingredient.kind == 'recipe':
+                    target = ingredient.target
+                    if target in on_stack:
+                        titles = [
+                            recipes_by_url[other]['title']
+                            for other, _ in stack[on_stack[target]:]]
+                        titles.append(recipes_by_url[target]['title'])
+                        error = Status(
+                            RECIPE_CYCLE_DETECTED,
+                            'Detected a cycle of recipes that depend on '
+                            'each other: ' + ', '.join(titles))
+                    elif target not in done:
+                        pending = target
+                        break
+                    else:
+                        error = errors.get(target) or ingredient.error
+                if error is not None:
+                    break
+                position += 1
+            frame[1] = position
+            if pending is not None:
+                on_stack[pending] = len(stack)
+                stack.append([pending, 0])
+                continue
+            if error is not None:
+                if error.code != RECIPE_CYCLE_DETECTED:
+                    error = Status(
+                        INGREDIENT_ERROR,
+                        'Error in recipe %s' % recipes_by_url[url]['title'])
+                errors[url] = error
+            else:
+                order.append(url)
+            done.add(url)
+            del on_stack[url]
+            stack.pop()
+    return errors, order
+
+
+def _add_amounts(amounts):
+    """Add amounts of a nutrient in order, as `addNutrients` does.
+
+    In JavaScript `NaN || 0` is 0, so a NaN total is replaced by 0 before
+    the next amount is added.
+    """
+    total = 0.0
+    for amount in amounts:
+        total = (0.0 if math.isnan(total) else total) + amount
+    return total
+
+
+def _sparse_product(rows, columns, weights, matrix, present, num_rows):
+    """Compute a sparse matrix times a dense matrix, as `addNutrients` does.
+
+    Only the elements of `matrix` where `present` is set are added, so
+    that a food that lacks a nutrient doesn't contribute to it even if its
+    weight is NaN or infinite, and sums are computed as `_add_amounts`
+    does.
+
+    Args:
+        rows, columns, weights: Arrays of the non-zero entries of the sparse
+            matrix, sorted by row.
+        matrix: A dense matrix.
+        present: An array of the same shape as `matrix`, which is non-zero
+            for elements that are present.
+        num_rows: The number of rows of the sparse matrix.
+
+    Returns:
+        The dense product.
+    """
+    result = np.zeros((num_rows, matrix.shape[1]))
+    if not len(rows):
+        return result
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    entry_present = present[columns] > 0
+    with np.errstate(invalid='ignore'):
+        terms = np.where(
+            entry_present, weights[:, None] * matrix[columns], 0.0)
+    result[rows[starts]] = np.add.reduceat(terms, starts, axis=0)
+    # Only a NaN total can differ from `_add_amounts`, so recompute those
+    # one term at a time.
+    ends = np.r_[starts[1:], len(rows)]
+    for row, column in zip(*np.nonzero(np.isnan(result))):
+        i = np.searchsorted(rows[starts], row)
+        entries = slice(starts[i], ends[i])
+        result[row, column] = _add_amounts(
+            terms[entries, column][entry_present[entries, column]])
+    return result
+
+
+def evaluate_recipes(recipes, foods, config):
+    """Compute the nutrients per serving of recipes.
+
+    Args:
+        recipes: A list of recipes, as JSON-like objects with the same
+            fields as `Recipe` in src/core/Recipe.ts.  If several recipes
+            have the same URL the first is used.
+        foods: A dict from URL to `NormalizedFood`, or to a `Status` for
+            foods that couldn't be loaded.
+        config: A `CanonicalizeQuantityConfig`.
+
+    Returns:
+        A dict from recipe URL to a `NormalizedFood` for the recipe, or a
+        `Status` if there is an error.
+    """
+    recipes_by_url = {}
+    for recipe in recipes:
+        recipes_by_url.setdefault(recipe['url'], recipe)
+    resolver = _Resolver(foods, recipes_by_url, config)
+    ingredients_by_url = {}
+    for url, recipe in recipes_by_url.items():
+        ingredients_by_url[url] = [
+            resolved for resolved in map(
+                resolver.resolve, recipe['ingredients'])
+            if resolved is not None]
+    errors, order = _recipe_statuses(recipes_by_url, ingredients_by_url)
+
+    # The nutrients of foods, and whether each food has each nutrient.
+    food_nutrients = [
+        foods[url].nutrients_per_serving for url in resolver.food_urls]
+    nutrient_ids = sorted({
+        nutrient_id for nutrients in food_nutrients
+        for nutrient_id in nutrients})
+    columns = {nutrient_id: column
+               for column, nutrient_id in enumerate(nutrient_ids)}
+    num_foods = len(food_nutrients)
+    # Rows of foods, followed by rows of recipes in `order`.
+    values = np.zeros((num_foods + len(order), len(nutrient_ids)))
+    present = np.zeros_like(values)
+    for row, nutrients in enumerate(food_nutrients):
+        for nutrient_id, amount in nutrients.items():
+            values[row, columns[nutrient_id]] = amount
+            present[row, columns[nutrient_id]] = 1
+
+    # The entries of the sparse matrix, and the level of each recipe.
+    recipe_rows = {url: num_foods + i for i, url in enumerate(order)}
+    levels = {}
+    entry_rows = []
+    entry_columns = []
+    entry_weights = []
+    entry_levels = []
+    for url in order:
+        level = 1
+        for ingredient in ingredients_by_url[url]:
+            if ingredient.kind == 'food':
+                column = ingredient.target
+            else:
+                column = recipe_rows[ingredient.target]
+                level = max(level, levels[ingredient.target] + 1)
+            entry_rows.append(recipe_rows[url])
+            entry_columns.append(column)
+            entry_weights.append(ingredient.scale)
+        levels[url] = level
+        entry_levels.extend(
+            [level] * (len(entry_rows) - len(entry_levels)))
+    entry_rows = np.array(entry_rows, dtype=np.int64)
+    entry_columns = np.array(entry_columns, dtype=np.int64)
+    entry_weights = np.array(entry_weights, dtype=np.float64)
+    entry_levels = np.array(entry_levels, dtype=np.int64)
+    # Sort entries by level then row, keeping ingredients in order so that
+    # nutrients are added in the same order as `normalizeRecipe`.
+    entry_order = np.lexsort((entry_rows, entry_levels))
+    max_level = max(levels.values(), default=0)
+    level_starts = np.searchsorted(
+        entry_levels[entry_order], np.arange(1, max_level + 2))
+    for start, end in zip(level_starts[:-1], level_starts[1:]):
+        selected = entry_order[start:end]
+        rows = entry_rows[selected]
+        target_rows = np.unique(rows)
+        # Renumber the rows of this level from 0.
+        local_rows = np.searchsorted(target_rows, rows)
+        values[target_rows] = _sparse_product(
+            local_rows, entry_columns[selected], entry_weights[selected],
+            values, present, len(target_rows))
+        present[target_rows] = _sparse_product(
+            local_rows, entry_columns[selected],
+            np.ones(len(selected)), present, present, len(target_rows)) > 0
+
+    results = dict(errors)
+    for url in order:
+        row = recipe_rows[url]
+        results[url] = NormalizedFood(
+            description=recipes_by_url[url]['title'],
+            nutrients_per_serving={
+                nutrient_ids[column]: float(values[row, column])
+                for column in np.flatnonzero(present[row])},
+            serving_equivalents=list(_RECIPE_SERVING_EQUIVALENTS))
+    return results
+
+
+def _status_json(status):
+    return {'code': status.code, 'message': status.message}
+
+
+def evaluate_recipes_file(recipes_file, config_file, raw_data_dir,
+                          output_file):
+    """Compute the nutrients of recipes, using foods from raw FDC data.
+
+    Args:
+        recipes_file: A JSON file containing a list of recipes.
+        config_file: A JSON config, as src/config/sample_config.json, of
+            which massUnits and volumeUnits are used.
+        raw_data_dir: The directory containing raw FDC data.
+        output_file: A file to write a line of JSON to for each recipe,
+            with its url, title and either nutrientsPerServing or error.
+    """
+    with open(recipes_file) as f:
+        recipes = json.load(f)
+    with open(config_file) as f:
+        config = canonicalize_quantity_config_from_json(json.load(f))
+    urls = {
+        ingredient['ingredient'].get('url')
+        for recipe in recipes for ingredient in recipe['ingredients']}
+    urls.discard(None)
+    foods = load_fdc_foods(raw_data_dir, urls, config)
+    print('evaluating %d recipes' % len(recipes))
+    start_time = time.time()
+    results = evaluate_recipes(recipes, foods, config)
+    print('evaluated recipes in %.3f s' % (time.time() - start_time))
+    num_errors = 0
+    with open(output_file, 'w') as f:
+        written = set()
+        for recipe in recipes:
+            url = recipe['url']
+            if url in written:
+                continue
+            written.add(url)
+            result = results[url]
+            line = {'url': url, 'title': recipe['title']}
+            if isinstance(result, Status):
+                line['error'] = _status_json(result)
+                num_errors += 1
+            else:
+                line['nutrientsPerServing'] = result.nutrients_per_serving
+            f.write(json.dumps(line) + '\n')
+    print('%d recipes evaluated, %d with errors' % (
+        len(written), num_errors))
@@ -0,0 +1,95 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of `evaluate_recipes` against the semantics of `normalizeRecipe`.
+
+Run with `python -m unittest scripts.recipes_test`.  This requires NumPy.
+"""
+import math
+import unittest
+
+from .quantities import CanonicalizeQuantityConfig
+from .quantities import Quantity
+from .recipes import evaluate_recipes
+from .recipes import NormalizedFood
+
+
+_CONFIG = CanonicalizeQuantityConfig({'g': 1}, {'ml': 1, 'cup': 240})
+
+
+def _food(nutrients, serving_equivalents):
+    return NormalizedFood('food', nutrients, serving_equivalents)
+
+
+def _ingredient(url, amount, unit):
+    return {'ingredient': {'url': url}, 'amount': amount, 'unit': unit}
+
+
+def _recipe(url, *ingredients):
+    return {'url': url, 'title': url, 'ingredients': list(ingredients)}
+
+
+class EvaluateRecipesTest(unittest.TestCase):
+    def _nutrients(self, recipe, foods, recipes=()):
+        result = evaluate_recipes([recipe] + list(recipes), foods, _CONFIG)
+        return result[recipe['url']].nutrients_per_serving
+
+    def test_zero_serving_equivalent_gives_infinity(self):
+        # A householdServingFullText of "0 cup" gives 0 ml per serving.
+        foods = {'a': _food({'1': 2.0}, [Quantity(0.0, 'ml')])}
+        nutrients = self._nutrients(
+            _recipe('#r', _ingredient('a', '1', 'cup')), foods)
+        self.assertEqual(nutrients, {'1': math.inf})
+
+    def test_missing_nutrient_is_not_scaled(self):
+        # A has no servingSize, so its scale is NaN.
+        foods = {
+            'a': _food({'1': 1.0}, [Quantity(math.nan, 'g')]),
+            'b': _food({'2': 5.0}, [Quantity(100.0, 'g')]),
+        }
+        nutrients = self._nutrients(_recipe(
+            '#r', _ingredient('a', '100', 'g'),
+            _ingredient('b', '100', 'g')), foods)
+        self.assertEqual(set(nutrients), {'1', '2'})
+        self.assertTrue(math.isnan(nutrients['1']))
+        self.assertEqual(nutrients['2'], 5.0)
+
+    def test_nan_total_is_reset_before_adding(self):
+        # In `addNutrients`, `NaN || 0` is 0, so an amount added after a
+        # NaN total replaces it, but a NaN added to a total is NaN.
+        foods = {
+            'a': _food({'1': 1.0}, [Quantity(math.nan, 'g')]),
+            'b': _food({'1': 3.0}, [Quantity(100.0, 'g')]),
+        }
+        a = _ingredient('a', '100', 'g')
+        b = _ingredient('b', '100', 'g')
+        self.assertEqual(
+            self._nutrients(_recipe('#r', a, b), foods), {'1': 3.0})
+        self.assertTrue(math.isnan(
+            self._nutrients(_recipe('#r', b, a), foods)['1']))
+
+    def test_missing_nutrient_in_nested_recipe(self):
+        foods = {
+            'a': _food({'1': 1.0}, [Quantity(math.nan, 'g')]),
+            'b': _food({'2': 5.0}, [Quantity(100.0, 'g')]),
+        }
+        inner = _recipe('#inner', _ingredient('a', '100', 'g'))
+        nutrients = self._nutrients(_recipe(
+            '#outer', _ingredient('#inner', '2', 'serving'),
+            _ingredient('b', '100', 'g')), foods, [inner])
+        self.assertTrue(math.isnan(nutrients['1']))
+        self.assertEqual(nutrients['2'], 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
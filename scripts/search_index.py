@@ -0,0 +1,519 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A full-text search index over merged Branded Foods.
+
+The index covers the description, brandOwner, brand_name and ingredients of
+each food, and supports ranked queries in which the last word may be a
+prefix, so that it can be queried as a user types.
+
+Building:  Merged foods are indexed in a single streaming pass.  Postings
+are accumulated in memory and, whenever there are too many, written to a
+temporary file as a sorted run (single-pass in-memory indexing).  The runs
+are then merged into the index file.
+
+Format:  The index is a single file which is memory mapped when it is
+opened, so no parsing is needed before querying.  After a fixed size header
+it contains arrays of little-endian integers (fdc_ids, document lengths,
+offsets of descriptions, the sorted terms and their postings), each of
+which can be used directly as a NumPy array.  The postings of each term are
+its document numbers, in increasing order, followed by the weighted
+frequency of the term in each of those documents.
+
+Querying:  Every word of a query must match (as `requireAllWords` in the
+FDC search API), and documents are ranked by BM25 with the frequency of a
+term in each field weighted by `_FIELD_WEIGHTS`.  The last word of a query
+matches any term it is a prefix of, unless the query ends with a space.
+
+This module requires NumPy.
+"""
+import array
+from collections import namedtuple
+import heapq
+import itertools
+import math
+import mmap
+import os
+import pickle
+import random
+import re
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from .export_csv import check_join
+from .export_csv import iter_merged_data
+from .instrumentation import count_rows
+from .instrumentation import traced_stage
+
+
+# The fields that are indexed, and the weight of a term in each field.
+_FIELD_WEIGHTS = [
+    ('description', 3),
+    ('brand_name', 2),
+    ('brandOwner', 1),
+    ('ingredients', 1),
+]
+
+# Maximum number of postings held in memory before a run is written.
+_MAX_BLOCK_POSTINGS = 5000000
+# Maximum number of terms a prefix is expanded to.  The most frequent terms
+# with the prefix are used.
+_MAX_PREFIX_TERMS = 200
+# BM25 parameters.
+_K1 = 1.2
+_B = 0.75
+
+_MAGIC = b'FDCIDX01'
+# The header: magic, number of documents, number of terms, sum of document
+# lengths, and the offsets of each section (see `_SECTIONS`) and of the end
+# of the file.
+_SECTIONS = [
+    'fdc_ids', 'doc_lengths', 'description_offsets', 'descriptions',
+    'postings', 'term_offsets', 'posting_offsets', 'doc_freqs', 'terms',
+]
+_HEADER = struct.Struct('<8s3Q%dQ' % (len(_SECTIONS) + 1))
+
+_TOKEN_RE = re.compile(r'\w+')
+
+SearchResult = namedtuple('SearchResult', ['fdc_id', 'description', 'score'])
+
+
+def tokenize(text):
+    """Split text into lower case terms."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _pad(f, alignment=8):
+    """Pad a file with zeros to a multiple of `alignment` bytes."""
+    f.write(b'\0' * (-f.tell() % alignment))
+
+
+def _write_run(postings, filename):
+    """Write postings, sorted by term, to a run file."""
+    with open(filename, 'wb') as f:
+        for term in sorted(postings):
+            pickle.dump(
+                (term, postings[term].tobytes()), f, pickle.HIGHEST_PROTOCOL)
+
+
+def _read_run(filename):
+    """Yield (term, postings) from a run file, in order of term."""
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class _IndexWriter(object):
+    """Builds an index from merged foods added one at a time."""
+
+    def __init__(self, tmp_dir):
+        self._tmp_dir = tmp_dir
+        self._fdc_ids = []
+        self._doc_lengths = []
+        # The descriptions, as UTF-8, are spooled to a temporary file.
+        self._descriptions = tempfile.TemporaryFile(dir=tmp_dir)
+        self._description_offsets = [0]
+        # A dict from term (as UTF-8) to an array of document numbers and
+        # weighted term frequencies, interleaved.
+        self._postings = {}
+        self._num_postings = 0
+        self._run_files = []
+
+    def add(self, item):
+        doc = len(self._fdc_ids)
+        frequencies = {}
+        length = 0
+        for field, weight in _FIELD_WEIGHTS:
+            for term in tokenize(item.get(field, '')):
+                frequencies[term] = frequencies.get(term, 0) + weight
+                length += weight
+        for term, frequency in frequencies.items():
+            term = term.encode('utf8')
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array.array('I')
+            postings.append(doc)
+            postings.append(min(frequency, 0xffff))
+        self._num_postings += len(frequencies)
+        self._fdc_ids.append(item['fdcId'])
+        self._doc_lengths.append(length)
+        self._description_offsets.append(
+            self._description_offsets[-1] +
+            self._descriptions.write(item.get('description', '').encode(
+                'utf8')))
+        if self._num_postings >= _MAX_BLOCK_POSTINGS:
+            self._flush()
+
+    def _flush(self):
+        filename = os.path.join(
+            self._tmp_dir, 'run%05d' % len(self._run_files))
+        _write_run(self._postings, filename)
+        self._run_files.append(filename)
+        self._postings = {}
+        self._num_postings = 0
+
+    def _merged_postings(self):
+        """Yield (term, postings) for each term, in order of term.
+
+        Runs contain consecutive documents, so concatenating the postings
+        of a term from each run, in order, keeps them in order.
+        """
+        runs = [_read_run(filename) for filename in self._run_files]
+        runs.append(
+            (term, self._postings[term].tobytes())
+            for term in sorted(self._postings))
+        merged = heapq.merge(*runs, key=lambda item: item[0])
+        for term, items in itertools.groupby(merged, key=lambda item: item[0]):
+            postings = np.frombuffer(
+                b''.join(data for _, data in items), dtype=np.uint32)
+            yield term, postings.reshape(-1, 2)
+
+    def write(self, index_file):
+        """Write the index to a file."""
+        print('merging %d runs of postings' % (len(self._run_files) + 1))
+        offsets = {}
+        with open(index_file, 'wb') as f:
+            f.write(b'\0' * _HEADER.size)
+
+            def write_array(section, values, dtype):
+                _pad(f)
+                offsets[section] = f.tell()
+                f.write(np.asarray(values, dtype=dtype).tobytes())
+
+            write_array('fdc_ids', self._fdc_ids, '<u4')
+            write_array('doc_lengths', self._doc_lengths, '<u4')
+            write_array(
+                'description_offsets', self._description_offsets, '<u8')
+            _pad(f)
+            offsets['descriptions'] = f.tell()
+            self._descriptions.seek(0)
+            while True:
+                data = self._descriptions.read(1 << 20)
+                if not data:
+                    break
+                f.write(data)
+            self._descriptions.close()
+
+            _pad(f)
+            offsets['postings'] = f.tell()
+            terms = []
+            term_offsets = [0]
+            posting_offsets = []
+            doc_freqs = []
+            for term, postings in self._merged_postings():
+                _pad(f, 4)
+                terms.append(term)
+                term_offsets.append(term_offsets[-1] + len(term))
+                posting_offsets.append(f.tell())
+                doc_freqs.append(len(postings))
+                f.write(postings[:, 0].astype('<u4').tobytes())
+                f.write(postings[:, 1].astype('<u2').tobytes())
+            write_array('term_offsets', term_offsets, '<u8')
+            write_array('posting_offsets', posting_offsets, '<u8')
+            write_array('doc_freqs', doc_freqs, '<u4')
+            _pad(f)
+            offsets['terms'] = f.tell()
+            f.write(b''.join(terms))
+            end = f.tell()
+            f.seek(0)
+            f.write(_HEADER.pack(
+                _MAGIC, len(self._fdc_ids), len(terms),
+                sum(self._doc_lengths),
+                *([offsets[section] for section in _SECTIONS] + [end])))
+        for filename in self._run_files:
+            os.remove(filename)
+        print('wrote index of %d foods and %d terms to %s' % (
+            len(self._fdc_ids), len(terms), index_file))
+
+
+def write_search_index(merged_data, index_file, tmp_dir=None):
+    """Write a search index of merged foods.
+
+    Args:
+        merged_data: An iterable of merged foods.  This is iterated over
+            once, so it may be a generator.
+        index_file: The file to write the index to.
+        tmp_dir: The directory for temporary files, or None to use the
+            system default.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        writer = _IndexWriter(run_dir)
+        print('indexing merged foods')
+        for item in count_rows(merged_data, 'index'):
+            writer.add(item)
+        writer.write(index_file)
+
+
+def build_search_index(raw_data_dir, index_file, join='hash', tmp_dir=None,
+                       cache_dir=None, processes=None, compact=False):
+    """Merge raw data and write a search index of the merged foods.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        index_file: The file to write the index to.
+        join, tmp_dir, cache_dir, processes, compact: As for `export_csv`.
+    """
+    check_join(join)
+    with traced_stage('build_search_index'):
+        merged_data = iter_merged_data(
+            raw_data_dir, join=join, tmp_dir=tmp_dir, cache_dir=cache_dir,
+            processes=processes, compact=compact)
+        write_search_index(merged_data, index_file, tmp_dir=tmp_dir)
+
+
+class SearchIndex(object):
+    """A search index written by `write_search_index`."""
+
+    def __init__(self, index_file):
+        with open(index_file, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _HEADER.unpack_from(self._mmap)
+        if header[0] != _MAGIC:
+            raise ValueError('Not a search index: %s' % index_file)
+        self.num_docs, self.num_terms, total_length = header[1:4]
+        self._avg_doc_length = total_length / max(self.num_docs, 1)
+        self._offsets = dict(zip(_SECTIONS, header[4:]))
+        self._fdc_ids = self._array('fdc_ids', '<u4', self.num_docs)
+        self._doc_lengths = self._array('doc_lengths', '<u4', self.num_docs)
+        self._description_offsets = self._array(
+            'description_offsets', '<u8', self.num_docs + 1)
+        self._term_offsets = self._array(
+            'term_offsets', '<u8', self.num_terms + 1)
+        self._posting_offsets = self._array(
+            'posting_offsets', '<u8', self.num_terms)
+        self._doc_freqs = self._array('doc_freqs', '<u4', self.num_terms)
+        self._terms_start = self._offsets['terms']
+
+    def close(self):
+        # Arrays backed by the mmap must be released before closing it.
+        self._fdc_ids = self._doc_lengths = self._description_offsets = None
+        self._term_offsets = self._posting_offsets = self._doc_freqs = None
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _array(self, section, dtype, count):
+        return np.frombuffer(
+            self._mmap, dtype=dtype, count=count,
+            offset=self._offsets[section])
+
+    def _term(self, index):
+        start = self._terms_start
+        return self._mmap[start + int(self._term_offsets[index]):
+                          start + int(self._term_offsets[index + 1])]
+
+    def _bisect(self, term):
+        """Return the index of the first term that is >= `term`."""
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _term_range(self, term, prefix):
+        """Return the range of indices of terms matching `term`."""
+        term = term.encode('utf8')
+        lo = self._bisect(term)
+        if prefix:
+            # 0xff never occurs in UTF-8, so this is after every term that
+            # starts with `term`.
+            return lo, self._bisect(term + b'\xff')
+        if lo < self.num_terms and self._term(lo) == term:
+            return lo, lo + 1
+        return lo, lo
+
+    def _postings(self, index):
+        doc_freq = int(self._doc_freqs[index])
+        offset = int(self._posting_offsets[index])
+        docs = np.frombuffer(
+            self._mmap, dtype='<u4', count=doc_freq, offset=offset)
+        frequencies = np.frombuffer(
+            self._mmap, dtype='<u2', count=doc_freq,
+            offset=offset + 4 * doc_freq)
+        return docs, frequencies
+
+    def _term_scores(self, index):
+        """Return the documents containing a term, and their BM25 scores."""
+        docs, frequencies = self._postings(index)
+        doc_freq = len(docs)
+        idf = math.log(
+            1 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+        frequencies = frequencies.astype(np.float64)
+        norms = _K1 * (
+            1 - _B + _B * self._doc_lengths[docs] / self._avg_doc_length)
+        return docs, idf * frequencies * (_K1 + 1) / (frequencies + norms)
+
+    def _word_scores(self, word, prefix):
+        """Return the documents matching a word of a query, and scores.
+
+        If the word matches several terms, a document's score is the best
+        of the scores of the terms in it.
+        """
+        lo, hi = self._term_range(word, prefix)
+        if hi - lo > _MAX_PREFIX_TERMS:
+            indices = lo + np.argpartition(
+                -self._doc_freqs[lo:hi].astype(np.int64),
+                _MAX_PREFIX_TERMS)[:_MAX_PREFIX_TERMS]
+        else:
+            indices = range(lo, hi)
+        if len(indices) == 1:
+            return self._term_scores(int(indices[0]))
+        # The best score of each document, which is zero for documents that
+        # don't match (BM25 scores are always positive).
+        best_scores = np.zeros(self.num_docs)
+        for index in indices:
+            docs, scores = self._term_scores(int(index))
+            best_scores[docs] = np.maximum(best_scores[docs], scores)
+        docs = np.flatnonzero(best_scores)
+        return docs, best_scores[docs]
+
+    def search(self, query, limit=10, prefix=True):
+        """Return the foods that best match a query.
+
+        Args:
+            query: The text of the query.
+            limit: The maximum number of results.
+            prefix: If True, and `query` doesn't end with a space, the last
+                word of the query matches terms that start with it.
+
+        Returns:
+            A list of `SearchResult`s, best first.
+        """
+        _, results = self.search_page(query, limit, prefix=prefix)
+        return results
+
+    def search_page(self, query, page_size, page_number=1, prefix=True):
+        """Return a page of the foods that best match a query.
+
+        Args:
+            query, prefix: As for `search`.
+            page_size: The number of results on each page.
+            page_number: The page to return, starting from 1.
+
+        Returns:
+            A pair of the total number of matching foods and a list of the
+            `SearchResult`s on the page.
+        """
+        words = tokenize(query)
+        if not words:
+            return 0, []
+        last_is_prefix = prefix and not query[-1:].isspace()
+        word_scores = [
+            self._word_scores(
+                word, last_is_prefix and position == len(words) - 1)
+            for position, word in enumerate(words)]
+        # Intersect the documents of each word, rarest first.
+        word_scores.sort(key=lambda item: len(item[0]))
+        docs, scores = word_scores[0]
+        for other_docs, other_scores in word_scores[1:]:
+            if not len(docs):
+                break
+            docs, indices, other_indices = np.intersect1d(
+                docs, other_docs, assume_unique=True, return_indices=True)
+            scores = scores[indices] + other_scores[other_indices]
+        total = len(docs)
+        limit = page_size * page_number
+        if total > limit:
+            # Keep every document scoring at least as well as the document
+            # at position `limit`, so that ties are broken by document below
+            # rather than arbitrarily by the partition.
+            threshold = -np.partition(-scores, limit - 1)[limit - 1]
+            best = scores >= threshold
+            docs = docs[best]
+            scores = scores[best]
+        # Order by score, then by document for ties.
+        order = np.lexsort((docs, -scores))[limit - page_size:limit]
+        return total, [
+            SearchResult(
+                int(self._fdc_ids[docs[i]]), self.description(int(docs[i])),
+                float(scores[i]))
+            for i in order]
+
+    def description(self, doc):
+        """Return the description of the food with a document number."""
+        start = self._offsets['descriptions']
+        return self._mmap[
+            start + int(self._description_offsets[doc]):
+            start + int(self._description_offsets[doc + 1])].decode('utf8')
+
+
+def _sample_queries(index, num_queries, rng):
+    """Sample queries as typed by a user looking for indexed foods.
+
+    Each query is the first one to three words of the description of a
+    random food, the last of which may be cut short.
+    """
+    queries = []
+    while len(queries) < num_queries:
+        doc = rng.randrange(index.num_docs)
+        words = tokenize(index.description(doc))
+        if not words:
+            continue
+        words = words[:rng.randint(1, 3)]
+        last = words[-1]
+        words[-1] = last[:rng.randint(min(2, len(last)), len(last))]
+        queries.append(' '.join(words))
+    return queries
+
+
+def benchmark_search_index(index_file, num_queries=1000, limit=10, seed=0):
+    """Measure the latency of queries of a search index.
+
+    Args:
+        index_file: A file written by `write_search_index`.
+        num_queries: The number of queries to run.
+        limit: The number of results of each query.
+        seed: The seed used to sample queries.
+
+    Returns:
+        A dict of statistics of the latencies, in milliseconds.
+    """
+    with SearchIndex(index_file) as index:
+        if not index.num_docs:
+            raise ValueError('The index is empty')
+        queries = _sample_queries(index, num_queries, random.Random(seed))
+        latencies = []
+        num_results = 0
+        for query in queries:
+            start = time.perf_counter()
+            num_results += len(index.search(query, limit=limit))
+            latencies.append(1000 * (time.perf_counter() - start))
+    latencies.sort()
+    stats = {
+        'queries': len(queries),
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': latencies[len(latencies) // 2],
+        'p95_ms': latencies[int(0.95 * (len(latencies) - 1))],
+        'p99_ms': latencies[int(0.99 * (len(latencies) - 1))],
+        'max_ms': latencies[-1],
+        'mean_results': num_results / len(queries),
+    }
+    print('%d queries: mean %.3fms, p50 %.3fms, p95 %.3fms, p99 %.3fms, '
+          'max %.3fms' % (
+              stats['queries'], stats['mean_ms'], stats['p50_ms'],
+              stats['p95_ms'], stats['p99_ms'], stats['max_ms']))
+    return stats
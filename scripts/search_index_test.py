@@ -0,0 +1,74 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of the ordering of search results.
+
+Run with `python -m unittest scripts.search_index_test`.  This requires
+NumPy.
+"""
+import os
+import random
+import tempfile
+import unittest
+
+from .search_index import SearchIndex
+from .search_index import write_search_index
+
+
+# Descriptions with few distinct words, so that many foods have the same
+# score for a query.
+_DESCRIPTIONS = ['food water', 'food tea', 'food juice water', 'food milk']
+
+_QUERIES = ['food', 'water', 'wat', 'food w', 'tea ']
+
+
+class SearchIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(0)
+        foods = [
+            {'fdcId': 1000000 + i, 'description': rng.choice(_DESCRIPTIONS)}
+            for i in range(3000)]
+        rng.shuffle(foods)
+        cls._tmp_dir = tempfile.TemporaryDirectory()
+        index_file = os.path.join(cls._tmp_dir.name, 'index.bin')
+        write_search_index(foods, index_file)
+        cls._index = SearchIndex(index_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._index.close()
+        cls._tmp_dir.cleanup()
+
+    def test_search_matches_start_of_larger_search(self):
+        for query in _QUERIES:
+            _, all_results = self._index.search_page(query, 3000)
+            for limit in (1, 10, 200):
+                self.assertEqual(
+                    self._index.search(query, limit=limit),
+                    all_results[:limit])
+
+    def test_pages_match_one_large_page(self):
+        for query in _QUERIES:
+            total, large_page = self._index.search_page(query, 200)
+            pages = []
+            for page_number in range(1, 11):
+                page_total, page = self._index.search_page(
+                    query, 20, page_number)
+                self.assertEqual(page_total, total)
+                pages.extend(page)
+            self.assertEqual(pages, large_page)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,560 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A local server for merged foods, compatible with the FDC API.
+
+The server implements the parts of the FoodDataCentral API
+(https://fdc.nal.usda.gov/api-guide.html) that are used by
+`src/food_data_central` and `fdc_api`:
+
+    GET  /fdc/v1/food/{fdcId}            a single food
+    GET  /fdc/v1/{fdcId}                 the same (older form)
+    GET  /fdc/v1/foods?fdcIds=1,2        several foods
+    POST /fdc/v1/foods                   the same, with a JSON body
+                                         {"fdcIds": [...]}
+    GET  /fdc/v1/foods/search?query=...  search, with pageSize and
+                                         pageNumber
+    POST /fdc/v1/foods/search            the same, with a JSON body
+    GET  /fdc/v1/search?generalSearchInput=...
+                                         search (older form)
+
+Query parameters other than these, such as api_key, are ignored.
+
+Foods are read from a `FoodStore` written by `build_food_store`, and
+searched with a search index written by `build_search_index`, so the server
+starts without merging raw data, and only recently used foods are held in
+memory.  Responses are kept in an LRU cache.  The server is a single
+asyncio event loop with a minimal HTTP/1.1 implementation that
+supports keep-alive connections, so it can handle many concurrent clients
+without a thread per connection.
+
+`benchmark_server` starts a server in a separate process and measures its
+throughput and latency under load from many concurrent connections.
+
+This module requires NumPy.
+"""
+import asyncio
+from collections import OrderedDict
+import json
+import math
+import multiprocessing
+import random
+import signal
+import socket
+import time
+import traceback
+import urllib.parse
+
+from .food_store import FoodStore
+from .search_index import SearchIndex
+from .search_index import tokenize
+
+
+# The fields of a food that are included in search results.
+_SEARCH_RESULT_FIELDS = [
+    'fdcId', 'description', 'dataType', 'gtinUpc', 'publicationDate',
+    'brandOwner', 'brand_name', 'ingredients', 'marketCountry',
+    'brandedFoodCategory', 'modifiedDate', 'dataSource', 'servingSizeUnit',
+    'servingSize', 'householdServingFullText',
+]
+# Default and maximum number of search results per page, as in the FDC API.
+_DEFAULT_PAGE_SIZE = 50
+_MAX_PAGE_SIZE = 200
+# Maximum number of foods in a batch request, as in the FDC API.
+_MAX_BATCH_SIZE = 20
+# Maximum size of a request body, in bytes.
+_MAX_BODY_SIZE = 1 << 20
+# fdc_ids are stored as SQLite integers, which are at most this.
+_MAX_FDC_ID = (1 << 63) - 1
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+_encode = json.JSONEncoder(
+    ensure_ascii=False, check_circular=False, separators=(',', ':')).encode
+
+
+class _BadRequest(Exception):
+    """An error in a request, which is returned to the client."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _error_body(message):
+    return _encode({'error': message}).encode('utf8')
+
+
+class FoodServer(object):
+    """Serves merged foods over HTTP."""
+
+    def __init__(self, food_store, search_index, cache_size=10000):
+        """Create a server.
+
+        Args:
+            food_store: A `FoodStore` of the foods.
+            search_index: A `SearchIndex` of the foods.
+            cache_size: The maximum number of responses to cache.
+        """
+        self._food_store = food_store
+        self._search_index = search_index
+        self._cache_size = cache_size
+        # An `OrderedDict` from (method, target, body) to (status, body),
+        # from least to most recently used.
+        self._cache = OrderedDict()
+        self.num_requests = 0
+
+    @property
+    def num_foods(self):
+        return self._search_index.num_docs
+
+    def close(self):
+        self._search_index.close()
+        self._food_store.close()
+
+    def _food(self, fdc_id):
+        item = self._food_store.get(_parse_fdc_id(fdc_id))
+        if item is None:
+            raise _BadRequest(404, 'No food with fdcId %s' % fdc_id)
+        return _encode(item).encode('utf8')
+
+    def _foods_batch(self, fdc_ids):
+        fdc_ids = [_parse_fdc_id(fdc_id) for fdc_id in fdc_ids]
+        if len(fdc_ids) > _MAX_BATCH_SIZE:
+            raise _BadRequest(
+                400, 'At most %d fdcIds are allowed' % _MAX_BATCH_SIZE)
+        items = self._food_store.get_many(fdc_ids)
+        # As in the FDC API, fdcIds that aren't found are left out.
+        return _encode([
+            items[fdc_id] for fdc_id in fdc_ids if fdc_id in items
+        ]).encode('utf8')
+
+    def _search(self, query, page_size, page_number):
+        page_size = _parse_int(page_size, 'pageSize')
+        page_number = _parse_int(page_number, 'pageNumber')
+        if not 1 <= page_size <= _MAX_PAGE_SIZE:
+            raise _BadRequest(
+                400, 'pageSize must be between 1 and %d' % _MAX_PAGE_SIZE)
+        if page_number < 1:
+            raise _BadRequest(400, 'pageNumber must be positive')
+        total, results = self._search_index.search_page(
+            query, page_size, page_number)
+        items = self._food_store.get_many(
+            result.fdc_id for result in results)
+        return _encode({
+            'foodSearchCriteria': {
+                'query': query,
+                'generalSearchInput': query,
+                'pageNumber': page_number,
+                'pageSize': page_size,
+                'requireAllWords': True,
+            },
+            'totalHits': total,
+            'currentPage': page_number,
+            'totalPages': math.ceil(total / page_size),
+            'foods': [
+                _search_result(items[result.fdc_id]) for result in results
+                if result.fdc_id in items],
+        }).encode('utf8')
+
+    def _route(self, method, target, body):
+        """Return the response body for a request."""
+        url = urllib.parse.urlsplit(target)
+        params = urllib.parse.parse_qs(url.query)
+        path = url.path.rstrip('/')
+        if path.startswith('/fdc/v1'):
+            path = path[len('/fdc/v1'):]
+        parts = path.split('/')[1:]
+        if method == 'POST':
+            try:
+                body = json.loads(body.decode('utf8'))
+            except ValueError:
+                raise _BadRequest(400, 'The request body is not valid JSON')
+            if not isinstance(body, dict):
+                raise _BadRequest(400, 'The request body is not an object')
+        elif method != 'GET':
+            raise _BadRequest(405, 'Method %s not allowed' % method)
+
+        def param(name, default=None):
+            if method == 'POST':
+                return body.get(name, default)
+            values = params.get(name)
+            return values[-1] if values else default
+
+        if len(parts) == 1 and parts[0].isdigit() and method == 'GET':
+            return self._food(parts[0])
+        if len(parts) == 2 and parts[0] == 'food' and method == 'GET':
+            return self._food(parts[1])
+        if parts == ['foods']:
+            if method == 'POST':
+                fdc_ids = body.get('fdcIds') or []
+                if not isinstance(fdc_ids, list):
+                    raise _BadRequest(400, 'fdcIds must be a list')
+            else:
+                fdc_ids = [
+                    fdc_id for value in params.get('fdcIds', [])
+                    for fdc_id in value.split(',') if fdc_id]
+            return self._foods_batch(fdc_ids)
+        if parts in (['foods', 'search'], ['search']):
+            query = param('query') or param('generalSearchInput') or ''
+            if not isinstance(query, str):
+                raise _BadRequest(400, 'query must be a string')
+            return self._search(
+                query,
+                param('pageSize', _DEFAULT_PAGE_SIZE),
+                param('pageNumber', 1))
+        raise _BadRequest(404, 'Unknown resource %s' % url.path)
+
+    def respond(self, method, target, body):
+        """Return the status and body of the response to a request."""
+        self.num_requests += 1
+        key = (method, target, body)
+        response = self._cache.get(key)
+        if response is not None:
+            self._cache.move_to_end(key)
+            return response
+        try:
+            response = 200, self._route(method, target, body)
+        except _BadRequest as e:
+            response = e.status, _error_body(str(e))
+        except Exception:
+            # E.g. a corrupt row in the store.  This isn't cached, since it
+            # may not happen again.
+            traceback.print_exc()
+            return 500, _error_body('Internal server error')
+        if self._cache_size:
+            self._cache[key] = response
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return response
+
+    async def handle_connection(self, reader, writer):
+        """Handle the requests on a connection until it is closed."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = (
+                        request_line.decode('latin-1').split())
+                except ValueError:
+                    await _write_response(
+                        writer, 400, _error_body('Malformed request'), False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= _MAX_BODY_SIZE:
+                    await _write_response(
+                        writer, 413, _error_body('Bad request body'), False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                status, response_body = self.respond(method, target, body)
+                await _write_response(
+                    writer, status, response_body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def _parse_fdc_id(fdc_id):
+    try:
+        value = int(fdc_id)
+    except (TypeError, ValueError):
+        value = -1
+    if not 0 <= value <= _MAX_FDC_ID:
+        raise _BadRequest(400, 'Invalid fdcId %s' % fdc_id)
+    return value
+
+
+def _search_result(item):
+    """Return the fields of a food that are included in search results."""
+    return {
+        field: item[field] for field in _SEARCH_RESULT_FIELDS
+        if field in item}
+
+
+def _parse_int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise _BadRequest(400, 'Invalid %s %s' % (name, value))
+
+
+async def _write_response(writer, status, body, keep_alive):
+    writer.write((
+        'HTTP/1.1 %d %s\r\n'
+        'Content-Type: application/json\r\n'
+        'Content-Length: %d\r\n'
+        'Connection: %s\r\n'
+        '\r\n' % (
+            status, _REASONS[status], len(body),
+            'keep-alive' if keep_alive else 'close')).encode('latin-1'))
+    writer.write(body)
+    await writer.drain()
+
+
+def load_food_server(store_file, index_file, cache_size=10000):
+    """Return a `FoodServer` for a food store and search index.
+
+    Args:
+        store_file: A food store written by `build_food_store`.
+        index_file: A search index written by `build_search_index`.
+        cache_size: The maximum number of responses to cache.
+    """
+    food_store = FoodStore(store_file)
+    try:
+        search_index = SearchIndex(index_file)
+    except Exception:
+        food_store.close()
+        raise
+    return FoodServer(food_store, search_index, cache_size)
+
+
+async def _serve_forever(server, host, port, ready=None):
+    asyncio_server = await asyncio.start_server(
+        server.handle_connection, host, port, backlog=1024)
+    print('serving %d foods on http://%s:%d/fdc/v1/' % (
+        server.num_foods, host, port))
+    # Stop cleanly when interrupted or terminated, so that the food store
+    # and search index are closed.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    if ready is not None:
+        ready.set()
+    async with asyncio_server:
+        await stop.wait()
+
+
+def serve(store_file, index_file, host='127.0.0.1', port=8080,
+          cache_size=10000, ready=None):
+    """Serve merged foods until interrupted or terminated.
+
+    Args:
+        store_file: A food store written by `build_food_store`.
+        index_file: A search index written by `build_search_index`.
+        host: The address to listen on.
+        port: The port to listen on.
+        cache_size: The maximum number of responses to cache.
+        ready: If set, a `multiprocessing.Event` which is set once the
+            server is listening.
+    """
+    server = load_food_server(store_file, index_file, cache_size=cache_size)
+    try:
+        asyncio.run(_serve_forever(server, host, port, ready))
+    finally:
+        server.close()
+
+
+async def _request(reader, writer, host, method, target, body=b''):
+    """Send a request on a keep-alive connection and read the response."""
+    head = '%s %s HTTP/1.1\r\nHost: %s\r\n' % (method, target, host)
+    if body:
+        head += ('Content-Type: application/json\r\n'
+                 'Content-Length: %d\r\n' % len(body))
+    writer.write((head + '\r\n').encode('latin-1') + body)
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        if name.lower() == b'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def _run_load(host, port, requests, concurrency):
+    """Send requests from concurrent connections.
+
+    Returns:
+        A list of (kind, status, latency in seconds) for each request.
+    """
+    requests = iter(requests)
+    results = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for kind, method, target, body in requests:
+                start = time.perf_counter()
+                status, _ = await _request(
+                    reader, writer, host, method, target, body)
+                results.append((kind, status, time.perf_counter() - start))
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return results
+
+
+def _sample_requests(fdc_ids, descriptions, num_requests, rng):
+    """Sample a mix of food, batch and search requests.
+
+    Requests for foods are skewed towards a small set of popular foods, as
+    for a typical recipe tool.
+    """
+    popular = rng.sample(fdc_ids, min(len(fdc_ids), 100))
+    requests = []
+    for _ in range(num_requests):
+        kind = rng.choices(['food', 'foods', 'search'], [6, 2, 2])[0]
+        if kind == 'food':
+            fdc_id = rng.choice(popular if rng.random() < 0.5 else fdc_ids)
+            requests.append(
+                (kind, 'GET', '/fdc/v1/food/%d' % fdc_id, b''))
+        elif kind == 'foods':
+            batch = rng.sample(fdc_ids, min(len(fdc_ids), 10))
+            requests.append((
+                kind, 'POST', '/fdc/v1/foods',
+                json.dumps({'fdcIds': batch}).encode('utf8')))
+        else:
+            words = tokenize(rng.choice(descriptions))[:rng.randint(1, 2)]
+            query = urllib.parse.quote(' '.join(words))
+            requests.append((
+                kind, 'GET',
+                '/fdc/v1/foods/search?query=%s&pageSize=25' % query, b''))
+    return requests
+
+
+def _latency_stats(latencies):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'mean_ms': 1000 * sum(latencies) / count,
+        'p50_ms': 1000 * latencies[count // 2],
+        'p95_ms': 1000 * latencies[int(0.95 * (count - 1))],
+        'p99_ms': 1000 * latencies[int(0.99 * (count - 1))],
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def benchmark_server(store_file, index_file, num_requests=20000,
+                     concurrency=64, seed=0, results_file=None):
+    """Measure the throughput and latency of a server under load.
+
+    A server for a food store and search index is started in a separate
+    process, and a mix of requests for single foods, batches of foods and
+    searches is sent to it from `concurrency` keep-alive connections.
+
+    Args:
+        store_file: A food store written by `build_food_store`.
+        index_file: A search index written by `build_search_index`.
+        num_requests: The number of requests to send.
+        concurrency: The number of concurrent connections.
+        seed: The seed used to sample requests.
+        results_file: If set, a file to write the results to as JSON.
+
+    Returns:
+        A dict of the results.
+    """
+    host = '127.0.0.1'
+    port = _free_port()
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    process = context.Process(
+        target=serve, args=(store_file, index_file, host, port),
+        kwargs={'ready': ready})
+    process.start()
+    try:
+        while not ready.wait(1):
+            if not process.is_alive():
+                raise RuntimeError('The server failed to start')
+        rng = random.Random(seed)
+        with FoodStore(store_file) as food_store:
+            fdc_ids = food_store.fdc_ids()
+
+        async def run():
+            # Fetch some foods to sample search queries from.
+            reader, writer = await asyncio.open_connection(host, port)
+            descriptions = []
+            sample = rng.sample(fdc_ids, min(len(fdc_ids), 200))
+            for start in range(0, len(sample), _MAX_BATCH_SIZE):
+                _, body = await _request(
+                    reader, writer, host, 'POST', '/fdc/v1/foods',
+                    json.dumps({'fdcIds': sample[
+                        start:start + _MAX_BATCH_SIZE]}).encode('utf8'))
+                descriptions.extend(
+                    food.get('description', '') for food in json.loads(body))
+            writer.close()
+            requests = _sample_requests(
+                fdc_ids, descriptions, num_requests, rng)
+            start = time.perf_counter()
+            results = await _run_load(host, port, requests, concurrency)
+            return results, time.perf_counter() - start
+
+        print('sending %d requests from %d connections' % (
+            num_requests, concurrency))
+        results, seconds = asyncio.run(run())
+    finally:
+        process.terminate()
+        process.join()
+    summary = {
+        'requests': len(results),
+        'concurrency': concurrency,
+        'seconds': seconds,
+        'requests_per_second': len(results) / seconds,
+        'errors': sum(1 for _, status, _ in results if status != 200),
+        'all': _latency_stats([latency for _, _, latency in results]),
+    }
+    for kind in ('food', 'foods', 'search'):
+        latencies = [
+            latency for other, _, latency in results if other == kind]
+        if latencies:
+            summary[kind] = _latency_stats(latencies)
+    print('%d requests in %.1fs: %.0f requests/s, %d errors' % (
+        summary['requests'], seconds, summary['requests_per_second'],
+        summary['errors']))
+    for kind in ('all', 'food', 'foods', 'search'):
+        if kind in summary:
+            stats = summary[kind]
+            print('%-8s mean %.2fms, p50 %.2fms, p95 %.2fms, p99 %.2fms' % (
+                kind, stats['mean_ms'], stats['p50_ms'], stats['p95_ms'],
+                stats['p99_ms']))
+    if results_file is not None:
+        with open(results_file, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    return summary
@@ -0,0 +1,175 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Mergeable sketches for approximate summaries of high-cardinality fields.
+
+`SpaceSaving` estimates the most frequent values and their frequencies, and
+`HyperLogLog` estimates the number of distinct values.  Both use a fixed
+amount of memory determined by an error bound, and sketches of different
+parts of the data can be merged.
+"""
+import hashlib
+import heapq
+import math
+
+
+class SpaceSaving(object):
+    """The Space-Saving sketch of the most frequent values of a stream.
+
+    At most `capacity` values are counted.  When a new value is seen and the
+    sketch is full, the value with the smallest count is replaced, and the
+    new value inherits its count, which is recorded as the error of that
+    count.  The count of each value is an overestimate by at most its error,
+    which is at most `num_items / capacity`, and every value with frequency
+    greater than `num_items / capacity` is counted.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.num_items = 0
+        # A dict from value to a pair [count, error].
+        self._counters = {}
+        # A min-heap of (count, value).  It may contain stale entries for
+        # values whose count has since increased, or that were replaced.
+        self._heap = []
+
+    @classmethod
+    def from_error(cls, error):
+        """Create a sketch whose counts are within `error * num_items`."""
+        return cls(int(math.ceil(1.0 / error)))
+
+    def add(self, value, count=1):
+        self.num_items += count
+        counter = self._counters.get(value)
+        if counter is not None:
+            counter[0] += count
+        elif len(self._counters) < self.capacity:
+            self._counters[value] = [count, 0]
+        else:
+            min_count = self._pop_min()
+            self._counters[value] = [min_count + count, min_count]
+        self._push(value)
+
+    def _push(self, value):
+        heapq.heappush(self._heap, (self._counters[value][0], value))
+        if len(self._heap) > 2 * self.capacity:
+            self._heap = [
+                (counter[0], value)
+                for value, counter in self._counters.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        """Remove the value with the smallest count, returning its count."""
+        while True:
+            count, value = heapq.heappop(self._heap)
+            counter = self._counters.get(value)
+            if counter is not None and counter[0] == count:
+                del self._counters[value]
+                return count
+
+    def _min_count(self):
+        """The smallest count, or 0 if the sketch isn't full."""
+        if len(self._counters) < self.capacity:
+            return 0
+        return min(counter[0] for counter in self._counters.values())
+
+    def merge(self, other):
+        """Add the counts of another sketch with the same capacity."""
+        # Values not counted by a sketch may have occurred up to its
+        # smallest count times.
+        min_count, other_min_count = self._min_count(), other._min_count()
+        merged = {}
+        for value, (count, error) in self._counters.items():
+            other_counter = other._counters.get(value)
+            if other_counter is None:
+                merged[value] = [count + other_min_count,
+                                 error + other_min_count]
+            else:
+                merged[value] = [count + other_counter[0],
+                                 error + other_counter[1]]
+        for value, (count, error) in other._counters.items():
+            if value not in merged:
+                merged[value] = [count + min_count, error + min_count]
+        self.num_items += other.num_items
+        self._counters = dict(heapq.nlargest(
+            self.capacity, merged.items(), key=lambda item: item[1][0]))
+        self._heap = [
+            (counter[0], value) for value, counter in self._counters.items()]
+        heapq.heapify(self._heap)
+
+    def most_common(self):
+        """Return (value, count, error) for each value, most frequent first.
+
+        Values with equal counts are in order of value.
+        """
+        return [
+            (value, count, error)
+            for value, (count, error) in sorted(
+                self._counters.items(),
+                key=lambda item: (-item[1][0], item[0]))]
+
+
+def _hash64(value):
+    return int.from_bytes(
+        hashlib.blake2b(value.encode('utf8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog(object):
+    """The HyperLogLog sketch of the number of distinct values of a stream.
+
+    Uses `2 ** precision` one byte registers.  The relative standard error of
+    the estimate is about `1.04 / sqrt(2 ** precision)`.
+    """
+
+    def __init__(self, precision):
+        assert 4 <= precision <= 18, precision
+        self.precision = precision
+        self._registers = bytearray(1 << precision)
+
+    @classmethod
+    def from_error(cls, error):
+        """Create a sketch with relative standard error at most `error`."""
+        precision = int(math.ceil(2 * math.log2(1.04 / error)))
+        return cls(min(max(precision, 4), 18))
+
+    @property
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self._registers))
+
+    def add(self, value):
+        hash_value = _hash64(value)
+        index_bits = 64 - self.precision
+        index = hash_value >> index_bits
+        rank = index_bits - (
+            hash_value & ((1 << index_bits) - 1)).bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def merge(self, other):
+        """Add the values of another sketch with the same precision."""
+        assert other.precision == self.precision
+        self._registers = bytearray(
+            map(max, self._registers, other._registers))
+
+    def estimate(self):
+        """Estimate the number of distinct values added."""
+        num_registers = len(self._registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(
+            num_registers, 0.7213 / (1 + 1.079 / num_registers))
+        estimate = alpha * num_registers ** 2 / sum(
+            2.0 ** -register for register in self._registers)
+        num_zeros = self._registers.count(0)
+        if estimate <= 2.5 * num_registers and num_zeros:
+            # Use linear counting for small cardinalities.
+            estimate = num_registers * math.log(num_registers / num_zeros)
+        return estimate
@@ -11,40 +11,60 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Function to export summaries of merged data."""
-from collections import Counter
+"""Function to export summaries of merged data.
+
+Summaries are computed directly from the raw data rows, without merging
+foods (see `summary_engine`).
+"""
 from contextlib import contextmanager
 import csv
 import os
 
+from .instrumentation import traced_stage
 from .load_raw_data import load_raw_data
-from .merge_sources import merge_sources
-
-
-def write_values_and_frequencies(merged_data, field, csv_writer):
-    print('generating values and frequencies for field: %s' % field)
-    values = Counter(item[field] for item in merged_data)
-    csv_writer.writerow([field, 'frequency'])
-    for value, frequency in values.most_common():
-        csv_writer.writerow([value, str(frequency)])
+from .summary_engine import check_sketch_error
+from .summary_engine import compute_summaries
+from .summary_engine import FIELD_SUMMARIES
+from .summary_engine import SKETCHED_FIELD_SUMMARIES
+from .summary_engine import summary_columns
 
 
-def write_nutrients_and_frequencies(merged_data, csv_writer):
-    print('generating values and frequencies for nutrients')
-    nutrients = Counter(
-        (nutrient['nutrient']['id'],
-         nutrient['nutrient']['name'],
-         nutrient['nutrient']['unitName'])
-        for item in merged_data for nutrient in item['foodNutrients'])
-    csv_writer.writerow(['id', 'name', 'unit', 'frequency'])
-    scale = 1.0 / float(len(merged_data))
-    for (id, name, unitName), frequency in nutrients.most_common():
-        csv_writer.writerow([id, name, unitName, str(frequency * scale)])
+def summarize(raw_data_dir, summary_dir, cache_dir=None, processes=None,
+              sketch_error=None, nutrient_stats=False):
+    """Write summaries of the merged data.
 
-
-def summarize(raw_data_dir, summary_dir):
-    raw_data = load_raw_data(raw_data_dir)
-    merged_data = merge_sources(raw_data)
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        summary_dir: The directory to write summaries to.
+        cache_dir: If set, a directory used to cache parsed raw data.
+        processes: The number of processes to summarize files with.
+        sketch_error: If set, also write approximate summaries of fields
+            with many distinct values, using sketches with this error bound
+            (see `summary_engine.compute_summaries`).
+        nutrient_stats: If True, also write statistics of the amounts of
+            each nutrient to nutrient_stats.csv.  This requires NumPy.
+    """
+    if sketch_error is None:
+        sketched_field_summaries = []
+    else:
+        check_sketch_error(sketch_error)
+        sketched_field_summaries = SKETCHED_FIELD_SUMMARIES
+    with traced_stage('summarize'):
+        if cache_dir is not None:
+            raw_data = load_raw_data(
+                raw_data_dir, cache_dir=cache_dir, processes=processes,
+                columns=summary_columns(
+                    FIELD_SUMMARIES + sketched_field_summaries,
+                    nutrient_stats))
+        else:
+            raw_data = None
+        summaries = compute_summaries(
+            raw_data_dir,
+            sketched_field_summaries=sketched_field_summaries,
+            sketch_error=sketch_error,
+            nutrient_stats=nutrient_stats,
+            processes=processes,
+            raw_data=raw_data)
 
     # Use a generator for this helper function so we can use it in
     # a `with` statement.
@@ -54,15 +74,27 @@ def summarize(raw_data_dir, summary_dir):
             yield csv.writer(f,  quoting=csv.QUOTE_ALL)
 
     # Generate unique values and frequencies for some fields.
-    with summary_writer('category.csv') as csv_writer:
-        write_values_and_frequencies(
-            merged_data, 'brandedFoodCategory', csv_writer)
-    with summary_writer('data_source.csv') as csv_writer:
-        write_values_and_frequencies(
-            merged_data, 'dataSource', csv_writer)
+    for field_summary in FIELD_SUMMARIES:
+        with summary_writer(field_summary.filename) as csv_writer:
+            summaries.write_values_and_frequencies(
+                field_summary.field, csv_writer)
+
+    # Generate approximate values and frequencies, with the maximum error of
+    # each frequency, and approximate numbers of distinct values.
+    for field_summary in sketched_field_summaries:
+        with summary_writer(field_summary.filename) as csv_writer:
+            summaries.write_sketched_values_and_frequencies(
+                field_summary.field, csv_writer)
+    if sketched_field_summaries:
+        with summary_writer('distinct_values.csv') as csv_writer:
+            summaries.write_distinct_values(csv_writer)
 
     # Generate unique values and frequencies for nutrients, where
     # frequencies are normalized by the total number of branded foods.
     with summary_writer('nutrient.csv') as csv_writer:
-        write_nutrients_and_frequencies(
-            merged_data, csv_writer)
+        summaries.write_nutrients_and_frequencies(csv_writer)
+
+    # Generate statistics of the amount of each nutrient.
+    if nutrient_stats:
+        with summary_writer('nutrient_stats.csv') as csv_writer:
+            summaries.write_nutrient_stats(csv_writer)
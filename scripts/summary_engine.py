@@ -0,0 +1,475 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""An engine to compute summaries directly from raw data rows.
+
+The summaries written by `summarize` are frequency tables of some fields of
+the merged foods, and of the nutrients they contain.  These can be computed
+without merging, with a single pass over `branded_food.csv` followed by a
+single pass over `food_nutrient.csv`.
+
+Each pass can be split into shards (byte ranges of the file, see
+`parallel_csv`).  A `SummaryAggregate` is computed for each shard, and these
+are merged in the order of the shards.  The result is the same as computing
+the summaries from the merged foods, including the order of values with the
+same frequency, which is the order in which they first appear in the merged
+foods.
+
+Fields with many distinct values, such as `brandOwner`, can be summarized
+approximately using sketches (see `sketches`), whose memory use depends only
+on the error bound.  Statistics of nutrient amounts can also be computed in
+the pass over `food_nutrient.csv` (see `nutrient_stats`).
+"""
+from collections import Counter
+from collections import namedtuple
+import concurrent.futures
+import math
+import os
+
+from .file_schemas import BrandedFood
+from .file_schemas import FoodNutrient
+from .file_schemas import Nutrient
+from .file_schemas import row_converter
+from .instrumentation import traced_stage
+from .merge_sources import _convert_nutrient
+from .merge_sources import MERGE_COLUMNS
+from .parallel_csv import check_header
+from .parallel_csv import iter_rows_in_range
+from .parallel_csv import split_into_ranges
+from .sketches import HyperLogLog
+from .sketches import SpaceSaving
+
+
+# A frequency table of a field of the merged foods, written to `filename`.
+# `field` is the name of the field in the merged foods, and `column` is the
+# name of the column in `branded_food.csv` that it comes from.
+FieldSummary = namedtuple('FieldSummary', ['filename', 'field', 'column'])
+
+# The frequency tables of fields computed by `summarize`.
+FIELD_SUMMARIES = [
+    FieldSummary('category.csv', 'brandedFoodCategory',
+                 'branded_food_category'),
+    FieldSummary('data_source.csv', 'dataSource', 'data_source'),
+]
+
+# The frequency tables of fields computed approximately by `summarize`, when
+# an error bound for sketches is given.
+SKETCHED_FIELD_SUMMARIES = [
+    FieldSummary('brand_owner.csv', 'brandOwner', 'brand_owner'),
+    FieldSummary('gtin_upc.csv', 'gtinUpc', 'gtin_upc'),
+    FieldSummary('ingredients.csv', 'ingredients', 'ingredients'),
+]
+
+# Number of shards per process.
+_SHARDS_PER_PROCESS = 4
+# Number of food nutrients in each chunk of amounts added to statistics.
+_STATS_CHUNK_SIZE = 100000
+
+
+class SummaryAggregate(object):
+    """Partial aggregates for summaries of a shard of the raw data.
+
+    Aggregates for different shards can be combined with `merge`.
+    """
+
+    def __init__(self, field_summaries, sketched_field_summaries=(),
+                 sketch_error=None, nutrient_stats=False):
+        self.num_foods = 0
+        self.num_food_nutrients = 0
+        self._columns = [
+            (summary.field, summary.column) for summary in field_summaries]
+        self._sketched_columns = [
+            (summary.field, summary.column)
+            for summary in sketched_field_summaries]
+        # A `Counter` of the values of each field, whose keys are in the
+        # order they first appear.
+        self.field_values = {
+            summary.field: Counter() for summary in field_summaries}
+        # A pair of a `SpaceSaving` and a `HyperLogLog` sketch of the values
+        # of each sketched field.
+        self.field_sketches = {
+            summary.field: (SpaceSaving.from_error(sketch_error),
+                            HyperLogLog.from_error(sketch_error))
+            for summary in sketched_field_summaries}
+        # A dict from nutrient_id to a pair of the number of times that
+        # nutrient appears in a merged food, and a key giving the position
+        # of its first appearance.
+        self.nutrients = {}
+        if nutrient_stats:
+            # Imported here because this requires NumPy, which is not
+            # otherwise needed.
+            from .nutrient_stats import NutrientStatistics
+            self.nutrient_stats = NutrientStatistics()
+        else:
+            self.nutrient_stats = None
+
+    def add_branded_food(self, branded_food):
+        self.num_foods += 1
+        for field, column in self._columns:
+            self.field_values[field][getattr(branded_food, column)] += 1
+        for field, column in self._sketched_columns:
+            value = getattr(branded_food, column)
+            frequent_values, distinct_values = self.field_sketches[field]
+            frequent_values.add(value)
+            distinct_values.add(value)
+
+    def add_nutrient(self, nutrient_id, count, first_seen):
+        previous = self.nutrients.get(nutrient_id)
+        if previous is None:
+            self.nutrients[nutrient_id] = [count, first_seen]
+        else:
+            previous[0] += count
+            previous[1] = min(previous[1], first_seen)
+
+    def merge(self, other):
+        """Add the aggregates of a later shard to this one."""
+        self.num_foods += other.num_foods
+        self.num_food_nutrients += other.num_food_nutrients
+        for field, values in other.field_values.items():
+            self.field_values[field].update(values)
+        for field, (frequent_values, distinct_values) in (
+                other.field_sketches.items()):
+            self.field_sketches[field][0].merge(frequent_values)
+            self.field_sketches[field][1].merge(distinct_values)
+        for nutrient_id, (count, first_seen) in other.nutrients.items():
+            self.add_nutrient(nutrient_id, count, first_seen)
+        if other.nutrient_stats is not None:
+            self.nutrient_stats.merge(other.nutrient_stats)
+
+
+def _summarize_branded_foods(rows, aggregate_args):
+    """Summarize a shard of branded foods.
+
+    Args:
+        rows: An iterable of branded foods.
+        aggregate_args: The arguments to create a `SummaryAggregate`.
+
+    Returns:
+        A pair of a `SummaryAggregate` and a list of the fdc_id of each row.
+    """
+    aggregate = SummaryAggregate(*aggregate_args)
+    fdc_ids = []
+    for branded_food in rows:
+        fdc_ids.append(branded_food.fdc_id)
+        aggregate.add_branded_food(branded_food)
+    return aggregate, fdc_ids
+
+
+def _summarize_food_nutrients(rows, shard_index, food_positions,
+                              nutrient_ids, nutrient_stats=False):
+    """Summarize a shard of food nutrients.
+
+    Args:
+        rows: An iterable of food nutrients.
+        shard_index: The index of this shard.
+        food_positions: A dict from fdc_id to a pair of the position of the
+            first branded food with that fdc_id, and the number of branded
+            foods with that fdc_id.
+        nutrient_ids: The set of nutrient ids that are merged.
+        nutrient_stats: If True, also compute statistics of the amounts of
+            each nutrient.
+
+    Returns:
+        A `SummaryAggregate`.
+    """
+    aggregate = SummaryAggregate([], nutrient_stats=nutrient_stats)
+    # The nutrient ids and amounts of the current chunk.
+    chunk_nutrient_ids = []
+    chunk_amounts = []
+    for row_index, food_nutrient in enumerate(rows):
+        aggregate.num_food_nutrients += 1
+        position = food_positions.get(food_nutrient.fdc_id)
+        if position is None or food_nutrient.nutrient_id not in nutrient_ids:
+            continue
+        food_position, count = position
+        # Merged foods are in order of branded food, and within each food
+        # the nutrients are in the order of the rows of food_nutrient.csv.
+        aggregate.add_nutrient(
+            food_nutrient.nutrient_id,
+            count,
+            (food_position, shard_index, row_index))
+        if nutrient_stats and food_nutrient.amount is not None:
+            chunk_nutrient_ids.append(food_nutrient.nutrient_id)
+            chunk_amounts.append(food_nutrient.amount)
+            if len(chunk_amounts) == _STATS_CHUNK_SIZE:
+                aggregate.nutrient_stats.add_chunk(
+                    chunk_nutrient_ids, chunk_amounts)
+                chunk_nutrient_ids = []
+                chunk_amounts = []
+    if nutrient_stats:
+        aggregate.nutrient_stats.add_chunk(chunk_nutrient_ids, chunk_amounts)
+    return aggregate
+
+
+# State shared by the shards of a pass, set in each worker process.
+_shard_state = {}
+
+
+def _init_shards(state):
+    _shard_state.clear()
+    _shard_state.update(state)
+
+
+def _branded_food_shard(path, start, end):
+    convert_row = row_converter(BrandedFood, _shard_state['column_types'])
+    return _summarize_branded_foods(
+        map(convert_row, iter_rows_in_range(path, start, end)),
+        _shard_state['aggregate_args'])
+
+
+def _food_nutrient_shard(shard_index, path, start, end):
+    convert_row = row_converter(FoodNutrient, _shard_state['column_types'])
+    return _summarize_food_nutrients(
+        map(convert_row, iter_rows_in_range(path, start, end)),
+        shard_index,
+        _shard_state['food_positions'],
+        _shard_state['nutrient_ids'],
+        _shard_state['nutrient_stats'])
+
+
+def _map_shards(shard_fn, shards, processes, **state):
+    """Call `shard_fn` on each shard, yielding the results in order.
+
+    `state` is set in `_shard_state` before any shard is processed.
+    """
+    if processes is None or processes <= 1 or len(shards) <= 1:
+        _init_shards(state)
+        for shard in shards:
+            yield shard_fn(*shard)
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, initializer=_init_shards, initargs=(state,)
+            ) as executor:
+        yield from executor.map(shard_fn, *zip(*shards))
+
+
+def _food_positions(fdc_id_lists):
+    """Compute the argument `food_positions` of `_summarize_food_nutrients`."""
+    food_positions = {}
+    position = 0
+    for fdc_ids in fdc_id_lists:
+        for fdc_id in fdc_ids:
+            previous = food_positions.get(fdc_id)
+            if previous is None:
+                food_positions[fdc_id] = (position, 1)
+            else:
+                food_positions[fdc_id] = (previous[0], previous[1] + 1)
+            position += 1
+    return food_positions
+
+
+def _branded_food_columns(field_summaries):
+    columns = {'fdc_id': int}
+    for summary in field_summaries:
+        columns[summary.column] = str
+    return columns
+
+
+def _food_nutrient_columns(nutrient_stats):
+    columns = {'fdc_id': int, 'nutrient_id': str}
+    if nutrient_stats:
+        columns['amount'] = float
+    return columns
+
+
+class SummaryResult(object):
+    """The combined aggregates for all shards, and the nutrients table."""
+
+    def __init__(self, aggregate, nutrients):
+        self.aggregate = aggregate
+        # A dict from nutrient_nbr to the nutrient, as in `merge_sources`.
+        self.nutrients = nutrients
+
+    def write_values_and_frequencies(self, field, csv_writer):
+        print('writing values and frequencies for field: %s' % field)
+        csv_writer.writerow([field, 'frequency'])
+        for value, frequency in (
+                self.aggregate.field_values[field].most_common()):
+            csv_writer.writerow([value, str(frequency)])
+
+    def write_sketched_values_and_frequencies(self, field, csv_writer):
+        """Write the approximate most frequent values of a sketched field.
+
+        Each frequency is an overestimate by at most the value in the error
+        column.
+        """
+        print('writing approximate values and frequencies for field: %s'
+              % field)
+        csv_writer.writerow([field, 'frequency', 'error'])
+        for value, frequency, error in (
+                self.aggregate.field_sketches[field][0].most_common()):
+            csv_writer.writerow([value, str(frequency), str(error)])
+
+    def write_distinct_values(self, csv_writer):
+        """Write the approximate number of distinct values of each field.
+
+        The error column is the standard error of the estimate.
+        """
+        print('writing approximate numbers of distinct values')
+        csv_writer.writerow(['field', 'distinct', 'error'])
+        for field, (_, distinct_values) in (
+                self.aggregate.field_sketches.items()):
+            estimate = distinct_values.estimate()
+            csv_writer.writerow([
+                field,
+                str(int(round(estimate))),
+                str(int(math.ceil(
+                    estimate * distinct_values.relative_error)))])
+
+    def write_nutrient_stats(self, csv_writer):
+        from .nutrient_stats import write_nutrient_stats
+        write_nutrient_stats(
+            self.aggregate.nutrient_stats, self.nutrients, csv_writer)
+
+    def write_nutrients_and_frequencies(self, csv_writer):
+        print('writing values and frequencies for nutrients')
+        nutrients = Counter()
+        for nutrient_id, (count, _) in sorted(
+                self.aggregate.nutrients.items(),
+                key=lambda item: item[1][1]):
+            nutrient = self.nutrients[nutrient_id]
+            nutrients[(nutrient['id'], nutrient['name'],
+                       nutrient['unitName'])] += count
+        csv_writer.writerow(['id', 'name', 'unit', 'frequency'])
+        if not nutrients:
+            return
+        scale = 1.0 / float(self.aggregate.num_foods)
+        for (id, name, unitName), frequency in nutrients.most_common():
+            csv_writer.writerow([id, name, unitName, str(frequency * scale)])
+
+
+def check_sketch_error(sketch_error):
+    """Raise a ValueError if `sketch_error` is not a valid error bound."""
+    if not 0 < sketch_error < 1:
+        raise ValueError(
+            'sketch_error must be between 0 and 1, not %s' % sketch_error)
+
+
+def compute_summaries(raw_data_dir, field_summaries=FIELD_SUMMARIES,
+                      sketched_field_summaries=(), sketch_error=None,
+                      nutrient_stats=False, processes=None, raw_data=None):
+    """Compute summaries from raw data.
+
+    Args:
+        raw_data_dir: The directory containing raw FDC data.
+        field_summaries: A list of `FieldSummary`s to compute exactly.
+        sketched_field_summaries: A list of `FieldSummary`s to compute
+            approximately.
+        sketch_error: The error bound of sketches, as a fraction of the
+            number of foods for frequencies and of the number of distinct
+            values for distinct counts.  Required if
+            `sketched_field_summaries` is not empty.
+        nutrient_stats: If True, also compute statistics of the amounts of
+            each nutrient.  This requires NumPy.
+        processes: The number of processes to use, or None to compute all
+            summaries in this process.
+        raw_data: If set, a `RawData` loaded with the columns returned by
+            `summary_columns` for all the field summaries (e.g. from the
+            cache), which is used instead of reading the files in
+            `raw_data_dir`.
+
+    Returns:
+        A `SummaryResult`.
+    """
+    if sketched_field_summaries:
+        check_sketch_error(sketch_error)
+    nutrient_rows = (
+        raw_data.nutrients if raw_data is not None
+        else _iter_nutrients(raw_data_dir))
+    nutrients = {
+        nutrient.nutrient_nbr: _convert_nutrient(nutrient)
+        for nutrient in nutrient_rows}
+    branded_food_columns = _branded_food_columns(
+        list(field_summaries) + list(sketched_field_summaries))
+    aggregate_args = (
+        field_summaries, sketched_field_summaries, sketch_error,
+        nutrient_stats)
+    aggregate = SummaryAggregate(*aggregate_args)
+
+    print('summarizing branded foods')
+    if raw_data is not None:
+        # A generator, so that the rows are summarized in the stage below.
+        branded_results = (
+            _summarize_branded_foods(rows, aggregate_args)
+            for rows in [raw_data.branded_foods])
+    else:
+        branded_results = _map_shards(
+            _branded_food_shard,
+            _shards(raw_data_dir, 'branded_food.csv', BrandedFood, processes),
+            processes,
+            column_types=branded_food_columns,
+            aggregate_args=aggregate_args)
+    fdc_id_lists = []
+    with traced_stage('summarize branded foods') as stage:
+        for partial, fdc_ids in branded_results:
+            aggregate.merge(partial)
+            fdc_id_lists.append(fdc_ids)
+            stage.add(partial.num_foods)
+    food_positions = _food_positions(fdc_id_lists)
+    del fdc_id_lists
+
+    print('summarizing food nutrients')
+    if raw_data is not None:
+        nutrient_results = (
+            _summarize_food_nutrients(
+                rows, 0, food_positions, set(nutrients), nutrient_stats)
+            for rows in [raw_data.food_nutrients])
+    else:
+        shards = _shards(
+            raw_data_dir, 'food_nutrient.csv', FoodNutrient, processes)
+        nutrient_results = _map_shards(
+            _food_nutrient_shard,
+            [(index,) + shard for index, shard in enumerate(shards)],
+            processes,
+            column_types=_food_nutrient_columns(nutrient_stats),
+            food_positions=food_positions,
+            nutrient_ids=set(nutrients),
+            nutrient_stats=nutrient_stats)
+    with traced_stage('summarize food nutrients') as stage:
+        for partial in nutrient_results:
+            aggregate.merge(partial)
+            stage.add(partial.num_food_nutrients)
+    return SummaryResult(aggregate, nutrients)
+
+
+def summary_columns(field_summaries=FIELD_SUMMARIES, nutrient_stats=False):
+    """The columns needed by `compute_summaries`, for `load_raw_data`."""
+    return {
+        'branded_foods': _branded_food_columns(field_summaries),
+        'food_nutrients': _food_nutrient_columns(nutrient_stats),
+        'nutrients': MERGE_COLUMNS['nutrients'],
+    }
+
+
+def _shards(raw_data_dir, filename, data_cls, processes):
+    """Split a file into shards, returning a list of (path, start, end)."""
+    path = os.path.join(raw_data_dir, filename)
+    num_shards = 1 if processes is None else processes * _SHARDS_PER_PROCESS
+    if processes is None or processes <= 1:
+        header_end, ranges = split_into_ranges(path, num_shards)
+    else:
+        # The shard boundaries are found in parallel.
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            header_end, ranges = split_into_ranges(
+                path, num_shards, executor)
+    check_header(path, header_end, data_cls)
+    return [(path, start, end) for start, end in ranges]
+
+
+def _iter_nutrients(raw_data_dir):
+    path = os.path.join(raw_data_dir, 'nutrient.csv')
+    header_end, ranges = split_into_ranges(path, 1)
+    check_header(path, header_end, Nutrient)
+    convert_row = row_converter(Nutrient, MERGE_COLUMNS['nutrients'])
+    for start, end in ranges:
+        yield from map(convert_row, iter_rows_in_range(path, start, end))